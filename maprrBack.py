@@ -2,32 +2,74 @@
 # coding: utf-8
 
 import os 
+import shutil
 import time
+import email.utils
 import logging
 import random
 import pickle
-import pandas as pd 
+import gzip
+import hashlib
+import sqlite3
+import queue
+import threading
+import itertools
+import contextlib
+import functools
+from collections import OrderedDict
+import concurrent.futures
+import importlib
 import re
-import requests 
-from bs4 import BeautifulSoup
-from natasha import (
-    Segmenter, 
-    MorphVocab, 
-    NewsEmbedding, 
-    NewsMorphTagger, 
-    NewsSyntaxParser, 
-    NewsNERTagger, 
-    PER, 
-    NamesExtractor, 
-    Doc)
-from razdel import tokenize
-
-logging.basicConfig(filename='maprr_out.log', encoding='utf-8', format='%(asctime)s %(message)s', level=logging.INFO)
+import json
+import mmap
+import asyncio
+
+class LazyModule: 
+    """Stands in for a heavy module until one of its attributes is first used, then imports it and puts 
+    the real module in its place among this module's globals, so later lookups go straight to it"""
+    
+    def __init__(self, name, alias): 
+        self.__dict__.update(_name=name, _alias=alias)
+    
+    def __getattr__(self, attr): 
+        module = importlib.import_module(self._name)
+        globals()[self._alias] = module
+        return getattr(module, attr)
+
+# pandas, pyarrow, the http clients, the parsers and natasha's models take most of a second to import, 
+# so they're only imported by whatever first uses them
+pd = LazyModule('pandas', 'pd')
+np = LazyModule('numpy', 'np')
+pa = LazyModule('pyarrow', 'pa')
+pc = LazyModule('pyarrow.compute', 'pc')
+pq = LazyModule('pyarrow.parquet', 'pq')
+aiohttp = LazyModule('aiohttp', 'aiohttp')
+requests = LazyModule('requests', 'requests')
+bs4 = LazyModule('bs4', 'bs4')
+etree = LazyModule('lxml.etree', 'etree')
+natasha = LazyModule('natasha', 'natasha')
+
+def BeautifulSoup(*args, **kwargs): 
+    return bs4.BeautifulSoup(*args, **kwargs)
+
+def log_to_file(path='maprr_out.log'): 
+    """This function sends logging.info to path. Every crawler calls it when it's made, importing doesn't, 
+    and it leaves logging alone if the program has set it up already"""
+    
+    logging.basicConfig(filename=path, encoding='utf-8', format='%(asctime)s %(message)s', level=logging.INFO)
 
 lib_cols = ['title_ru', 'genre', 'text', 'title_en', '1st_line', 'author', 'comp_date', 'comp_loc', 'pub_src', '1st_pub', 'pub_year', 'pub_loc']
 a_cols = ['name', 'birth', 'death', 'a_type', 'sex', 'occs', 'fam_soc_str', 'lit_affil', 'pol_affil', 'corp_type', 'corp_affil']
+# levels of the long text frames, from work down to token
+OHCO = ['w_id', 'stanza', 'line', 'token']
 
 domain = 'https://maprr.iath.virginia.edu/'
+# seconds to wait for a connection and then for each read before a request is given up on, so one 
+# hung connection can't stall a crawl
+request_timeout = (10, 30)
+# fetch threads and parse processes used by ParallelMAPRR
+max_threads = 8
+max_procs = os.cpu_count()
 tables = {
     'agents/': 323, 
     'works/': 648, 
@@ -36,48 +78,569 @@ tables = {
     'multivalent_markers/': 439
 }
 
-allURLs = [domain+item[0]+str(i) for item in tables.items() for i in range(1, item[1]+1)]
+def __getattr__(name): 
+    """Module level values that cost something to make are made when they're first asked for"""
+    
+    if name == 'allURLs': 
+        return [domain+item[0]+str(i) for item in tables.items() for i in range(1, item[1]+1)]
+    if name == 'urls_to_visit': 
+        return [domain+t+str(j) for t, i in list(tables.items())[:2] for j in range(1,i+1)]
+    if name in ('category', 'date_parts'): 
+        return arrow_schemas()[name]
+    if name in ('work_schema', 'agent_schema', 'edge_schema'): 
+        return arrow_schemas()[{'work_schema': 'works', 'agent_schema': 'agents', 'edge_schema': 'edges'}[name]]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def crawl_plan(tables=tables): 
+    """This function lists a (table, id) pair for every page of every entry in the tables dict"""
+    
+    # table names are the tables keys without their trailing slash, e.g. 'agents'
+    return [(t.strip('/'), i) for t, n in tables.items() for i in range(1, n+1)]
+
+def probe(session, url, timeout=30, retries=2, backoff=.5): 
+    """This function asks for a page with HEAD (GET if HEAD isn't allowed) and says whether it exists. 
+    Only 404/410 count as missing, a 500 still means there is a record behind the id. A request that 
+    times out or drops is tried again up to retries times, backoff sec apart and doubling, before 
+    its exception is raised"""
+    
+    for attempt in range(retries+1): 
+        try: 
+            r = session.head(url, timeout=timeout, allow_redirects=True)
+            if r.status_code == 405: 
+                r = session.get(url, timeout=timeout)
+            break
+        except requests.RequestException as e: 
+            if attempt == retries: 
+                raise
+            logging.info(f"Probe of {url} failed: {e!r}, retrying")
+            time.sleep(backoff*2**attempt)
+    logging.info(f"Probed {url}: {r.status_code}")
+    return r.status_code not in (404, 410)
+
+def index_max(session, url, table, timeout=30): 
+    """This function looks for an index page listing the table's records and returns the highest 
+    id linked from it, or 0 if there's no usable index"""
+    
+    try: 
+        r = session.get(url, timeout=timeout)
+    except requests.RequestException as e: 
+        logging.info(f"No index at {url}: {e!r}")
+        return 0
+    if r.status_code != 200: 
+        return 0
+    ids = [int(i) for i in re.findall(rf'href="[^"]*/{table}/(\d+)"', r.text)]
+    return max(ids, default=0)
+
+def discover_max_id(session, base, table, hint=1, window=3, timeout=30): 
+    """This function finds the highest id in a table by probing hint, 2*hint, 4*hint... until it 
+    runs past the end, then binary searching between the last hit and the first miss. Ids can have 
+    holes, so an id counts as inside the table if it or one of the next window-1 ids exists"""
+    
+    def present(i): 
+        return any(probe(session, f"{base}{table}/{j}", timeout) for j in range(i, i+window))
+    
+    # lo is inside the table, hi is past its end
+    lo = 0
+    hi = max(1, hint)
+    while present(hi): 
+        lo, hi = hi, hi*2
+    while hi - lo > 1: 
+        mid = (lo + hi) // 2
+        if present(mid): 
+            lo = mid
+        else: 
+            hi = mid
+    # lo+1 is past the end, so no id from lo+1 up to lo+window exists and lo itself must
+    return lo
+
+def discover_tables(base=domain, tables=tables, window=3, headers=None, timeout=30): 
+    """This function returns a copy of tables with each count replaced by the table's real highest 
+    id, starting from the table's index page when there is one and the old count otherwise. A table 
+    whose probes keep failing keeps its old count (or the index's, if higher). AsyncMAPRR runs this 
+    itself when made with discover=True, maprr and ParallelMAPRR crawl the counts they're given, so 
+    pass them the result instead: ParallelMAPRR(tables=...), or maprrBack.tables for maprr"""
+    
+    found = {}
+    with requests.Session() as session: 
+        session.headers.update(headers or {})
+        for t, n in tables.items(): 
+            table = t.strip('/')
+            hint = index_max(session, base+table, table, timeout) or n
+            try: 
+                found[t] = discover_max_id(session, base, table, hint, window, timeout)
+            except requests.RequestException as e: 
+                # one unreachable table costs its discovery, not everyone else's
+                found[t] = max(n, hint)
+                logging.info(f"Could not discover {table}, keeping {found[t]}: {e!r}")
+                continue
+            logging.info(f"Discovered {found[t]} {table} (was {n})")
+    return found
+
+class PageStore: 
+    """On-disk store of raw page html. Bodies are gzipped and saved once per sha1 of their 
+    content under objects/, and an sqlite index maps each (table, id) to its current hash"""
+    
+    def __init__(self, path='pages'): 
+        self.path = path
+        os.makedirs(os.path.join(path, 'objects'), exist_ok=True)
+        # fetch threads write to the store concurrently, so share one connection behind a lock
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(path, 'index.sqlite'), check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS pages (tbl TEXT, id INTEGER, sha1 TEXT, fetched REAL, PRIMARY KEY (tbl, id))')
+        # what the server last said about each url, for conditional requests
+        self.db.execute('CREATE TABLE IF NOT EXISTS manifest (tbl TEXT, id INTEGER, etag TEXT, last_modified TEXT, sha1 TEXT, status INTEGER, checked REAL, PRIMARY KEY (tbl, id))')
+        # pages that are permanently missing and shouldn't be requested again
+        self.db.execute('CREATE TABLE IF NOT EXISTS skip (tbl TEXT, id INTEGER, status INTEGER, since REAL, PRIMARY KEY (tbl, id))')
+        self.db.commit()
+    
+    def object_path(self, sha1): 
+        return os.path.join(self.path, 'objects', sha1[:2], sha1 + '.gz')
+    
+    def put(self, table, id_num, body): 
+        """This function saves the html of one page and points (table, id) at it"""
+        
+        sha1 = hashlib.sha1(body).hexdigest()
+        path = self.object_path(sha1)
+        # identical bodies are only written once
+        if not os.path.exists(path): 
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # write to a temporary name first so a crash never leaves half an object
+            tmp = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp, 'wb') as f: 
+                f.write(gzip.compress(body, compresslevel=6))
+            os.replace(tmp, path)
+        with self.lock: 
+            self.db.execute('INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?)', (table, id_num, sha1, time.time()))
+            self.db.commit()
+        return sha1
+    
+    def sha1(self, table, id_num): 
+        with self.lock: 
+            row = self.db.execute('SELECT sha1 FROM pages WHERE tbl = ? AND id = ?', (table, id_num)).fetchone()
+        return row[0] if row else None
+    
+    def get(self, table, id_num): 
+        """This function returns the html of one page or None if it isn't stored"""
+        
+        sha1 = self.sha1(table, id_num)
+        if sha1 is None: 
+            return None
+        with open(self.object_path(sha1), 'rb') as f: 
+            return gzip.decompress(f.read())
+    
+    def remove(self, table, id_num): 
+        """This function forgets the page at (table, id), e.g. once the site says it's gone. Its object 
+        stays, other pages may have the same html"""
+        
+        with self.lock: 
+            self.db.execute('DELETE FROM pages WHERE tbl = ? AND id = ?', (table, id_num))
+            self.db.commit()
+    
+    def ids(self, table): 
+        with self.lock: 
+            return [i for (i,) in self.db.execute('SELECT id FROM pages WHERE tbl = ? ORDER BY id', (table,))]
+    
+    def count(self, table=None): 
+        with self.lock: 
+            if table is None: 
+                return self.db.execute('SELECT COUNT(*) FROM pages').fetchone()[0]
+            return self.db.execute('SELECT COUNT(*) FROM pages WHERE tbl = ?', (table,)).fetchone()[0]
+    
+    def iter_pages(self, table): 
+        """This function yields (id, html) for every stored page of table, reading one page at a time"""
+        
+        for id_num in self.ids(table): 
+            yield id_num, self.get(table, id_num)
+    
+    def manifest(self, table, id_num): 
+        """This function returns the last recorded etag, last_modified, sha1 and status of a url or None"""
+        
+        with self.lock: 
+            row = self.db.execute('SELECT etag, last_modified, sha1, status FROM manifest WHERE tbl = ? AND id = ?', (table, id_num)).fetchone()
+        return dict(zip(('etag', 'last_modified', 'sha1', 'status'), row)) if row else None
+    
+    def record(self, table, id_num, status, etag=None, last_modified=None, sha1=None): 
+        """This function records the server's latest answer for a url in the manifest"""
+        
+        with self.lock: 
+            self.db.execute('INSERT OR REPLACE INTO manifest VALUES (?, ?, ?, ?, ?, ?, ?)', (table, id_num, etag, last_modified, sha1, status, time.time()))
+            self.db.commit()
+    
+    def manifest_keys(self, status=200): 
+        """This function lists the (table, id) pairs whose last recorded status was status"""
+        
+        with self.lock: 
+            return [(t, i) for t, i in self.db.execute('SELECT tbl, id FROM manifest WHERE status = ? ORDER BY tbl, id', (status,))]
+    
+    def skip(self, table, id_num, status=404): 
+        """This function adds a permanently missing page to the skip list"""
+        
+        with self.lock: 
+            self.db.execute('INSERT OR REPLACE INTO skip VALUES (?, ?, ?, ?)', (table, id_num, status, time.time()))
+            self.db.commit()
+    
+    def unskip(self, table=None, id_num=None): 
+        """This function takes one page, one table, or everything off the skip list"""
+        
+        with self.lock: 
+            if table is None: 
+                self.db.execute('DELETE FROM skip')
+            elif id_num is None: 
+                self.db.execute('DELETE FROM skip WHERE tbl = ?', (table,))
+            else: 
+                self.db.execute('DELETE FROM skip WHERE tbl = ? AND id = ?', (table, id_num))
+            self.db.commit()
+    
+    def skipped(self): 
+        """This function returns the set of (table, id) pairs on the skip list"""
+        
+        with self.lock: 
+            return {(t, i) for t, i in self.db.execute('SELECT tbl, id FROM skip')}
+    
+    def __contains__(self, key): 
+        return self.sha1(*key) is not None
+    
+    def __len__(self): 
+        return self.count()
+
+class CrawlJournal: 
+    """Durable record of a crawl, kept in the PageStore's sqlite index next to the pages. A run lists 
+    every (table, id) it plans to fetch, each marked 'todo', 'in_flight', 'done' or 'failed' as it goes, 
+    and is closed by finish(). A run that never finished is picked up again by the next start(), 
+    which hands back only the pages not yet done, those left in flight by the crash included"""
+    
+    def __init__(self, store): 
+        self.store = store
+        self.db = store.db
+        self.lock = store.lock
+        self.run = None
+        with self.lock: 
+            self.db.execute('CREATE TABLE IF NOT EXISTS runs (run INTEGER PRIMARY KEY, started REAL, finished REAL)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS journal (run INTEGER, tbl TEXT, id INTEGER, state TEXT, status TEXT, attempts INTEGER, updated REAL, PRIMARY KEY (run, tbl, id))')
+            self.db.commit()
+    
+    def unfinished(self): 
+        """This function returns the id of the latest run that didn't finish, or None"""
+        
+        with self.lock: 
+            row = self.db.execute('SELECT run FROM runs WHERE finished IS NULL ORDER BY run DESC LIMIT 1').fetchone()
+        return row[0] if row else None
+    
+    def start(self, plan, resume=True): 
+        """This function resumes the unfinished run if there is one, or starts a new run of plan, and 
+        returns the (table, id) pairs of plan still to fetch. Pages added to plan since are added to the run. 
+        With resume False it always starts a new run, leaving an unfinished one for the next crawl"""
+        
+        self.run = self.unfinished() if resume else None
+        with self.lock: 
+            if self.run is None: 
+                self.run = self.db.execute('INSERT INTO runs (started) VALUES (?)', (time.time(),)).lastrowid
+                logging.info(f"Starting crawl run {self.run} of {len(plan)} pages")
+            else: 
+                logging.info(f"Resuming crawl run {self.run}")
+            self.db.executemany('INSERT OR IGNORE INTO journal VALUES (?, ?, ?, ?, NULL, 0, ?)', 
+                                ((self.run, t, i, 'todo', time.time()) for t, i in plan))
+            self.db.commit()
+            done = {(t, i) for t, i in self.db.execute('SELECT tbl, id FROM journal WHERE run = ? AND state = ?', (self.run, 'done'))}
+        pending = [(t, i) for t, i in plan if (t, i) not in done]
+        logging.info(f"Run {self.run}: {len(done)} pages done, {len(pending)} to fetch")
+        return pending
+    
+    def mark(self, table, id_num, state, status=None): 
+        """This function records the state of one page in the current run, committed straight away"""
+        
+        if self.run is None: 
+            raise ValueError("No crawl run to journal in, start() one first")
+        with self.lock: 
+            self.db.execute('INSERT OR IGNORE INTO journal VALUES (?, ?, ?, ?, NULL, 0, ?)', (self.run, table, id_num, 'todo', time.time()))
+            self.db.execute('UPDATE journal SET state = ?, status = COALESCE(?, status), attempts = attempts + ?, updated = ? WHERE run = ? AND tbl = ? AND id = ?', 
+                            (state, None if status is None else str(status), state == 'in_flight', time.time(), self.run, table, id_num))
+            self.db.commit()
+    
+    def begin(self, table, id_num): 
+        self.mark(table, id_num, 'in_flight')
+    
+    def done(self, table, id_num, status=200): 
+        """This function marks a page done: fetched, or answered with a status not worth asking again"""
+        
+        self.mark(table, id_num, 'done', status)
+    
+    def failed(self, table, id_num, status): 
+        """This function marks a page failed, status being the HTTP status or the exception, so a resumed run retries it"""
+        
+        self.mark(table, id_num, 'failed', status)
+    
+    def state(self, table, id_num): 
+        """This function returns the state and status of a page in the latest run that has it, or None"""
+        
+        with self.lock: 
+            row = self.db.execute('SELECT state, status FROM journal WHERE tbl = ? AND id = ? ORDER BY run DESC LIMIT 1', (table, id_num)).fetchone()
+        return dict(zip(('state', 'status'), row)) if row else None
+    
+    def counts(self, run=None): 
+        """This function counts the pages of a run, the current one by default, in each state"""
+        
+        with self.lock: 
+            return dict(self.db.execute('SELECT state, COUNT(*) FROM journal WHERE run = ? GROUP BY state', (run or self.run,)).fetchall())
+    
+    def finish(self): 
+        """This function closes the current run, so the next start() begins a new one. Marking pages 
+        takes a start() again after this"""
+        
+        with self.lock: 
+            self.db.execute('UPDATE runs SET finished = ? WHERE run = ?', (time.time(), self.run))
+            self.db.commit()
+        logging.info(f"Finished crawl run {self.run}: {self.counts()}")
+        self.run = None
+
+def import_soup_pickles(store, names=('Asoup', 'Wsoup', 'soups')): 
+    """This function copies the pickled soup dumps made by earlier runs into a PageStore. 
+    Asoup/Wsoup are keyed by id, soups by 'a1'/'w1' style keys"""
+    
+    imported = 0
+    for name in names: 
+        if not os.path.exists(name + '.pkl'): 
+            continue
+        with open(name + '.pkl', 'rb') as f: 
+            soups = pickle.load(f)
+        for k, s in soups.items(): 
+            if name == 'Asoup': 
+                table, id_num = 'agents', int(k)
+            elif name == 'Wsoup': 
+                table, id_num = 'works', int(k)
+            elif str(k)[:1] in ('a', 'w') and str(k)[1:].isdigit(): 
+                table, id_num = {'a': 'agents', 'w': 'works'}[k[0]], int(k[1:])
+            else: 
+                # bare ids in soups.pkl don't say which table they came from
+                logging.info(f"Skipping {name}[{k!r}], its table is unknown")
+                continue
+            store.put(table, id_num, str(s).encode('utf-8'))
+            imported += 1
+    logging.info(f"Imported {imported} pages into {store.path}")
+    return imported
+
+# upper bounds in sec of the latency histogram buckets, the Prometheus client defaults
+latency_buckets = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, float('inf'))
+
+def label_text(labels): 
+    return ','.join(f'{k}="{v}"' for k, v in labels)
+
+class Metrics: 
+    """Counters, latency histograms and a record per page for one run, dumped at the end as 
+    JSON and as Prometheus text. Safe to share between fetch threads"""
+    
+    def __init__(self, prefix='maprr'): 
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        # {name: {labels: value}}, labels being sorted (key, value) tuples
+        self.counters = {}
+        # {name: {labels: [bucket counts, sum, count]}}
+        self.histograms = {}
+        # (table, id, status, bytes, fetch sec, parse sec) of every page seen
+        self.pages = {}
+        self.started = time.time()
+    
+    def count(self, name, value=1, **labels): 
+        """This function adds value to a counter"""
+        
+        key = tuple(sorted(labels.items()))
+        with self.lock: 
+            counter = self.counters.setdefault(name, {})
+            counter[key] = counter.get(key, 0) + value
+    
+    def observe(self, name, seconds, **labels): 
+        """This function records one duration in a histogram"""
+        
+        key = tuple(sorted(labels.items()))
+        with self.lock: 
+            hist = self.histograms.setdefault(name, {}).setdefault(key, [[0]*len(latency_buckets), 0.0, 0])
+            for i, bound in enumerate(latency_buckets): 
+                if seconds <= bound: 
+                    hist[0][i] += 1
+            hist[1] += seconds
+            hist[2] += 1
+    
+    @contextlib.contextmanager
+    def timer(self, stage, **labels): 
+        """This function times the block it wraps as a stage of the run, e.g. with metrics.timer('parse'): ..."""
+        
+        t1 = time.perf_counter()
+        try: 
+            yield
+        finally: 
+            seconds = time.perf_counter() - t1
+            self.observe('stage_seconds', seconds, stage=stage, **labels)
+            logging.info(f"{stage} {labels or ''} took {round(seconds, 3)} sec")
+    
+    def timed(self, stage): 
+        """This function makes a decorator that times every call of a function as stage"""
+        
+        def decorator(func): 
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs): 
+                with self.timer(stage): 
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+    
+    def fetched(self, table, id_num, status, seconds, size=0): 
+        """This function records one response: its latency, status and size"""
+        
+        self.observe('fetch_seconds', seconds, table=table)
+        self.count('responses_total', table=table, status=status)
+        self.count('bytes_total', size, table=table)
+        with self.lock: 
+            page = self.pages.setdefault((table, id_num), {'status': None, 'bytes': 0, 'fetch_seconds': 0.0, 'parse_seconds': None, 'attempts': 0})
+            page.update(status=status, bytes=size)
+            page['fetch_seconds'] += seconds
+            page['attempts'] += 1
+    
+    def parsed(self, table, id_num, seconds, ok=True): 
+        """This function records how long one page took to parse, and whether it could be"""
+        
+        self.observe('parse_seconds', seconds, table=table)
+        if not ok: 
+            self.count('parse_errors_total', table=table)
+        with self.lock: 
+            page = self.pages.setdefault((table, id_num), {'status': None, 'bytes': 0, 'fetch_seconds': 0.0, 'parse_seconds': None, 'attempts': 0})
+            page['parse_seconds'] = seconds
+    
+    def slowest(self, n=10, key='fetch_seconds'): 
+        """This function returns the n pages that took longest to fetch (or parse, with key='parse_seconds')"""
+        
+        with self.lock: 
+            pages = [dict(table=t, id=i, **page) for (t, i), page in self.pages.items() if page[key] is not None]
+        return sorted(pages, key=lambda page: page[key], reverse=True)[:n]
+    
+    def to_dict(self): 
+        """This function returns every metric as plain JSON-ready data"""
+        
+        with self.lock: 
+            return {
+                'started': self.started, 
+                'elapsed': time.time() - self.started, 
+                'counters': {name: [dict(labels=dict(k), value=v) for k, v in values.items()] for name, values in self.counters.items()}, 
+                'histograms': {name: [dict(labels=dict(k), buckets=dict(zip(map(str, latency_buckets), h[0])), sum=h[1], count=h[2]) 
+                                      for k, h in values.items()] for name, values in self.histograms.items()}, 
+                'pages': [dict(table=t, id=i, **page) for (t, i), page in sorted(self.pages.items())]}
+    
+    def prometheus(self): 
+        """This function renders the counters and histograms in the Prometheus text exposition format"""
+        
+        lines = []
+        with self.lock: 
+            for name, values in sorted(self.counters.items()): 
+                lines.append(f"# TYPE {self.prefix}_{name} counter")
+                lines += [f"{self.prefix}_{name}{{{label_text(k)}}} {v}" for k, v in sorted(values.items())]
+            for name, values in sorted(self.histograms.items()): 
+                lines.append(f"# TYPE {self.prefix}_{name} histogram")
+                for k, (buckets, total, n) in sorted(values.items()): 
+                    for bound, count in zip(latency_buckets, buckets): 
+                        le = '+Inf' if bound == float('inf') else bound
+                        lines.append(f"{self.prefix}_{name}_bucket{{{label_text(k + (('le', le),))}}} {count}")
+                    lines.append(f"{self.prefix}_{name}_sum{{{label_text(k)}}} {total}")
+                    lines.append(f"{self.prefix}_{name}_count{{{label_text(k)}}} {n}")
+        return '\n'.join(lines) + '\n'
+    
+    def dump(self, path='maprr_metrics'): 
+        """This function writes the metrics to path.json and path.prom"""
+        
+        for ext, content in (('.json', json.dumps(self.to_dict(), indent=1, default=str)), ('.prom', self.prometheus())): 
+            with open(path + ext + '.tmp', 'w') as f: 
+                f.write(content)
+            os.replace(path + ext + '.tmp', path + ext)
+        slow = self.slowest(3)
+        logging.info(f"Metrics written to {path}.json and {path}.prom, slowest pages {[(p['table'], p['id'], round(p['fetch_seconds'], 3)) for p in slow]}")
 
-urls_to_visit = [] 
-for t, i in list(tables.items())[:2]: 
-    for j in range(0,i+1): 
-        urls_to_visit.append(domain+t+str(j))
+def bio_dates(bio): 
+    """This function splits an agent's bio line, such as '1878 - 1936?', into birth and death. A bio 
+    with one date has it as the birth and None for the death"""
+    
+    bdate, sep, ddate = bio.partition(' - ')
+    return bdate, ddate if sep else None
 
 class maprr: 
+    """Crawls the agents and works one page at a time, ids 1 up to the counts in the module's tables, 
+    which it keeps as they are. See discover_tables for finding the real counts first"""
     
-    def __init__(self): 
-        self.Wsoup = {} 
-        self.Asoup = {}
+    def __init__(self, store=None, metrics=None, timeout=request_timeout): 
+        log_to_file()
+        self._store = store
+        self._journal = None
+        # seconds before a request is given up on, as (connect, read)
+        self.timeout = timeout
+        # per page and per stage timings, written out at the end of run
+        self.metrics = metrics or Metrics()
         self.Ws = {}
         self.As = {}
     
-    def get_htmlA(self): 
-        """This function uses the list of Agent IDs from the tables dict above
-        and the grabs it using requests before putting the html reponse in Asoup"""
+    @property
+    def store(self): 
+        """Raw html of every fetched page, parsed lazily from disk. Opened on first use so 
+        instances that only parse never touch the disk"""
         
-        # initialize list of pages that don't return 200
-        aberrantAs = []
-        # go through list of Agents from 1 to the number defined in tables
-        for i in range(1, (list(tables.values())[0]+1)):
-        #for i in range(1, 11):
-            # make url
-            url = domain+list(tables.keys())[0]+str(i) 
-            # initialize connection to url 
-            with requests.get(url, verify=False) as r: 
+        if self._store is None: 
+            self._store = PageStore()
+        return self._store
+    
+    @property
+    def journal(self): 
+        """CrawlJournal in the page store, so a run that stopped part way resumes where it was""" 
+        
+        if self._journal is None: 
+            self._journal = CrawlJournal(self.store)
+        return self._journal
+    
+    def get_page(self, table, id_num): 
+        """This function fetches one page with a timeout, puts it in the page store and notes it in the 
+        journal. It returns the status code, or the exception's name if the request failed""" 
+        
+        url = domain+table+'/'+str(id_num)
+        self.journal.begin(table, id_num)
+        sent = time.perf_counter()
+        try: 
+            with requests.get(url, verify=False, timeout=self.timeout) as r: 
+                # record latency, size and status of the page
+                self.metrics.fetched(table, id_num, r.status_code, time.perf_counter() - sent, len(r.content))
                 # log status code 
-                logging.info(f"A{i} status code: {r.status_code}")
+                logging.info(f"{table}/{id_num} status code: {r.status_code}")
                 # if connection is successful
                 if r.status_code == 200: 
-                    # make soup from html
-                    s = BeautifulSoup(r.content, 'html.parser') 
-                    # add to list of A soups
-                    self.Asoup.update({i:s})
+                    # add html to the page store
+                    self.store.put(table, id_num, r.content)
+                    self.journal.done(table, id_num)
+                elif r.status_code in (404, 410): 
+                    # not there, so forget any copy an earlier crawl stored and don't ask again
+                    self.store.remove(table, id_num)
+                    self.store.skip(table, id_num, r.status_code)
+                    self.journal.done(table, id_num, r.status_code)
                 else: 
-                    # if connection is not successful, add to list
-                    aberrantAs.append((i, r.status_code))
-                    pass
-                # wait a hot second or the server gets >:( 
-                time.sleep(.1)
+                    self.journal.failed(table, id_num, r.status_code)
+                return r.status_code
+        except requests.RequestException as e: 
+            # timeouts and dropped connections cost this page, not the crawl
+            logging.info(f"{table}/{id_num} failed: {e!r}")
+            self.metrics.fetched(table, id_num, type(e).__name__, time.perf_counter() - sent)
+            self.journal.failed(table, id_num, type(e).__name__)
+            return type(e).__name__
+    
+    def get_htmlA(self): 
+        """This function uses the list of Agent IDs from the tables dict above
+        and the grabs it using requests before putting the html reponse in the page store"""
+        
+        # initialize list of pages that don't return 200
+        aberrantAs = []
+        # go through list of Agents from 1 to the number defined in tables, skipping the ones 
+        # a run that stopped part way already got
+        # and the ones an earlier crawl found gone
+        skipped = self.store.skipped()
+        for _, i in self.journal.start([('agents', i) for i in range(1, (list(tables.values())[0]+1)) if ('agents', i) not in skipped]): 
+            status = self.get_page('agents', i)
+            if status != 200: 
+                # if connection is not successful, add to list
+                aberrantAs.append((i, status))
+            # wait a hot second or the server gets >:( 
+            time.sleep(.1)
         # report list of A errors if there is one (there always is)
         if len(aberrantAs) > 0: 
             print(f"Aberrant agent pages are #s {aberrantAs}")
@@ -86,31 +649,21 @@ class maprr:
 
     def get_htmlW(self): 
         """This function uses the list of Work IDs from the tables dict above
-        and the grabs it using requests before putting the html reponse in Wsoup"""
+        and the grabs it using requests before putting the html reponse in the page store"""
         
         # initialize list of pages that don't return 200
         aberrantWs = []
-        # go through list of Words from 1 to the number defined in tables
-        for i in range(1, (list(tables.values())[1]+1)):
-        #for i in range(1, 11):
-            # make url
-            url = domain+list(tables.keys())[1]+str(i)
-            # initialize connection to url 
-            with requests.get(url, verify=False) as r: 
-                # log status code
-                logging.info(f"W{i} status code: {r.status_code}")
-                # if connection is successful
-                if r.status_code == 200: 
-                    # make soup from html
-                    s = BeautifulSoup(r.content, 'html.parser')
-                    # add to list of A soups
-                    self.Wsoup.update({i:s})
-                else: 
-                    # if connection is not successful, add to list
-                    aberrantWs.append((i, r.status_code))
-                    pass
-                # wait a hot second or the server gets >:( 
-                time.sleep(.1)
+        # go through list of Words from 1 to the number defined in tables, skipping the ones 
+        # a run that stopped part way already got
+        # and the ones an earlier crawl found gone
+        skipped = self.store.skipped()
+        for _, i in self.journal.start([('works', i) for i in range(1, (list(tables.values())[1]+1)) if ('works', i) not in skipped]): 
+            status = self.get_page('works', i)
+            if status != 200: 
+                # if connection is not successful, add to list
+                aberrantWs.append((i, status))
+            # wait a hot second or the server gets >:( 
+            time.sleep(.1)
         # report list of A errors if there is one (there always is)
         if len(aberrantWs) > 0: 
             print(f"Aberrant work pages are #s {aberrantWs}")
@@ -162,10 +715,14 @@ class maprr:
     def parseAs(self, html): 
         """This function retrieves Agent info from the HTML provided"""
         
+        card = html.find('div', {'class': 'card scrollable'})
+        # the site's current layout has no card, the agent is in a wrapper div with a typology table
+        if card is None: 
+            return self.parseAsTypology(html)
         # get Agent's name
-        name = html.find('div', {'class': 'card scrollable'}).h2.text 
+        name = card.h2.text 
         # get Agent's birth- and deathdates 
-        bdate, ddate = html.find('div', {'class': 'card scrollable'}).span.text.split(' - ') 
+        bdate, ddate = bio_dates(card.span.text)
         # initialize dictionary of Agent
         Adict = {'name': name, 'birth': bdate, 'death': ddate}
         # make list of type keys
@@ -187,122 +744,126 @@ class maprr:
         # return Agent dict to be made into a DataFrame row 
         return Adict
     
-    def get_single(self, cat, id_num): 
-        """This function combines the functions above and returns the DataFrame row""" 
+    def parseAsTypology(self, html): 
+        """This function retrieves Agent info from the HTML provided in the site's current layout"""
+        
+        wrapper = html.find('div', {'class': 'wrapper'})
+        # get Agent's name
+        name = wrapper.h3.text
+        # get Agent's birth- and deathdates 
+        bdate, ddate = bio_dates(wrapper.find('span', {'class': 'bio'}).text)
+        Adict = {'name': name, 'birth': bdate, 'death': ddate}
+        # type keys and values are the header and data cells of each row of the typology table
+        rows = html.find('table', {'id': 'typology'}).find_all('tr')
+        typeKeys = [x.th.text.lower().replace(' ','_') for x in rows]
+        typeVals = [x.td.text for x in rows]
+        Adict.update(dict(zip(typeKeys, typeVals)))
+        return Adict
+    
+    def get_single(self, cat, id_num, refresh=False): 
+        """This function combines the functions above and returns the DataFrame row. The page comes from 
+        the page store when a crawl already got it, and is fetched (and stored, and journaled) otherwise 
+        or when refresh is True""" 
         
-        # make url from parameters and initialize request 
-        with requests.get(domain+cat+'s/'+str(id_num), verify=False) as r: 
-            # double check the URL is correct
-            print(r.url)
+        # sort by FOO type 
+        parse = {'work': self.parseWs, 'agent': self.parseAs}.get(cat.lower())
+        if parse is None: 
+            print("You need a category: 'work' or 'agent'...") 
+            return None
+        table = cat.lower()+'s'
+        body = None if refresh else self.store.get(table, id_num)
+        if body is None: 
+            # outside a crawl the page gets a run of its own, a crawl that stopped part way is left to resume
+            own_run = self.journal.run is None
+            if own_run: 
+                self.journal.start([(table, id_num)], resume=False)
+            status = self.get_page(table, id_num)
+            if own_run: 
+                self.journal.finish()
             # check status code
-            print(f"{cat+str(id_num)} status code: {r.status_code}")
-            # if connection is successful
-            if r.status_code == 200: 
-                # make soup from html content 
-                s = BeautifulSoup(r.content, 'html.parser')
-                # sort by FOO type 
-                if cat.lower() == 'work': 
-                    # make dictionary if Work with parseWs function
-                    SubDict = {id_num:self.parseWs(s)}
-                elif cat.lower() == 'agent': 
-                    # make dictionary if Agent with parseAs function
-                    SubDict = {id_num:self.parseAs(s)} 
-                else: 
-                    print("You need a category: 'work' or 'agent'...") 
-                # make DataFrame row from dictionary
-                singleDf = pd.DataFrame.from_dict(newSubDict, orient='index')
-                # return DataFrame row
-                return singleDf
+            print(f"{cat+str(id_num)} status code: {status}")
             # return status code if connection is unsuccessful
-            else: 
-                print(f"Error: {r.status_code}") 
-                
-        def save_obj(obj, name):
-            with open(name + '.pkl', 'wb+') as f:
-                pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
-
-        def load_obj(name):
-            with open(name + '.pkl', 'rb') as f:
-                return pickle.load(f)
-
-
+            if status != 200: 
+                print(f"Error: {status}") 
+                return status
+            body = self.store.get(table, id_num)
+        # make soup from html content and a DataFrame row from the parsed dictionary
+        return pd.DataFrame.from_dict({id_num: parse(BeautifulSoup(body, 'html.parser'))}, orient='index')
+    
+    def parse_stored(self, table, parse): 
+        """This function parses the stored pages of table with parse (parseAs or parseWs), timing each page. 
+        Only ids this crawl asked for count, up to the table's number in the tables dict, so pages stored by 
+        an earlier crawl of more pages, or since gone, are left out"""
+        
+        parsed = {}
+        skipped = self.store.skipped()
+        for k in range(1, tables[table+'/']+1): 
+            v = self.store.get(table, k) if (table, k) not in skipped else None
+            if v is None: 
+                continue
+            t1 = time.perf_counter()
+            try: 
+                parsed[k] = parse(BeautifulSoup(v, 'html.parser'))
+                self.metrics.parsed(table, k, time.perf_counter() - t1)
+            except Exception as e: 
+                # whatever goes wrong with one page costs that page, not the crawl
+                logging.info(f"{table}/{k} could not be parsed: {e!r}")
+                self.metrics.parsed(table, k, time.perf_counter() - t1, ok=False)
+        return parsed
+    
     def run(self): 
-        """This function runs retrieval and parsing using the functions above, creates DataFrames, and persists them (JSON)"""
+        """This function runs retrieval and parsing using the functions above, creates DataFrames, and persists them 
+        (typed Parquet, see write_frames). Stage and page timings end up in maprr_metrics.json and maprr_metrics.prom"""
         
         logging.info(f"Getting As and Ws")
         print(f"Getting As")
-        # get starting time for A retrieval
-        at1 = time.time()
         # retrieve As
-        self.get_htmlA() 
-        # get finishing time for A retrieval
-        at2 = time.time()
-        # display run times for A retrieval 
-        logging.info(f"Got As in {round((at2-at1), 3)} sec ({round(((at2-at1)/list(tables.values())[0]), 5)} sec/ea.)")
+        with self.metrics.timer('fetch', table='agents'): 
+            self.get_htmlA() 
         
         print(f"Getting Ws")
-        # get starting time for W retrieval
-        wt1 = time.time()
-        # retrieve As
-        self.get_htmlW() 
-        # get finishing time for W retrieval
-        wt2 = time.time()
-        # display run times for W retrieval 
-        print(f"Got Ws in {round((wt2-wt1), 3)} sec ({round(((wt2-wt1)/list(tables.values())[1]), 5)} sec/ea.)")
-        logging.info(f"Got Ws in {round((wt2-wt1), 3)} sec ({round(((wt2-wt1)/list(tables.values())[1]), 5)} sec/ea.)")
-        
+        # retrieve Ws
+        with self.metrics.timer('fetch', table='works'): 
+            self.get_htmlW() 
+        # both tables are in, the next run starts afresh
+        self.journal.finish()
         logging.info(f"Done getting As and Ws")
         
-        self.save_obj(self.Asoup, 'Asoup')
-        self.save_obj(self.Wsoup, 'Wsoup')
-        
         logging.info(f"Parsing As and Ws")
-        
-        logging.info(f"Parsing As")
         print(f"Parsing As")
-        # get starting time for A parsing
-        pa1 = time.time()
         # parse Agent HTML instances
-        #self.As = {k: self.parseAs(v) for k, v in self.Asoup.items()}
-        # get finishing time for A parsing
-        pa2 = time.time()
-        # display run times for A parsing 
-        logging.info(f"Parsed As in {round((pa2-pa1), 3)} sec ({round((pa2-pa1)/len(list(self.Asoup.items())), 5)} sec/ea.)")
+        with self.metrics.timer('parse', table='agents'): 
+            self.As = self.parse_stored('agents', self.parseAs)
         
         print(f"Parsing Ws")
-        # get starting time for W parsing
-        pw1 = time.time()
         # parse Work HTML instances 
-        #self.Ws = {k: self.parseWs(v) for k, v in self.Wsoup.items()}
-        # get finishing time for W parsing
-        pw2 = time.time() 
-        # display run times for W parsing 
-        print(f"Parsed Ws in {round((pw2-pw1), 3)} sec ({round((pw2-pw1)/len(list(self.Wsoup.items())), 5)} sec/ea.)")
-        logging.info(f"Parsed Ws in {round((pw2-pw1), 3)} sec ({round((pw2-pw1)/len(list(self.Wsoup.items())), 5)} sec/ea.)")
+        with self.metrics.timer('parse', table='works'): 
+            self.Ws = self.parse_stored('works', self.parseWs)
         logging.info(f"Done parsing As and Ws")
         
         logging.info(f"Making dataframes")
-        print(f"Making AsDf")
-        # create DataFrame of Agent dictionaries
-        #AsDf = pd.DataFrame.from_dict(self.As, orient='index')
-        print(f"Making WsDf")
-        # create DataFrame of Work dictionaries
-        #WsDf = pd.DataFrame.from_dict(self.Ws, orient='index')  
+        with self.metrics.timer('build'): 
+            print(f"Making AsDf")
+            # create DataFrame of Agent dictionaries
+            AsDf = pd.DataFrame.from_dict(self.As, orient='index')
+            print(f"Making WsDf")
+            # create DataFrame of Work dictionaries
+            WsDf = pd.DataFrame.from_dict(self.Ws, orient='index')  
         logging.info(f"Done making dataframes")
         
-        logging.info(f"Writing to json")
-        # write Work DataFrame to JSON
-        #WsDf.to_json('WsDf.json')
-        # write Agent DataFrame to JSON
-        #AsDf.to_json('AsDf.json')
-        logging.info(f"Done writing to json")
+        logging.info(f"Writing to parquet")
+        with self.metrics.timer('write'): 
+            # write Work and Agent DataFrames to Parquet
+            write_frames(WsDf, AsDf)
+        logging.info(f"Done writing to parquet")
+        self.metrics.dump()
 
 def check_status(urls): 
     aberrantURLs = []
     logging.info(f"Checking status of URLs")
     for url in urls: 
         logging.info(f"Trying {url}")
-        with requests.get(url, verify=False) as r: 
+        with requests.get(url, verify=False, timeout=request_timeout) as r: 
             if r.status_code == 200: 
                 #logging.info(f"{url} successful")
                 pass
@@ -313,6 +874,7 @@ def check_status(urls):
 class MAPRR: 
     
     def __init__(self): 
+        log_to_file()
         self.urls_to_visit = []
         self.aberrantAs = []
         self.aberrantWs = []
@@ -323,14 +885,15 @@ class MAPRR:
         self.As = {}
     
     def get_html(self, url): 
-        url_format = 'https://mpgrr.herokuapp.com/(\w+)/(\d{1,3})'
+        # any host, so the crawl can be pointed somewhere other than the old heroku app
+        url_format = r'https?://[^/]+/(\w+)/(\d+)'
         url_match = re.match(url_format, url)
         fco_type = url_match.group(1)
         id_num = url_match.group(2)
         headers = {
         'User-Agent': 'Mozilla/5.0 (Windows NT 6.1) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/41.0.2228.0 Safari/537.36',
     }
-        with requests.get(url, headers=headers) as r: 
+        with requests.get(url, headers=headers, timeout=request_timeout) as r: 
             logging.info(f"{fco_type}/{id_num} status code: {r.status_code}")
             if r.status_code == 200: 
                 s = BeautifulSoup(r.content, 'html.parser')
@@ -419,125 +982,2277 @@ class MAPRR:
         AsDf.to_json('AsDf.json')
         logging.info(f"Done writing to json")
         
+def has_class(name): 
+    """XPath test for an element whose class list includes name, as bs4 matches a single class"""
+    
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')"
+
+# compiled XPaths of the table specs, each compiled once per process the first time it's used
+selectors = {}
+
+@functools.lru_cache(maxsize=None)
+def html_parser(): 
+    return etree.HTMLParser(encoding='utf-8')
+
+def select(expr, node, **variables): 
+    """This function evaluates an XPath expression on node, compiling it the first time"""
+    
+    if expr not in selectors: 
+        selectors[expr] = etree.XPath(expr)
+    return selectors[expr](node, **variables)
+
+def text(node): 
+    """This function returns all the text under node like bs4's .text, raising AttributeError if node is None"""
+    
+    if node is None: 
+        raise AttributeError("'NoneType' object has no attribute 'text'")
+    return str(node.xpath('string()'))
+
+def first_text(exprs, find, default=None): 
+    """This function returns the text of the first match of the first expression in exprs (one XPath or a 
+    list of fallbacks) that matches anything, or default. Without a default the field is required. 
+    find evaluates an expression on the node being read"""
+    
+    for expr in [exprs] if isinstance(exprs, str) else exprs: 
+        found = find(expr)
+        if isinstance(found, str): 
+            return str(found)
+        if found: 
+            return text(found[0])
+    if default is None: 
+        raise AttributeError(f"Nothing matches {exprs}")
+    return default
+
+# how a label found on a page becomes a field name: 'label' drops the trailing colon of a work
+# card heading as parseWs does, 'snake' lowercases and underscores as parseAs does
+key_styles = {
+    'label': lambda k: k[:-1], 
+    'snake': lambda k: k.lower().replace(' ','_'), 
+}
+
+# how one text found on a page becomes several fields, 'bio' being an agent's birth and death
+value_splits = {
+    'bio': bio_dates, 
+}
+
+def read_field(find, field, row): 
+    """This function reads one field of a table spec into row. The reader names how: 'text' the first 
+    match, 'longest' the texts of whichever XPath matches most (the first on a tie), 'which' the label 
+    of that XPath, 'zip' labels and values matched separately and paired in order, 'rows' a label and 
+    a value from each matched row, 'split' the first match cut into several fields by one of value_splits"""
+    
+    name, reader, *args = field
+    if reader == 'text': 
+        row[name] = first_text(args[0], find, *args[1:])
+    elif reader in ('longest', 'which'): 
+        exprs, labels = args[0], args[1] if len(args) > 1 else None
+        found = [find(expr) for expr in exprs]
+        i = max(range(len(found)), key=lambda j: (len(found[j]), -j))
+        row[name] = labels[i] if reader == 'which' else [text(x).replace('\n','').strip() for x in found[i]]
+    elif reader == 'zip': 
+        keys, values, style = args
+        row.update(zip((key_styles[style](text(x)) for x in find(keys)), (text(x) for x in find(values))))
+    elif reader == 'rows': 
+        rows, key, values, style = args[:4]
+        default = args[4] if len(args) > 4 else None
+        for x in find(rows): 
+            at = lambda expr: select(expr, x)
+            row[key_styles[style](first_text(key, at))] = first_text(values, at, default)
+    elif reader == 'split': 
+        exprs, how, names = args
+        row.update(zip(names, value_splits[how](first_text(exprs, find))))
+    else: 
+        raise ValueError(f"Unknown field reader {reader}")
+
+wrapper_xpath = f'(//div[{has_class("wrapper")}])[1]'
+paragraph_xpaths = [f'$content//p[{has_class("stanza")}]', f'$content//p[{has_class("text")}]']
+
+# what each table's pages hold: a list of layouts, the first whose anchors are all on the page reads it. 
+# Anchors are found once per page and fields reach them as XPath variables, e.g. $card. Each field is 
+# (name, reader, reader arguments...) as read_field takes them, fields named '*' add every field 
+# they find. Works and agents give exactly the dicts of parseWs and parseAs
+table_specs = {
+    'works': [{
+        'anchors': {
+            'content': '(//div[@class="col-md-9 fixed-height"])[1]', 
+            'card': f'(//div[{has_class("card-body")}])[1]'}, 
+        'fields': [
+            ('title', 'text', '$content/descendant::div[1]/descendant::h4[1]', 'untitled'), 
+            ('genre', 'which', paragraph_xpaths, ['poetry', 'prose']), 
+            ('text', 'longest', paragraph_xpaths), 
+            ('*', 'zip', '$card//h4', '$card//p', 'label'), 
+        ]}], 
+    'agents': [{
+        'anchors': {
+            'card': '(//div[@class="card scrollable"])[1]'}, 
+        'fields': [
+            ('name', 'text', '$card/descendant::h2[1]'), 
+            ('*', 'split', '$card/descendant::span[1]', 'bio', ['birth', 'death']), 
+            ('*', 'rows', f'//div[{has_class("col-md-4")}]', 'descendant::h4[1]', 
+             ['descendant::p[1]', 'descendant::div[1]/descendant::span[1]'], 'snake', 'unknown'), 
+        ]}, {
+        'anchors': {
+            'wrapper': wrapper_xpath}, 
+        'fields': [
+            ('name', 'text', '$wrapper/descendant::h3[1]'), 
+            ('*', 'split', f'$wrapper/descendant::span[{has_class("bio")}][1]', 'bio', ['birth', 'death']), 
+            ('*', 'rows', '(//table[@id="typology"])[1]//tr', 'descendant::th[1]', 'descendant::td[1]', 'snake'), 
+        ]}], 
+}
+# place based concepts, locations and multivalent markers share the site's entity page: a name heading 
+# in the wrapper and label/value tables, the association tables being read as links instead
+for t in ('place_based_concepts', 'locations', 'multivalent_markers'): 
+    table_specs[t] = [{
+        'anchors': {
+            'wrapper': wrapper_xpath}, 
+        'fields': [
+            ('name', 'text', ['$wrapper/descendant::h3[1]', '$wrapper/descendant::h2[1]']), 
+            ('*', 'rows', f'//table[not({has_class("associations")})]//tr[th and td]', 'descendant::th[1]', 'descendant::td[1]', 'snake', ''), 
+        ]}]
+
+def parse_spec(table, root): 
+    """This function reads a page's lxml tree into a dict with the spec of its table"""
+    
+    if table not in table_specs: 
+        raise ValueError(f"There is no parser for {table}")
+    for layout in table_specs[table]: 
+        anchors = {}
+        for name, expr in layout['anchors'].items(): 
+            found = select(expr, root)
+            if not found: 
+                break
+            anchors[name] = found[0]
+        else: 
+            # the paragraph lists are asked for twice, by genre and text
+            seen = {}
+            def find(expr): 
+                if expr not in seen: 
+                    seen[expr] = select(expr, root, **anchors)
+                return seen[expr]
+            row = {}
+            for field in layout['fields']: 
+                read_field(find, field, row)
+            return row
+    raise AttributeError(f"No {table} layout matches this page")
+
+# where a page's links to other entities are found: (XPath of the link elements, table they point to, 
+# XPath of the id on each, and the relation, itself an XPath on the link or a fixed name). Hrefs name 
+# their table, and are labelled by the table row or card heading they sit under
+link_scope = '//div[@id="maprr-content-wrapper"]'
+link_specs = [
+    (f'{link_scope}//a[@href]', None, 'string(@href)', ['ancestor::tr[1]/th[1]', 'ancestor::p[1]/preceding-sibling::h4[1]']), 
+    (f'{link_scope}//div[@id="content"]//a[@data-pbc_id]', 'place_based_concepts', 'string(@data-pbc_id)', 'mentions'), 
+    (f'{link_scope}//div[@id="content"]//a[@data-loc_id]', 'locations', 'string(@data-loc_id)', 'mentions'), 
+    (f'{link_scope}//a[starts-with(@onclick, "showMMInfo(")]', 'multivalent_markers', 
+     'substring-before(substring-after(@onclick, "("), ")")', 'marked_by'), 
+]
+entity_href = re.compile(r'^(?:https?://[^/]+)?/(' + '|'.join(t.strip('/') for t in tables) + r')/(\d+)/?$')
+
+def parse_links(table, id_num, root): 
+    """This function lists the (src, src_id, dst, dst_id, rel) links from one page to other entities"""
+    
+    links = []
+    for nodes, dst, id_expr, rel in link_specs: 
+        for node in select(nodes, root): 
+            value = select(id_expr, node).strip()
+            if dst is None: 
+                found = entity_href.match(value)
+                if not found: 
+                    continue
+                to, value = found.group(1), found.group(2)
+            else: 
+                to = dst
+            if not value.isdigit() or (to, int(value)) == (table, id_num): 
+                continue
+            name = rel if isinstance(rel, str) else key_styles['snake'](first_text(rel, lambda e: select(e, node), '').strip().rstrip(':'))
+            links.append((table, id_num, to, int(value), name))
+    return links
+
+def parse_bs4(table, body): 
+    """This function parses a page with BeautifulSoup's html.parser and the maprr parsers"""
+    
+    s = BeautifulSoup(body, 'html.parser')
+    if table == 'agents': 
+        return maprr().parseAs(s)
+    elif table == 'works': 
+        return maprr().parseWs(s)
+    else: 
+        raise ValueError(f"There is no parser for {table}")
+
+class PageError(ValueError): 
+    """Raised for a page there is nothing to parse in, like a 200 with an empty body"""
+
+def page_root(body): 
+    """This function parses raw html into an lxml tree, raising PageError if there is no html in it"""
+    
+    if isinstance(body, str): 
+        body = body.encode('utf-8')
+    root = etree.fromstring(body, html_parser()) if body and body.strip() else None
+    if root is None: 
+        raise PageError(f"No html in a page of {len(body or b'')} bytes")
+    return root
+
+def parse_lxml(table, body): 
+    """This function parses a page with lxml and the spec of its table"""
+    
+    return parse_spec(table, page_root(body))
+
+def parse_entity(table, id_num, body): 
+    """This function parses one page of any table into its row dict and its links to other 
+    entities, reading the html once. It lives at module level so it can be sent to a process pool"""
+    
+    root = page_root(body)
+    return parse_spec(table, root), parse_links(table, id_num, root)
+
+def parse_timed(table, id_num, body): 
+    """This function runs parse_entity and also returns how long it took, for process pools"""
+    
+    t1 = time.perf_counter()
+    return parse_entity(table, id_num, body), time.perf_counter() - t1
+
+# parser backends by name, parse_page uses parser_backend unless told otherwise
+parsers = {'bs4': parse_bs4, 'lxml': parse_lxml}
+parser_backend = 'lxml'
+
+def parse_page(table, body, backend=None): 
+    """This function parses the raw html of one page into a dict. It lives at 
+    module level so it can be sent to a process pool"""
+    
+    return parsers[backend or parser_backend](table, body)
+
 class ParallelMAPRR: 
+    """Fetches pages on a pool of threads and hands the raw html through a bounded queue 
+    to a pool of processes for parsing, so parsing overlaps with downloading. It crawls the 
+    counts in tables as they are, see discover_tables for finding the real ones first"""
     
-    global domain, tables, max_threads
+    headers = {
+        'User-Agent': 'Mozilla/5.0 (Windows NT 6.1) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/41.0.2228.0 Safari/537.36',
+    }
     
-    def __init__(self): 
-        self.urls_to_visit = []
+    def __init__(self, threads=max_threads, procs=max_procs, queue_size=64, domain=domain, tables=tables, store=None, metrics=None, 
+                 timeout=request_timeout): 
+        log_to_file()
+        self.threads = threads
+        self.procs = procs
+        # pages waiting to be parsed, fetch threads block when it is full
+        self.queue_size = queue_size
+        self.domain = domain
+        # optional PageStore that keeps the raw html of every fetched page
+        self.store = store
+        # with a store, a journal of the crawl so a run that stopped part way picks up where it was
+        self.journal = CrawlJournal(store) if store is not None else None
+        # seconds before a request is given up on, as (connect, read)
+        self.timeout = timeout
+        # every table with a spec in table_specs
+        self.urls_to_visit = [(t, i) for t, i in crawl_plan(tables) if t in table_specs]
         self.aberrantAs = []
         self.aberrantWs = []
-        self.soups = {}
-        self.Wsoup = {} 
-        self.Asoup = {}
+        # {'table/id': status} of pages from the other tables that didn't return 200
+        self.aberrant = []
+        # parsed dicts keyed by (table, id) so agent 5 and work 5 don't collide
+        self.parsed = {}
+        # (src, src_id, dst, dst_id, rel) links found on the parsed pages
+        self.links = []
+        # parsed dicts of every table, {table: {id: dict}}
+        self.entities = {}
+        # parse jobs submitted to the process pool but not yet collected
+        self.pending = {}
+        # PartWriter parsed pages go to instead of parsed, set by stream
+        self.sink = None
+        # set when the parser has stopped, so fetch threads don't wait on a queue nobody reads
+        self.stopped = threading.Event()
+        # what stopped the download thread, raised by get_and_parse
+        self.error = None
         self.Ws = {}
         self.As = {}
+        self.local = threading.local()
+        # per page and per stage timings, written out at the end of run
+        self.metrics = metrics or Metrics()
     
-    def get_html(self, url): 
-        url_format = 'https://mpgrr.herokuapp.com/(\w+)/(\d{1,3})'
-        url_match = re.match(url_format, url)
-        fco_type = url_match.group(1)
-        id_num = url_match.group(2)
-        headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 6.1) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/41.0.2228.0 Safari/537.36',
-    }
-        with requests.get(url, headers=headers) as r: 
-            logging.info(f"{fco_type}/{id_num} status code: {r.status_code}")
-            if r.status_code == 200: 
-                s = BeautifulSoup(r.content, 'html.parser')
-                self.soups.update({id_num:s})
-                #if fco_type == 'agents': 
-                #    self.Asoup.update({id_num:s})
-                #elif fco_type == 'works': 
-                #    self.Wsoup.update({id_num:s})
-            else: 
-                if fco_type == 'agents': 
-                    self.aberrantAs.append({'A'+str(id_num): r.status_code})
-                elif fco_type == 'works': 
-                    self.aberrantWs.append({'W'+str(id_num): r.status_code})
-                pass
-        time.sleep(.5)
-            
-    def downloadHTML(self): 
-        threads = min(max_threads, len(self.urls_to_visit)) 
-        print(f"Downloading with {threads} threads")
-        with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor: 
-            executor.map(self.get_html, self.urls_to_visit)
-
-    def parse_html(self, html): 
-        if 'works' in list(html.body.attrs.values())[0]: 
-            content = html.find('div', {'class':'col-md-9 fixed-height'})
-            try: 
-                author = content.div.h3.text
-            except: 
-                author = ""
-            try: 
-                title = content.div.h4.text
-            except: 
-                title = ""
-            stanza_text = content.find_all('p',{'class':'stanza'})
-            prose_text = content.find_all('p',{'class':'text'})
-            if len(stanza_text) > len(prose_text): 
-                text = stanza_text
-            elif len(stanza_text) < len(prose_text): 
-                text = prose_text
-            Wtext = [x.text.replace('\n','').strip() for x in text]
-            metaKeys = [x.text[:-1] for x in html.find('div', {'class':'card-body'}).find_all('h4')]
-            metaVals = [x.text for x in html.find('div', {'class':'card-body'}).find_all('p')]
-            metaDict = dict(zip(metaKeys, metaVals))
-            subDict = {'title': title, 
-                       'text': Wtext}
-
-            self.Ws.update(subdict)
-            #return subDict
-
-        elif 'agents' in list(html.body.attrs.values())[0]: 
-            name = html.find('div', {'class': 'card scrollable'}).h2.text
-            bdate, ddate = html.find('div', {'class': 'card scrollable'}).span.text.split(' - ')
-            subDict = {'name': name, 'birth': bdate, 'death': ddate}
+    def hand_over(self, pages, item): 
+        """This function queues item for the parser, giving up if the parser has stopped"""
+        
+        while not self.stopped.is_set(): 
             try: 
-                typeKeys = [x.h4.text for x in html.find_all('div', {'class': 'col-md-4'})]
-                typeVals = [x.p or x.div.span.text for x in html.find_all('div', {'class': 'col-md-4'})]
-                typeVals[:2] = [x.text for x in typeVals[:2]]
-                typeDict = dict(zip(typeKeys, typeVals))
-                subDict.update(typeDict)
-            except: 
+                pages.put(item, timeout=.1)
+                return True
+            except queue.Full: 
                 pass
-
-            self.As.update(subdict)
-            #return subDict
+        return False
+    
+    def get_html(self, table, id_num, pages): 
+        """This function fetches one page on the calling thread's session and queues its html"""
         
-        else: 
-            logging.info(f"Something went wrong while parsing")
-            pass
+        if self.stopped.is_set(): 
+            return
+        # each thread keeps its own keep-alive session
+        if not hasattr(self.local, 'session'): 
+            self.local.session = requests.Session()
+            self.local.session.headers.update(self.headers)
+        if self.journal is not None: 
+            self.journal.begin(table, id_num)
+        sent = time.perf_counter()
+        with self.local.session.get(self.domain+table+'/'+str(id_num), timeout=self.timeout) as r: 
+            self.metrics.fetched(table, id_num, r.status_code, time.perf_counter() - sent, len(r.content))
+            logging.info(f"{table}/{id_num} status code: {r.status_code}")
+            # the store has the page before the journal has it done, so a resumed run always finds its html
+            if r.status_code == 200 and self.store is not None: 
+                self.store.put(table, id_num, r.content)
+            elif r.status_code in (404, 410) and self.store is not None: 
+                # not there, so forget any copy an earlier crawl stored and don't ask again
+                self.store.remove(table, id_num)
+                self.store.skip(table, id_num, r.status_code)
+            if self.journal is not None: 
+                if r.status_code in (200, 404, 410): 
+                    self.journal.done(table, id_num, r.status_code)
+                else: 
+                    self.journal.failed(table, id_num, r.status_code)
+            if r.status_code == 200: 
+                self.hand_over(pages, (table, id_num, r.content))
+            elif table == 'agents': 
+                self.aberrantAs.append({'a'+str(id_num): r.status_code})
+            elif table == 'works': 
+                self.aberrantWs.append({'w'+str(id_num): r.status_code})
+            else: 
+                self.aberrant.append({table+'/'+str(id_num): r.status_code})
     
-    def parseHTML(self): 
-        threads = min(max_threads, len(self.urls_to_visit)) 
-        print(f"Parsing with {threads} threads")
-        with concurrent.futures.ProcessPoolExecutor(max_workers=threads) as executor: 
-            executor.map(self.parse_html, self.soups)
+    def downloadHTML(self, pages): 
+        """This function fetches every page on the thread pool then marks the queue finished"""
+        
+        plan = self.urls_to_visit
+        try: 
+            if self.store is not None: 
+                # ids that were 404 on an earlier run aren't asked for again
+                skipped = self.store.skipped()
+                plan = [(t, i) for t, i in plan if (t, i) not in skipped]
+            if self.journal is not None: 
+                wanted = plan
+                plan = self.journal.start(wanted)
+                # pages got before the last run stopped are parsed from the store, not fetched again
+                fetched = set(plan)
+                for t, i in wanted: 
+                    body = self.store.get(t, i) if (t, i) not in fetched else None
+                    if body is not None: 
+                        self.hand_over(pages, (t, i, body))
+            threads = min(self.threads, len(plan)) or 1
+            print(f"Downloading with {threads} threads")
+            with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor: 
+                futures = [executor.submit(self.get_html, t, i, pages) for t, i in plan]
+                for f, (t, i) in zip(futures, plan): 
+                    try: 
+                        f.result()
+                    except requests.RequestException as e: 
+                        # timeouts and dropped connections cost this page, not the crawl
+                        logging.info(f"{t}/{i} failed: {e!r}")
+                        if self.journal is not None: 
+                            self.journal.failed(t, i, type(e).__name__)
+                    except Exception: 
+                        # anything else isn't the page's fault, so stop fetching and leave the run to resume
+                        executor.shutdown(wait=False, cancel_futures=True)
+                        raise
+            if self.journal is not None: 
+                self.journal.finish()
+        except BaseException as e: 
+            # this thread can't raise to run, get_and_parse raises it once the parser is done
+            logging.info(f"Download stopped: {e!r}")
+            self.error = e
+        finally: 
+            # tell the parser there is nothing more coming
+            self.hand_over(pages, None)
     
-    def run(self): 
-        for t, i in list(tables.items())[:2]: 
-            for j in range(0,5): 
-                self.urls_to_visit.append(domain+t+str(j))
+    def collect(self, done): 
+        """This function stores the results of finished parse jobs"""
         
-        logging.info(f"Getting As and Ws")
-        self.downloadHTML()
-        logging.info(f"Done getting As and Ws")
+        for f in done: 
+            table, id_num = self.pending.pop(f)
+            try: 
+                (row, links), seconds = f.result()
+                self.metrics.parsed(table, id_num, seconds)
+                if self.sink is not None: 
+                    self.sink.add(table, id_num, tidy_row(table, row), links)
+                    continue
+                self.parsed[(table, id_num)] = row
+                self.links.extend(links)
+            except Exception as e: 
+                # whatever goes wrong with one page costs that page, not the crawl
+                logging.info(f"{table}/{id_num} could not be parsed: {e!r}")
+                self.metrics.parsed(table, id_num, 0.0, ok=False)
+    
+    def parseHTML(self, pages): 
+        """This function sends queued html to the process pool as it arrives"""
         
-        logging.info(f"Parsing As and Ws")
-        self.parseHTML()
-        logging.info(f"Done parsing As and Ws")
+        print(f"Parsing with {self.procs} processes")
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.procs) as executor: 
+            while True: 
+                item = pages.get()
+                if item is None: 
+                    break
+                table, id_num, body = item
+                self.pending[executor.submit(parse_timed, table, id_num, body)] = (table, id_num)
+                # keep the html held by the pool bounded as well
+                if len(self.pending) >= self.queue_size: 
+                    done, _ = concurrent.futures.wait(self.pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    self.collect(done)
+            self.collect(list(self.pending))
+    
+    def get_and_parse(self): 
+        """This function runs the download threads alongside the parse processes and sorts the results into 
+        entities by table, with the agents and works also in As and Ws. An error that stopped the download 
+        is raised once the parser is done"""
+        
+        logging.info(f"Getting and parsing all tables")
+        pages = queue.Queue(maxsize=self.queue_size)
+        self.stopped.clear()
+        self.error = None
+        downloader = threading.Thread(target=self.downloadHTML, args=(pages,))
+        downloader.start()
+        try: 
+            self.parseHTML(pages)
+        except BaseException: 
+            self.stopped.set()
+            raise
+        finally: 
+            downloader.join()
+        # a crawl whose download broke off mustn't be written as if it were complete
+        if self.error is not None: 
+            raise self.error
+        logging.info(f"Done getting and parsing all tables")
+        
+        for (t, i), d in self.parsed.items(): 
+            self.entities.setdefault(t, {})[i] = d
+        self.As = self.entities.get('agents', {})
+        self.Ws = self.entities.get('works', {})
+    
+    def stream(self, path='.', batch_size=256): 
+        """This function runs the fetch/parse pipeline with each parsed page going to a PartWriter rather 
+        than into parsed, skipping pages already in committed batches under path. Ends by merging the parts 
+        into the frames and edgesDf (Parquet) and returns their names""" 
+        
+        self.sink = PartWriter(path, batch_size)
+        self.urls_to_visit = [(t, i) for t, i in self.urls_to_visit if (t, i) not in self.sink.done]
+        logging.info(f"Streaming {len(self.urls_to_visit)} pages, {len(self.sink.done)} already written")
+        try: 
+            with self.metrics.timer('fetch+parse'): 
+                self.get_and_parse()
+        finally: 
+            # whatever was parsed before a failure still gets written
+            self.sink.flush()
+        with self.metrics.timer('write'): 
+            merged = self.sink.close()
+        self.sink = None
+        self.metrics.dump()
+        return merged
+    
+    def run(self): 
+        """This function runs the fetch/parse pipeline, creates DataFrames of every table and the edge table, 
+        and persists them (Parquet, see write_graph). Stage and page timings end up in maprr_metrics.json and maprr_metrics.prom"""
+        
+        # fetching and parsing overlap, so they're timed as one stage
+        with self.metrics.timer('fetch+parse'): 
+            self.get_and_parse()
         
         logging.info(f"Making dataframes")
-        print(f"Making AsDf")
-        AsDf = pd.DataFrame.from_dict(self.As)
-        print(f"Making WsDf")
-        WsDf = pd.DataFrame.from_dict(self.Ws)        
+        with self.metrics.timer('build'): 
+            # a frame for every table crawled, even if none of its pages could be parsed
+            tables = dict.fromkeys(t for t, _ in self.urls_to_visit)
+            frames = {t: pd.DataFrame.from_dict(self.entities.get(t, {}), orient='index').sort_index() for t in tables}
+            edgesDf = edge_frame(self.links)
         logging.info(f"Done making dataframes")
         
-        logging.info(f"Writing to json")
-        WsDf.to_json('WsDf.json')
-        AsDf.to_json('AsDf.json')
-        logging.info(f"Done writing to json")
\ No newline at end of file
+        logging.info(f"Writing to parquet")
+        with self.metrics.timer('write'): 
+            write_graph(frames, edgesDf)
+        logging.info(f"Done writing to parquet")
+        self.metrics.dump()
+
+
+# page field names to lib_cols, matched exactly since 'title' and 'Title' are different fields
+work_fields = {
+    'title': 'title_ru', 
+    'genre': 'genre', 
+    'text': 'text', 
+    'Title': 'title_en', 
+    'First Line': '1st_line', 
+    'Author': 'author', 
+    'Composition Date': 'comp_date', 
+    'Composition Location': 'comp_loc', 
+    'Source of First Publication': 'pub_src', 
+    'First Publication Publisher': '1st_pub', 
+    'First Publication Year': 'pub_year', 
+    'First Publication Location': 'pub_loc'
+}
+# page field names, lowercased with underscores as parseAs makes them, to a_cols
+agent_fields = {
+    'name': 'name', 
+    'birth': 'birth', 
+    'death': 'death', 
+    'type_of_agent': 'a_type', 
+    'sex': 'sex', 
+    'occupations': 'occs', 
+    'family_social_strata': 'fam_soc_str', 
+    'social_strata': 'fam_soc_str', 
+    'literary_affiliations': 'lit_affil', 
+    'political_affiliations': 'pol_affil', 
+    'type_of_corporate_body': 'corp_type', 
+    'affiliation': 'corp_affil'
+}
+
+# every date field is followed in the Parquet output by its end bound, precision and certainty (see parse_dates)
+date_part_names = ('_end', '_precision', '_certainty')
+
+@functools.lru_cache(maxsize=None)
+def arrow_schemas(): 
+    """This function builds the Arrow types of the Parquet output the first time they're needed, as 'category', 
+    'date_parts' and the 'works', 'agents' and 'edges' schemas, so importing doesn't load pyarrow"""
+    
+    category = pa.dictionary(pa.int32(), pa.string())
+    date_parts = dict(zip(date_part_names, (pa.date32(), category, category)))
+    
+    def with_date_parts(fields): 
+        # add the end, precision and certainty fields after each date field
+        return [f for name, t in fields for f in [(name, t)] + ([(name + k, v) for k, v in date_parts.items()] if t == pa.date32() else [])]
+    
+    return {
+        'category': category, 
+        'date_parts': date_parts, 
+        # column types in lib_cols/a_cols order after the id
+        'works': pa.schema(with_date_parts([('w_id', pa.int32())] + [(c, {
+            'genre': category, 
+            'text': pa.list_(pa.string()), 
+            'comp_date': pa.date32(), 
+            'pub_year': pa.int16()}.get(c, pa.string())) for c in lib_cols])), 
+        'agents': pa.schema(with_date_parts([('a_id', pa.int32())] + [(c, {
+            'birth': pa.date32(), 
+            'death': pa.date32(), 
+            'a_type': category, 
+            'sex': category, 
+            'fam_soc_str': category, 
+            'lit_affil': category, 
+            'pol_affil': category, 
+            'corp_type': category, 
+            'corp_affil': category}.get(c, pa.string())) for c in a_cols])), 
+        'edges': pa.schema([
+            ('src', category), ('src_id', pa.int32()), ('dst', category), ('dst_id', pa.int32()), ('rel', category), ('n', pa.int16())])}
+
+month_numbers = {m[:3]: i for i, m in enumerate(['january', 'february', 'march', 'april', 'may', 'june', 'july', 
+                                                   'august', 'september', 'october', 'november', 'december'], 1)}
+# first month of each season, winter being the one that ends in February of its year
+season_months = {'spring': 3, 'summer': 6, 'autumn': 9, 'fall': 9, 'winter': 0}
+# (precision, pattern) tried in turn on a single date, finest first. Years may be negative (BC). 
+# A century is named ('19th century') or written as hundreds before 1900 ('1800s'), as '1900s' and 
+# '1910s' are both read as decades 
+date_patterns = [
+    ('day', re.compile(r'(?P<month>[A-Za-z]{3,})\.? (?P<day>\d{1,2}),? (?P<year>-?\d{1,4})')), 
+    ('day', re.compile(r'(?P<day>\d{1,2}) (?P<month>[A-Za-z]{3,})\.?,? (?P<year>-?\d{1,4})')), 
+    ('day', re.compile(r'(?P<year>\d{4})-(?P<month>\d{2})-(?P<day>\d{2})')), 
+    ('season', re.compile(r'(?P<season>spring|summer|autumn|fall|winter),? (?:of )?(?P<year>-?\d{1,4})', re.I)), 
+    ('month', re.compile(r'(?P<month>[A-Za-z]{3,})\.?,? (?P<year>-?\d{1,4})')), 
+    ('month', re.compile(r'(?P<month>\d{1,2})\s*[/.]\s*(?P<year>\d{4})')), 
+    ('year', re.compile(r'(?P<year>-?\d{1,4})(?:\.0)?')), 
+    ('century', re.compile(r'(?P<year>1[0-8]00)\'?s')), 
+    ('century', re.compile(r'(?P<century>\d{1,2})(?:st|nd|rd|th) century', re.I)), 
+    ('decade', re.compile(r'(?P<year>\d{3}0)\'?s')), 
+]
+# day and month in either order, '1/5/1917' being January 5 or May 1. Two digit years are left alone
+numeric_date = re.compile(r'(\d{1,2})\s*[/.]\s*(\d{1,2})\s*[/.]\s*(\d{4})')
+precisions = ['day', 'month', 'season', 'year', 'decade', 'century']
+# (certainty, pattern) of the ways one string gives several dates, tried in turn where a single date doesn't match. 
+# Commas only split before a letter first, so 'August 22, 1891, August 22, 1896' splits in two and not four
+date_joins = [
+    ('range', re.compile(r'\s+(?:to|until|-|–)\s+|(?<=\d)[-–](?=\d)')), 
+    ('alternatives', re.compile(r',\s+(?=[A-Za-z])|\s+or\s+')), 
+    ('alternatives', re.compile(r',\s+')), 
+    ('alternatives', re.compile(r'\s*/\s*')), 
+]
+# a piece of a range or list too short to be a year on its own, like the 16 of '1914-16'
+short_year = re.compile(r'(\d{1,2})(\??)')
+approximate_date = re.compile(r'(?:c\.|ca\.|circa|about|approx\.)\s*', re.I)
+unknown_date = re.compile(r'(?:date\s+)?unknown|n\.\s?d\.|not specified|undated', re.I)
+no_date = (None, None, None, None)
+
+def date_bounds(precision, year, month=None, day=None): 
+    """This function returns the first and last day a date of the given precision could be, or None if it doesn't exist"""
+    
+    first_year = np.datetime64(year - 1970, 'Y')
+    if precision == 'century': 
+        return first_year.astype('M8[D]'), (first_year + 100).astype('M8[D]') - 1
+    if precision == 'decade': 
+        return first_year.astype('M8[D]'), (first_year + 10).astype('M8[D]') - 1
+    if precision == 'year': 
+        return first_year.astype('M8[D]'), (first_year + 1).astype('M8[D]') - 1
+    if precision == 'season': 
+        first_month = first_year.astype('M8[M]') + (month - 1)
+        return first_month.astype('M8[D]'), (first_month + 3).astype('M8[D]') - 1
+    if not 1 <= month <= 12: 
+        return None
+    first_month = first_year.astype('M8[M]') + (month - 1)
+    last = (first_month + 1).astype('M8[D]') - 1
+    if precision == 'month': 
+        return first_month.astype('M8[D]'), last
+    start = first_month.astype('M8[D]') + (day - 1)
+    return (start, start) if 1 <= day and start <= last else None
+
+def date_piece(text): 
+    """This function reads one date like 'June 23, 1889', '23 June 1889', 'July 1917', '1936?' or 'c. 1920s' into 
+    (start, end, precision, certainty). It returns None if it isn't one and False if it is one that can't be, like February 30"""
+    
+    text = text.strip()
+    certainty = 'exact'
+    if text.endswith('?'): 
+        certainty = 'uncertain'
+        text = text[:-1].strip()
+    approximate = approximate_date.match(text)
+    if approximate: 
+        certainty = 'approximate'
+        text = text[approximate.end():]
+    numeric = numeric_date.fullmatch(text)
+    if numeric: 
+        a, b, year = (int(x) for x in numeric.groups())
+        readings = {date_bounds('day', year, m, d) for m, d in ((a, b), (b, a))} - {None}
+        if not readings: 
+            return False
+        if len(readings) == 2 and certainty == 'exact': 
+            certainty = 'alternatives'
+        return min(r[0] for r in readings), max(r[1] for r in readings), 'day', certainty
+    for precision, pattern in date_patterns: 
+        m = pattern.fullmatch(text)
+        if m is None: 
+            continue
+        parts = m.groupdict()
+        month = parts.get('month')
+        if parts.get('season'): 
+            month = season_months[parts['season'].lower()]
+        elif month is not None and not month.isdigit(): 
+            month = month_numbers.get(month[:3].lower())
+            if month is None: 
+                return None
+        # the 19th century runs from 1800 to 1899
+        year = (int(parts['century']) - 1)*100 if parts.get('century') else int(parts['year'])
+        bounds = date_bounds(precision, year, month and int(month), parts.get('day') and int(parts['day']))
+        return False if bounds is None else bounds + (precision, certainty)
+    return None
+
+def full_year(first, text): 
+    """This function reads the abbreviated end year of a range like '1914-16' in the century of its start 
+    (the decade for one digit), rolling over to the next when that would end before it starts, '1899-01' being 1899 to 1901"""
+    
+    end = short_year.fullmatch(text.strip())
+    start = re.search(r'(\d{4})\D*$', first)
+    if end is None or start is None: 
+        return text
+    step = 10 ** len(end.group(1))
+    year = int(start.group(1)) // step * step + int(end.group(1))
+    return str(year + step if year < int(start.group(1)) else year) + end.group(2)
+
+@functools.lru_cache(maxsize=4096)
+def parse_date(text): 
+    """This function reads a free text date, ranges ('1914 to 1916') and alternatives ('1891, 1896') included, into 
+    (start, end, precision, certainty): the earliest and latest day it allows, the coarsest precision of its parts 
+    ('day', 'month', 'season', 'year', 'decade' or 'century') and 'exact', 'uncertain', 'approximate', 'range', 'alternatives' or 'unknown'. 
+    Text that isn't a date gives None for all four. Repeated strings come from the cache"""
+    
+    piece = date_piece(text)
+    if piece is not None: 
+        return piece or no_date
+    if unknown_date.fullmatch(text.strip()): 
+        return no_date[:3] + ('unknown',)
+    for certainty, pattern in date_joins: 
+        texts = pattern.split(text)
+        if len(texts) < 2: 
+            continue
+        if certainty == 'range': 
+            texts = texts[:1] + [full_year(texts[0], t) for t in texts[1:]]
+        if any(short_year.fullmatch(t.strip()) for t in texts): 
+            continue
+        pieces = [date_piece(t) for t in texts]
+        # a range has to run forwards
+        if certainty == 'range' and all(pieces) and any(b[1] < a[0] for a, b in zip(pieces, pieces[1:])): 
+            continue
+        if all(pieces): 
+            doubtful = [p[3] for p in pieces if p[3] != 'exact']
+            return (min(p[0] for p in pieces), max(p[1] for p in pieces), max((p[2] for p in pieces), key=precisions.index), 
+                    doubtful[0] if doubtful else certainty)
+    return no_date
+
+def date_of(value): 
+    """This function parses one value of a date column: text, a number read as a year, or a date or timestamp"""
+    
+    if isinstance(value, (pd.Timestamp, np.datetime64)) or hasattr(value, 'isoformat'): 
+        day = np.datetime64(value, 'D')
+        return (day, day, 'day', 'exact')
+    if isinstance(value, float) and value.is_integer(): 
+        value = int(value)
+    return parse_date(str(value))
+
+certainties = ['exact', 'uncertain', 'approximate', 'range', 'alternatives', 'unknown']
+
+def parse_dates(col): 
+    """This function parses a column of free text dates into a frame of start and end (datetime64[s]), precision and 
+    certainty (categories) with col's index. Each distinct string is parsed once and the results are spread back over 
+    the rows with a take, so columns that repeat their dates cost little more than their distinct values"""
+    
+    codes, uniques = pd.factorize(col, use_na_sentinel=True)
+    parsed = [date_of(u) for u in uniques] + [no_date]
+    # missing values have code -1, the no_date added at the end
+    starts, ends, precision, certainty = zip(*parsed)
+    labels = lambda values, categories: pd.Categorical.from_codes(
+        np.array([-1 if v is None else categories.index(v) for v in values], 'int8')[codes], categories=categories)
+    return pd.DataFrame({
+        'start': np.array(starts, 'M8[D]')[codes].astype('M8[s]'), 
+        'end': np.array(ends, 'M8[D]')[codes].astype('M8[s]'), 
+        'precision': labels(precision, precisions), 
+        'certainty': labels(certainty, certainties)}, index=col.index)
+
+def tidy_name(table, key): 
+    """This function maps a field name from a parsed page to its lib_cols/a_cols name, other tables keep theirs"""
+    
+    fields = {'works': work_fields, 'agents': agent_fields}.get(table, {})
+    return fields.get(key) or fields.get(key.lower().replace(' ','_')) or key
+
+def tidy_row(table, row): 
+    """This function renames the fields of one parsed page to lib_cols/a_cols"""
+    
+    return {tidy_name(table, k): v for k, v in row.items()}
+
+def to_year(col): 
+    """This function reads years out of a column of years and free text dates, the first year a date allows"""
+    
+    return parse_dates(col).start.dt.year.astype('Int16')
+
+def to_arrow(df, table): 
+    """This function converts WsDf (table='works') or AsDf (table='agents') to an Arrow table with the fixed schema"""
+    
+    schema = arrow_schemas()[table]
+    category = arrow_schemas()['category']
+    df = df.rename(columns=lambda k: tidy_name(table, k))
+    dropped = [c for c in df.columns if c not in schema.names]
+    if dropped: 
+        logging.info(f"Columns not in the {table} schema were left out: {dropped}")
+    arrays = [pa.array(df.index, pa.int32())]
+    # end, precision and certainty of the date fields, filled in when their date field is parsed
+    parts = {}
+    for field in list(schema)[1:]: 
+        if field.name in parts: 
+            arrays.append(parts.pop(field.name))
+            continue
+        col = df[field.name] if field.name in df else pd.Series(None, index=df.index, dtype=object)
+        if field.type == pa.date32(): 
+            dates = parse_dates(col)
+            for k in date_part_names: 
+                # rows read back from Parquet already carry their parts, which know more than the stored start does
+                if field.name + k in df: 
+                    known = df[field.name + k].astype(object)
+                    dates[k[1:]] = known.where(known.notna(), dates[k[1:]].astype(object))
+            arrays.append(pa.array(dates.start.to_numpy('M8[D]')).cast(pa.date32()))
+            parts[field.name + '_end'] = pa.array(pd.to_datetime(dates.end).to_numpy('M8[D]')).cast(pa.date32())
+            for k in ('precision', 'certainty'): 
+                parts[f'{field.name}_{k}'] = pa.array(dates[k].astype(object).where(dates[k].notna(), None), pa.string()).dictionary_encode()
+        elif field.type == pa.int16(): 
+            arrays.append(pa.array(to_year(col), pa.int16()))
+        else: 
+            values = col.astype(object).where(col.notna(), None)
+            if field.type == category: 
+                arrays.append(pa.array(values, pa.string()).dictionary_encode())
+            else: 
+                arrays.append(pa.array(values, field.type))
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+def write_frames(WsDf, AsDf, path='.'): 
+    """This function writes WsDf and AsDf as typed Parquet files"""
+    
+    pq.write_table(to_arrow(WsDf, 'works'), os.path.join(path, 'WsDf.parquet'), compression='zstd')
+    pq.write_table(to_arrow(AsDf, 'agents'), os.path.join(path, 'AsDf.parquet'), compression='zstd')
+
+def read_frame(name, columns=None, path='.'): 
+    """This function loads a frame such as 'WsDf', 'AsDf' or 'edgesDf' from Parquet, reading only columns if given. Dates come 
+    back as datetime64 and categorical fields as pandas categories, so nothing needs converting"""
+    
+    file = os.path.join(path, name + '.parquet')
+    id_col = pq.read_schema(file).names[0]
+    # entity frames lead with their id, edgesDf has none
+    if not id_col.endswith('_id'): 
+        return pq.read_table(file, columns=columns).to_pandas()
+    table = pq.read_table(file, columns=None if columns is None else [id_col] + [c for c in columns if c != id_col])
+    # nullable Int16 keeps pub_year whole numbers even where it's missing
+    return table.to_pandas(date_as_object=False, types_mapper={pa.int16(): pd.Int16Dtype()}.get).set_index(id_col)
+
+def patch_frame(df, rows, gone=()): 
+    """This function replaces or adds the rows in the {id: dict} rows and drops the ids in gone, 
+    leaving every other row of df as it was"""
+    
+    patch = pd.DataFrame.from_dict(rows, orient='index')
+    stale = [i for i in set(rows) | set(gone) if i in df.index]
+    if len(patch) == 0: 
+        return df.drop(index=stale)
+    return pd.concat([df.drop(index=stale), patch]).sort_index()
+
+# frame of each table, named like WsDf and AsDf, and the id column it leads with
+frame_names = {'works': 'WsDf', 'agents': 'AsDf', 'place_based_concepts': 'PsDf', 'locations': 'LsDf', 'multivalent_markers': 'MsDf'}
+id_cols = {'works': 'w_id', 'agents': 'a_id', 'place_based_concepts': 'p_id', 'locations': 'l_id', 'multivalent_markers': 'm_id'}
+
+# columns of the edge table, one row per distinct link between two entities
+edge_cols = ['src', 'src_id', 'dst', 'dst_id', 'rel', 'n']
+edge_dtypes = {'src': 'category', 'src_id': 'int32', 'dst': 'category', 'dst_id': 'int32', 'rel': 'category', 'n': 'int16'}
+
+def edge_frame(links): 
+    """This function collapses (src, src_id, dst, dst_id, rel) links into edgesDf, one row per distinct 
+    link with the number of times its page makes it in n"""
+    
+    edgesDf = pd.DataFrame(links, columns=edge_cols[:-1]).groupby(edge_cols[:-1], observed=True).size().rename('n').reset_index()
+    return edgesDf.astype(edge_dtypes)
+
+def patch_edges(edgesDf, links, pages): 
+    """This function replaces the edges from the (table, id) pages in edgesDf with the ones in links"""
+    
+    fresh = edge_frame(links)
+    if edgesDf is None or len(edgesDf) == 0: 
+        return fresh
+    pages = set(pages)
+    stale = np.array([(t, i) in pages for t, i in zip(edgesDf.src, edgesDf.src_id)], bool)
+    edgesDf = pd.concat([edgesDf[~stale].astype(object), fresh.astype(object)]).sort_values(edge_cols[:-1], ignore_index=True)
+    return edgesDf.astype(edge_dtypes)
+
+def entity_arrow(df, table): 
+    """This function converts the frame of a table without a fixed schema to Arrow, its id first and every field as text"""
+    
+    arrays = [pa.array(df.index, pa.int32())] + [pa.array(df[c].astype(object).where(df[c].notna(), None), pa.string()) for c in df.columns]
+    return pa.Table.from_arrays(arrays, names=[id_cols[table]] + [str(c) for c in df.columns])
+
+def write_graph(frames, edgesDf, path='.'): 
+    """This function writes the frame of every table in frames, {table: df}, and edgesDf as Parquet"""
+    
+    for table, df in frames.items(): 
+        arrow = to_arrow(df, table) if table in ('works', 'agents') else entity_arrow(df, table)
+        pq.write_table(arrow, os.path.join(path, frame_names[table] + '.parquet'), compression='zstd')
+    pq.write_table(edge_arrow(edgesDf), os.path.join(path, 'edgesDf.parquet'), compression='zstd')
+
+def edge_arrow(edgesDf): 
+    """This function converts edgesDf to Arrow with the edge schema"""
+    
+    return pa.Table.from_pandas(edgesDf[edge_cols], schema=arrow_schemas()['edges'], preserve_index=False)
+
+class PartWriter: 
+    """Takes parsed pages one at a time, buffers their rows and links, and every batch_size pages appends 
+    them to Parquet part files under path/parts, one file per frame per batch. A batch counts once its 
+    number is in parts/committed, so a crawl that dies part way leaves every committed batch readable 
+    and the next PartWriter on the same path knows which pages not to fetch again. close() merges the 
+    parts into the usual WsDf.parquet, AsDf.parquet... and edgesDf.parquet one part at a time"""
+    
+    def __init__(self, path='.', batch_size=256): 
+        self.path = path
+        self.batch_size = batch_size
+        self.dir = os.path.join(path, 'parts')
+        os.makedirs(self.dir, exist_ok=True)
+        self.log = os.path.join(self.dir, 'committed')
+        # rows waiting for the next flush, {table: {id: row}}, and their pages' links
+        self.rows = {}
+        self.links = []
+        self.buffered = 0
+        self.batches = self.committed()
+        self.clean()
+        # (table, id) of every page already in a committed batch
+        self.done = self.written()
+    
+    def committed(self): 
+        """This function returns the numbers of the batches that finished writing"""
+        
+        if not os.path.exists(self.log): 
+            return []
+        with open(self.log) as f: 
+            return [int(line) for line in f if line.strip()]
+    
+    def part_files(self, name): 
+        """This function lists the committed part files of a frame such as 'WsDf', oldest first"""
+        
+        return [f for f in (os.path.join(self.dir, name, f'{b:05d}.parquet') for b in self.batches) if os.path.exists(f)]
+    
+    def clean(self): 
+        """This function deletes parts left by a batch that was being written when the last crawl stopped"""
+        
+        batches = set(self.batches)
+        for name in os.listdir(self.dir): 
+            folder = os.path.join(self.dir, name)
+            if not os.path.isdir(folder): 
+                continue
+            for f in os.listdir(folder): 
+                if not f.endswith('.parquet') or int(f.split('.')[0]) not in batches: 
+                    logging.info(f"Removing uncommitted part {name}/{f}")
+                    os.remove(os.path.join(folder, f))
+    
+    def written(self): 
+        """This function reads the ids out of the committed parts of every table"""
+        
+        done = set()
+        for table, name in frame_names.items(): 
+            for f in self.part_files(name): 
+                ids = pq.read_table(f, columns=[id_cols[table]]).column(0).to_pylist()
+                done.update((table, i) for i in ids)
+        return done
+    
+    def add(self, table, id_num, row, links): 
+        """This function buffers one parsed page, writing out a batch when batch_size pages are waiting"""
+        
+        self.rows.setdefault(table, {})[id_num] = row
+        self.links.extend(links)
+        self.buffered += 1
+        if self.buffered >= self.batch_size: 
+            self.flush()
+    
+    def write_part(self, name, batch, arrow): 
+        """This function writes one part file, under a temporary name until it is complete"""
+        
+        folder = os.path.join(self.dir, name)
+        os.makedirs(folder, exist_ok=True)
+        file = os.path.join(folder, f'{batch:05d}.parquet')
+        pq.write_table(arrow, file + '.tmp', compression='zstd')
+        os.replace(file + '.tmp', file)
+    
+    def flush(self): 
+        """This function writes the buffered pages out as the next batch and commits it"""
+        
+        if not self.buffered: 
+            return
+        batch = max(self.batches, default=-1) + 1
+        for table, rows in self.rows.items(): 
+            df = pd.DataFrame.from_dict(rows, orient='index')
+            arrow = to_arrow(df, table) if table in ('works', 'agents') else entity_arrow(df, table)
+            self.write_part(frame_names[table], batch, arrow)
+        # every link of a page is in the same batch as the page, so collapsing per batch is exact
+        self.write_part('edgesDf', batch, edge_arrow(edge_frame(self.links)))
+        with open(self.log, 'a') as f: 
+            f.write(f'{batch}\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.batches.append(batch)
+        self.done.update((t, i) for t, rows in self.rows.items() for i in rows)
+        logging.info(f"Wrote batch {batch} of {self.buffered} pages")
+        self.rows = {}
+        self.links = []
+        self.buffered = 0
+    
+    def merge(self, name, out): 
+        """This function appends the committed parts of a frame to one Parquet file. Tables without a fixed 
+        schema can gain columns from part to part, those missing from a part are left null. Entity frames 
+        are sorted by id, as run writes them, which takes the frame's Arrow table in memory. edgesDf is 
+        written a part at a time"""
+        
+        files = self.part_files(name)
+        if not files: 
+            return False
+        schemas = [pq.read_schema(f) for f in files]
+        names = list(dict.fromkeys(n for s in schemas for n in s.names))
+        schema = schemas[0] if all(s.names == names for s in schemas) else pa.schema(
+            [schemas[0].field(0)] + [pa.field(n, pa.string()) for n in names[1:]])
+        key = {n: id_cols[t] for t, n in frame_names.items()}.get(name)
+        with pq.ParquetWriter(out + '.tmp', schema, compression='zstd') as writer: 
+            parts = []
+            for f in files: 
+                part = pq.read_table(f)
+                if part.schema.names != schema.names: 
+                    part = pa.Table.from_arrays([part.column(n) if n in part.schema.names else pa.nulls(len(part), pa.string())
+                                                 for n in schema.names], schema=schema)
+                if key is None: 
+                    writer.write_table(part)
+                else: 
+                    parts.append(part)
+            if parts: 
+                writer.write_table(pa.concat_tables(parts).sort_by(key))
+        os.replace(out + '.tmp', out)
+        return True
+    
+    def close(self): 
+        """This function writes what is still buffered, merges every frame's parts into its Parquet file 
+        and removes the parts, returning the names of the frames written"""
+        
+        self.flush()
+        merged = [name for name in list(frame_names.values()) + ['edgesDf']
+                  if self.merge(name, os.path.join(self.path, name + '.parquet'))]
+        shutil.rmtree(self.dir)
+        logging.info(f"Merged {len(self.batches)} batches into {merged}")
+        return merged
+
+class TokenBucket: 
+    """Token bucket rate limit for the async crawler: requests may go out in short bursts 
+    but never faster than rate per second on average"""
+    
+    def __init__(self, rate, burst=None): 
+        self.rate = rate
+        self.burst = burst or max(1, rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+    
+    async def acquire(self): 
+        """This function waits until a token is available and takes it"""
+        
+        async with self.lock: 
+            while True: 
+                # refill for the time passed since the last request
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now-self.updated)*self.rate)
+                self.updated = now
+                if self.tokens >= 1: 
+                    self.tokens -= 1
+                    return
+                # sleep just long enough for the next token
+                await asyncio.sleep((1-self.tokens)/self.rate)
+
+class AdaptiveLimiter(TokenBucket): 
+    """Token bucket whose rate follows the server: it creeps up while responses come back 
+    fast, halves on 429/5xx or slow responses, and stops entirely for a Retry-After"""
+    
+    def __init__(self, rate, min_rate=.5, max_rate=50, target_latency=1.0, step=.5, burst=None): 
+        super().__init__(rate, burst)
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        # responses slower than this many seconds count as the server struggling
+        self.target_latency = target_latency
+        # requests/sec added after each fast response
+        self.step = step
+        # monotonic time before which no request may go out
+        self.paused_until = 0
+    
+    async def acquire(self): 
+        """This function waits out any Retry-After pause, then takes a token"""
+        
+        while True: 
+            delay = self.paused_until - time.monotonic()
+            if delay <= 0: 
+                break
+            await asyncio.sleep(delay)
+        await super().acquire()
+    
+    def success(self, latency): 
+        """This function widens the rate after a good response, or narrows it if the response was slow"""
+        
+        if latency > self.target_latency: 
+            self.slow_down()
+        else: 
+            self.rate = min(self.max_rate, self.rate + self.step)
+    
+    def slow_down(self, retry_after=None): 
+        """This function halves the rate and, given a Retry-After in seconds, pauses all requests that long"""
+        
+        self.rate = max(self.min_rate, self.rate/2)
+        # don't let tokens banked at the old rate burst straight back out
+        self.tokens = min(self.tokens, 1)
+        if retry_after: 
+            self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+            logging.info(f"Server asked to retry after {retry_after} sec")
+
+def retry_after(value): 
+    """This function turns a Retry-After header, in seconds or as an HTTP date, into seconds from now"""
+    
+    if not value: 
+        return None
+    if value.strip().isdigit(): 
+        return int(value)
+    try: 
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError): 
+        return None
+    return max(0, when.timestamp() - time.time())
+
+# statuses worth retrying, anything else that isn't 200 or 304 is treated as permanent
+transient_statuses = {408, 425, 429, 500, 502, 503, 504}
+
+class AsyncMAPRR: 
+    """Crawls every table with asyncio over one pooled keep-alive session instead of 
+    one requests.get and a sleep per page"""
+    
+    headers = {
+        'User-Agent': 'Mozilla/5.0 (Windows NT 6.1) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/41.0.2228.0 Safari/537.36',
+    }
+    
+    def __init__(self, domain=domain, tables=tables, rate=10, burst=None, per_host=8, timeout=30, store=None, incremental=False, 
+                 adaptive=True, min_rate=.5, max_rate=50, target_latency=1.0, retries=4, backoff=.5, max_backoff=60, discover=False, 
+                 metrics=None, journal=True): 
+        log_to_file()
+        self.domain = domain
+        self.tables = tables
+        # find each table's real size before crawling instead of trusting tables
+        self.discover = discover
+        # requests/sec allowed by the token bucket, where an adaptive crawl starts
+        self.rate = rate
+        self.burst = burst
+        # let the server's answers move the rate between min_rate and max_rate
+        self.adaptive = adaptive
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.target_latency = target_latency
+        # attempts after the first for transient failures, with jittered exponential backoff from backoff sec
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        # open connections allowed per host
+        self.per_host = per_host
+        # seconds before a single request is given up on, its connect and each read held to request_timeout as well
+        self.timeout = timeout
+        # PageStore the raw html goes to as it arrives, if None it is kept in pages instead
+        self.store = store
+        # send conditional requests based on the store's manifest, needs a store
+        self.incremental = incremental
+        if incremental and store is None: 
+            raise ValueError("Incremental crawls need a PageStore")
+        # with a store, a journal of the crawl so a run that stopped part way picks up where it was. Incremental 
+        # crawls go by the manifest instead, their changes have to be seen by the run that patches the frames
+        self.journal = CrawlJournal(store) if journal and store is not None and not incremental else None
+        # raw html bytes keyed by (table, id)
+        self.pages = {}
+        # (table, id) pairs the last get_html set out to fetch
+        self.plan = []
+        # pages of plan the journal says a run that stopped part way already got, so they weren't fetched again
+        self.resumed = []
+        # (table, id, status) of pages that didn't return 200
+        self.aberrant = []
+        # 404s found by this crawl, kept in the store's skip list when there is a store
+        self.skips = set()
+        # 'unchanged', 'changed', 'new' or 'gone' for every page seen by an incremental crawl
+        self.changes = {}
+        self.Ws = {}
+        self.As = {}
+        # tidy rows of every table, {table: {id: dict}}, and the (src, src_id, dst, dst_id, rel) links between them
+        self.entities = {}
+        self.links = []
+        # PartWriter each page goes to as soon as it is parsed, set by stream
+        self.sink = None
+        # per page and per stage timings, written out at the end of run
+        self.metrics = metrics or Metrics()
+    
+    @property
+    def report(self): 
+        """Counts of unchanged, changed, new and gone pages from the last incremental crawl"""
+        
+        counts = dict.fromkeys(('unchanged', 'changed', 'new', 'gone'), 0)
+        for state in self.changes.values(): 
+            counts[state] += 1
+        return counts
+    
+    def note(self, state, table, id_num, status=None): 
+        """This function marks a page 'in_flight', 'done' or 'failed' in the journal, if there is one"""
+        
+        if self.journal is not None: 
+            self.journal.mark(table, id_num, state, status)
+    
+    async def fetch(self, session, bucket, table, id_num): 
+        """This function fetches a single page, retrying transient failures with jittered exponential backoff"""
+        
+        self.note('in_flight', table, id_num)
+        for attempt in range(self.retries+1): 
+            wait = await self.fetch_once(session, bucket, table, id_num, last=(attempt == self.retries))
+            if wait is None: 
+                return
+            # full jitter, but never sooner than the server asked for
+            delay = max(wait, random.uniform(0, min(self.max_backoff, self.backoff*2**attempt)))
+            logging.info(f"{table}/{id_num} retry {attempt+1} in {round(delay, 2)} sec")
+            await asyncio.sleep(delay)
+    
+    async def fetch_once(self, session, bucket, table, id_num, last=True): 
+        """This function makes one attempt at a page once the token bucket allows it. It returns 
+        None when done, or the seconds the server asked to wait if the attempt should be retried"""
+        
+        await bucket.acquire()
+        url = self.domain+table+'/'+str(id_num)
+        # ask for the page only if it changed since the last crawl
+        seen = self.store.manifest(table, id_num) if self.incremental else None
+        headers = {}
+        if seen is not None and seen['status'] == 200: 
+            if seen['etag']: 
+                headers['If-None-Match'] = seen['etag']
+            if seen['last_modified']: 
+                headers['If-Modified-Since'] = seen['last_modified']
+        
+        sent = time.monotonic()
+        try: 
+            async with session.get(url, headers=headers) as r: 
+                body = await r.read()
+                self.metrics.fetched(table, id_num, r.status, time.monotonic() - sent, len(body))
+                logging.info(f"{table}/{id_num} status code: {r.status}")
+                if r.status in transient_statuses: 
+                    wait = retry_after(r.headers.get('Retry-After'))
+                    if self.adaptive: 
+                        bucket.slow_down(wait)
+                    if not last: 
+                        return wait or 0
+                    self.aberrant.append((table, id_num, r.status))
+                    self.note('failed', table, id_num, r.status)
+                    return None
+                if self.adaptive: 
+                    bucket.success(time.monotonic() - sent)
+                if r.status in (200, 304, 404, 410): 
+                    self.note('done', table, id_num, r.status)
+                else: 
+                    self.note('failed', table, id_num, r.status)
+                if r.status == 304: 
+                    self.changes[(table, id_num)] = 'unchanged'
+                    self.store.record(table, id_num, 200, seen['etag'], seen['last_modified'], seen['sha1'])
+                elif r.status == 200: 
+                    if self.store is not None: 
+                        sha1 = await asyncio.to_thread(self.store.put, table, id_num, body)
+                        self.store.record(table, id_num, 200, r.headers.get('ETag'), r.headers.get('Last-Modified'), sha1)
+                    elif self.sink is None: 
+                        self.pages[(table, id_num)] = body
+                    if self.sink is not None: 
+                        # parse straight away so neither the html nor its tree outlive this page
+                        parsed = await asyncio.to_thread(self.parse, table, id_num, body)
+                        if parsed is None: 
+                            self.aberrant.append((table, id_num, 'parse error'))
+                        else: 
+                            self.sink.add(table, id_num, *parsed)
+                    if self.incremental: 
+                        if seen is None or seen['status'] != 200: 
+                            self.changes[(table, id_num)] = 'new'
+                        elif seen['sha1'] == sha1: 
+                            self.changes[(table, id_num)] = 'unchanged'
+                        else: 
+                            self.changes[(table, id_num)] = 'changed'
+                else: 
+                    self.aberrant.append((table, id_num, r.status))
+                    if r.status in (404, 410): 
+                        self.skips.add((table, id_num))
+                        if self.store is not None: 
+                            if seen is not None and seen['status'] == 200: 
+                                self.changes[(table, id_num)] = 'gone'
+                            self.store.record(table, id_num, r.status)
+                            self.store.skip(table, id_num, r.status)
+                            self.store.remove(table, id_num)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e: 
+            logging.info(f"{table}/{id_num} failed: {e!r}")
+            self.metrics.fetched(table, id_num, type(e).__name__, time.monotonic() - sent)
+            if self.adaptive: 
+                bucket.slow_down()
+            if not last: 
+                return 0
+            self.aberrant.append((table, id_num, repr(e)))
+            self.note('failed', table, id_num, type(e).__name__)
+    
+    async def crawl(self, plan=None): 
+        """This function fetches every (table, id) in plan, all of them by default"""
+        
+        plan = crawl_plan(self.tables) if plan is None else plan
+        # ids that were 404 on an earlier run aren't asked for again
+        skipped = self.store.skipped() if self.store is not None else set()
+        plan = [(t, i) for t, i in plan if (t, i) not in skipped]
+        # ssl=False mirrors the verify=False used by the serial crawler
+        connector = aiohttp.TCPConnector(limit_per_host=self.per_host, ssl=False)
+        timeout = aiohttp.ClientTimeout(total=self.timeout, sock_connect=request_timeout[0], sock_read=request_timeout[1])
+        if self.adaptive: 
+            bucket = AdaptiveLimiter(self.rate, self.min_rate, self.max_rate, self.target_latency, burst=self.burst)
+        else: 
+            bucket = TokenBucket(self.rate, self.burst)
+        self.limiter = bucket
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout, headers=self.headers) as session: 
+            # a fixed set of workers pulls from the plan, so pending requests don't grow with the tables; 
+            # more of them than connections so pages waiting out a backoff don't hold the others up
+            pages = iter(plan)
+            async def worker(): 
+                for t, i in pages: 
+                    await self.fetch(session, bucket, t, i)
+            await asyncio.gather(*(worker() for _ in range(min(len(plan), 4*self.per_host) or 1)))
+        if self.incremental: 
+            # pages that used to exist but have dropped out of the plan are gone too
+            planned = set(plan)
+            tables = {t for t, _ in plan}
+            for t, i in self.store.manifest_keys(200): 
+                if t in tables and (t, i) not in planned: 
+                    self.changes[(t, i)] = 'gone'
+                    self.store.record(t, i, 404)
+    
+    def get_html(self, plan=None): 
+        """This function runs the crawl to completion and returns pages/sec"""
+        
+        if plan is None and self.discover: 
+            self.tables = discover_tables(self.domain, self.tables, headers=self.headers)
+        plan = crawl_plan(self.tables) if plan is None else plan
+        self.plan = plan
+        self.resumed = []
+        if self.journal is not None: 
+            # only what the last run didn't get, if it stopped part way
+            plan = self.journal.start(plan)
+            pending = set(plan)
+            self.resumed = [(t, i) for t, i in self.plan if (t, i) not in pending]
+        t1 = time.time()
+        with self.metrics.timer('fetch'): 
+            asyncio.run(self.crawl(plan))
+        t2 = time.time()
+        if self.journal is not None: 
+            self.journal.finish()
+        logging.info(f"Got {len(plan)-len(self.aberrant)} pages in {round((t2-t1), 3)} sec ({round(len(plan)/(t2-t1), 2)} pages/sec)")
+        if len(self.aberrant) > 0: 
+            print(f"Aberrant pages are {self.aberrant}")
+        return len(plan)/(t2-t1)
+    
+    def iter_pages(self, tables): 
+        """This function yields (table, id, html) for the pages of tables the last get_html got, from the store 
+        if there is one. Pages stored by earlier crawls that this one didn't plan, or found gone, are left out"""
+        
+        for table in tables: 
+            if self.store is not None: 
+                skipped = self.store.skipped()
+                for t, id_num in sorted(set(self.plan)): 
+                    body = self.store.get(t, id_num) if t == table and (t, id_num) not in skipped else None
+                    if body is not None: 
+                        yield table, id_num, body
+            else: 
+                for (t, id_num), body in sorted(self.pages.items()): 
+                    if t == table: 
+                        yield table, id_num, body
+    
+    def parse(self, table, id_num, body): 
+        """This function parses one page into its tidy row and links, returning None if it can't be parsed"""
+        
+        t1 = time.perf_counter()
+        try: 
+            row, links = parse_entity(table, id_num, body)
+        except Exception as e: 
+            logging.info(f"{table}/{id_num} could not be parsed: {e!r}")
+            self.metrics.parsed(table, id_num, time.perf_counter() - t1, ok=False)
+            return None
+        self.metrics.parsed(table, id_num, time.perf_counter() - t1)
+        return tidy_row(table, row), links
+    
+    def update_graph(self, frames, edgesDf=None): 
+        """This function re-parses only the pages of the tables in frames ({table: df}) that the last 
+        incremental crawl found new or changed, patches those rows in and drops rows for gone pages. 
+        The edges from those pages are swapped in edgesDf the same way"""
+        
+        frames = dict(frames)
+        links = []
+        touched = []
+        for table in frames: 
+            rows = {}
+            gone = []
+            for (t, id_num), state in self.changes.items(): 
+                if t != table or state == 'unchanged': 
+                    continue
+                touched.append((t, id_num))
+                if state == 'gone': 
+                    gone.append(id_num)
+                    continue
+                parsed = self.parse(table, id_num, self.store.get(table, id_num))
+                if parsed is not None: 
+                    rows[id_num] = parsed[0]
+                    links.extend(parsed[1])
+            frames[table] = patch_frame(frames[table], rows, gone)
+        return frames, patch_edges(edgesDf, links, touched)
+    
+    def update_frames(self, WsDf, AsDf): 
+        """This function re-parses only the agent and work pages the last incremental crawl found 
+        new or changed, patches those rows into WsDf and AsDf, and drops rows for gone pages"""
+        
+        frames, _ = self.update_graph({'works': WsDf, 'agents': AsDf})
+        return frames['works'], frames['agents']
+    
+    def run_incremental(self): 
+        """This function re-crawls with conditional requests and patches the frames of every table 
+        and edgesDf (Parquet) with what changed"""
+        
+        tables = [t.strip('/') for t in self.tables if t.strip('/') in table_specs]
+        frames = {t: read_frame(frame_names[t]) if os.path.exists(frame_names[t] + '.parquet') else pd.DataFrame() for t in tables}
+        edgesDf = read_frame('edgesDf') if os.path.exists('edgesDf.parquet') else None
+        
+        logging.info(f"Checking all tables for changes")
+        self.get_html()
+        logging.info(f"Pages since the last crawl: {self.report}")
+        print(f"Pages since the last crawl: {self.report}")
+        
+        with self.metrics.timer('parse'): 
+            frames, edgesDf = self.update_graph(frames, edgesDf)
+        
+        logging.info(f"Writing to parquet")
+        with self.metrics.timer('write'): 
+            write_graph(frames, edgesDf)
+        logging.info(f"Done writing to parquet")
+        self.metrics.dump()
+    
+    def stream(self, path='.', batch_size=256): 
+        """This function crawls every table, parsing each page as it arrives and handing its row and links 
+        to a PartWriter, so memory holds at most batch_size parsed pages whatever the size of the tables. 
+        Pages already in committed batches under path (from a crawl that stopped part way) aren't fetched 
+        again, and pages that crawl got but never committed are parsed from the store. Ends by merging the 
+        parts into the frames (sorted by id) and edgesDf (Parquet) and returns their names""" 
+        
+        if self.incremental: 
+            raise ValueError("Incremental crawls patch the existing frames, they can't be streamed")
+        self.sink = PartWriter(path, batch_size)
+        if self.discover: 
+            self.tables = discover_tables(self.domain, self.tables, headers=self.headers)
+        plan = [(t, i) for t, i in crawl_plan(self.tables) if t in table_specs and (t, i) not in self.sink.done]
+        logging.info(f"Streaming {len(plan)} pages, {len(self.sink.done)} already written")
+        try: 
+            self.get_html(plan)
+            # the journal has these done, but the crawl that got them stopped before their batch was committed
+            with self.metrics.timer('parse'): 
+                for t, i in self.resumed: 
+                    body = self.store.get(t, i)
+                    if body is None: 
+                        continue
+                    parsed = self.parse(t, i, body)
+                    if parsed is None: 
+                        self.aberrant.append((t, i, 'parse error'))
+                    else: 
+                        self.sink.add(t, i, *parsed)
+        finally: 
+            # whatever was parsed before a failure still gets written
+            self.sink.flush()
+        with self.metrics.timer('write'): 
+            merged = self.sink.close()
+        self.sink = None
+        self.metrics.dump()
+        return merged
+    
+    def run(self): 
+        """This function crawls every table, parses every page with its table's spec, creates DataFrames 
+        and the edge table, and persists them (Parquet). Stage and page timings end up in maprr_metrics.json/.prom"""
+        
+        logging.info(f"Getting all tables")
+        self.get_html()
+        logging.info(f"Done getting all tables")
+        
+        tables = [t.strip('/') for t in self.tables if t.strip('/') in table_specs]
+        logging.info(f"Parsing {tables}")
+        with self.metrics.timer('parse'): 
+            for table, id_num, body in self.iter_pages(tables): 
+                parsed = self.parse(table, id_num, body)
+                if parsed is None: 
+                    self.aberrant.append((table, id_num, 'parse error'))
+                    continue
+                self.entities.setdefault(table, {})[id_num] = parsed[0]
+                self.links.extend(parsed[1])
+        self.As = self.entities.get('agents', {})
+        self.Ws = self.entities.get('works', {})
+        logging.info(f"Done parsing {tables}")
+        
+        logging.info(f"Making dataframes")
+        with self.metrics.timer('build'): 
+            frames = {t: pd.DataFrame.from_dict(self.entities.get(t, {}), orient='index') for t in tables}
+            edgesDf = edge_frame(self.links)
+        logging.info(f"Done making dataframes")
+        
+        logging.info(f"Writing to parquet")
+        with self.metrics.timer('write'): 
+            write_graph(frames, edgesDf)
+        logging.info(f"Done writing to parquet")
+        self.metrics.dump()
+
+# lines inside a stanza are separated by the run of spaces left where each <br/> was
+line_break = r' {15,}'
+
+def split_list(arr, pattern=None): 
+    """This function splits every string of the arrow array arr on whitespace (or the regex pattern) and 
+    returns the flat pieces, the position of each piece's parent in arr, and its position inside the parent"""
+    
+    pieces = pc.utf8_split_whitespace(arr) if pattern is None else pc.split_pattern_regex(arr, pattern)
+    parents = pc.list_parent_indices(pieces).to_numpy()
+    offsets = pieces.offsets.to_numpy()
+    return pc.list_flatten(pieces), parents, np.arange(len(parents)) - offsets[parents]
+
+def stanza_array(WsDf): 
+    """This function flattens WsDf.text into an arrow array of stanzas with their w_id and stanza numbers"""
+    
+    stanzas = WsDf.text.explode().dropna()
+    arr = pc.utf8_trim_whitespace(pa.array(stanzas.values, pa.string()))
+    return arr, stanzas.index.to_numpy(), stanzas.groupby(level=0).cumcount().to_numpy()
+
+def explode_text(WsDf, level='token'): 
+    """This function turns the text column of WsDf into a long frame with one row per stanza, line or 
+    token (level), indexed by the OHCO levels down to it, using arrow string kernels instead of apply"""
+    
+    arr, w_id, stanza = stanza_array(WsDf)
+    levels = [w_id, stanza]
+    for name, pattern in (('line', line_break), ('token', None)): 
+        if len(levels) > OHCO.index(level): 
+            break
+        arr, parents, positions = split_list(arr, pattern)
+        keep = pc.not_equal(arr, '').to_numpy(zero_copy_only=False)
+        arr, parents, positions = arr.filter(keep), parents[keep], positions[keep]
+        levels = [l[parents] for l in levels] + [positions]
+    index = pd.MultiIndex.from_arrays(levels, names=OHCO[:len(levels)])
+    return pd.DataFrame({'str': arr.to_pandas()}).set_index(index)
+
+def work_counts(WsDf): 
+    """This function counts stanzas/paragraphs (num_lps), lines and words of every work in WsDf in bulk. 
+    A word is a whitespace-delimited token made only of letters, as in the notebook's isalpha() count. 
+    Splitting every stanza into tokens is most of the cost, so this takes about as long as the notebook's 
+    num_words lambda (see bench_text), with lines and stanzas counted as well"""
+    
+    arr, w_id, _ = stanza_array(WsDf)
+    tokens, parents, _ = split_list(arr)
+    words = np.bincount(parents, weights=pc.utf8_is_alpha(tokens).to_numpy(zero_copy_only=False), minlength=len(arr))
+    counts = pd.DataFrame({
+        'num_lps': 1, 
+        'num_lines': pc.count_substring_regex(arr, line_break).to_numpy() + (pc.utf8_length(arr).to_numpy() > 0), 
+        'num_words': words.astype('int64')}, index=w_id).groupby(level=0).sum()
+    return counts.reindex(WsDf.index, fill_value=0).rename_axis('w_id')
+
+def author_summary(WsDf, AsDf, counts=None, graph=None): 
+    """This function builds authorsDf: works, words and average words per work for every author, alongside 
+    their row of AsDf and sorted by avg_wpw. Works are tied to agents by graph, an EntityGraph, which is 
+    built from the frames by author name if not given. As in the notebook's right merge, authors are kept 
+    when AsDf has no row for them: agents of the graph with NaN agent fields, and authors of works tied to 
+    no agent by their name, with no a_id"""
+    
+    counts = work_counts(WsDf) if counts is None else counts
+    graph = EntityGraph().build(WsDf=WsDf, AsDf=AsDf) if graph is None else graph
+    num_works = graph.degrees('author_works')
+    authors = pd.DataFrame({'num_works': num_works, 'num_words': graph.sums('author_works', counts.num_words).astype('int64')})
+    authors = authors[authors.num_works > 0]
+    authorsDf = AsDf.rename_axis('a_id').join(authors, how='right')
+    authorsDf.index = authorsDf.index.astype('Int64')
+    # works no agent is tied to are summed by their author's name
+    works = WsDf.rename(columns=lambda k: tidy_name('works', k))
+    untied = graph.degrees('work_authors').reindex(works.index, fill_value=0) == 0
+    if 'author' in works and untied.any(): 
+        words = counts.num_words.reindex(works.index, fill_value=0)[untied]
+        others = words.groupby(works.author[untied]).agg(['size', 'sum']).rename(columns={'size': 'num_works', 'sum': 'num_words'})
+        others = others.rename_axis('name').reset_index().set_index(pd.Index([pd.NA]*len(others), dtype='Int64', name='a_id'))
+        authorsDf = pd.concat([authorsDf, others.astype({'num_words': 'int64'})])
+    authorsDf['avg_wpw'] = (authorsDf.num_words/authorsDf.num_works).round(2)
+    return authorsDf.sort_values('avg_wpw', ascending=False, kind='stable')
+
+class LemmaCache: 
+    """Lemmas keyed by (surface form, pos, feats): a bounded LRU in memory in front of an sqlite table 
+    that persists across runs and is shared by every NLP worker process"""
+    
+    def __init__(self, path='lemmas.sqlite', size=200000): 
+        self.path = path
+        # most lemmas kept in memory at once
+        self.size = size
+        self.memory = OrderedDict()
+        # lemmas computed since the last flush, waiting to be written to disk
+        self.pending = []
+        self.db = sqlite3.connect(path, timeout=60)
+        # several worker processes read and write the same file
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS lemmas (form TEXT, pos TEXT, feats TEXT, lemma TEXT, PRIMARY KEY (form, pos, feats))')
+        self.db.commit()
+        self.stats = {'memory': 0, 'disk': 0, 'miss': 0}
+    
+    def remember(self, key, lemma): 
+        self.memory[key] = lemma
+        if len(self.memory) > self.size: 
+            self.memory.popitem(last=False)
+    
+    def lemmatize(self, form, pos, feats, compute): 
+        """This function returns the lemma of form with the given tags, calling compute() only if it has never been seen"""
+        
+        key = (form, pos or '', feats)
+        lemma = self.memory.get(key)
+        if lemma is not None: 
+            self.memory.move_to_end(key)
+            self.stats['memory'] += 1
+            return lemma
+        row = self.db.execute('SELECT lemma FROM lemmas WHERE form = ? AND pos = ? AND feats = ?', key).fetchone()
+        if row is not None: 
+            self.stats['disk'] += 1
+            lemma = row[0]
+        else: 
+            self.stats['miss'] += 1
+            lemma = compute()
+            self.pending.append(key + (lemma,))
+        self.remember(key, lemma)
+        return lemma
+    
+    def flush(self): 
+        """This function writes the lemmas computed since the last flush to disk"""
+        
+        if self.pending: 
+            self.db.executemany('INSERT OR IGNORE INTO lemmas VALUES (?, ?, ?, ?)', self.pending)
+            self.db.commit()
+            self.pending = []
+    
+    def take_stats(self): 
+        """This function returns the hit counters since the last call and resets them"""
+        
+        stats, self.stats = self.stats, dict.fromkeys(self.stats, 0)
+        return stats
+
+def hit_rate(stats): 
+    """This function returns the share of lookups answered from memory or disk"""
+    
+    total = sum(stats.values())
+    return (stats['memory'] + stats['disk'])/total if total else 0.0
+
+# natasha models for this process, loaded once by nlp_init
+nlp_models = {}
+# where LemmaCache keeps lemmas between runs
+lemma_cache_path = 'lemmas.sqlite'
+
+# columns of the token table, one row per token of every stanza
+token_cols = ['w_id', 'stanza', 'sent', 'tok', 'start', 'stop', 'token', 'lemma', 'pos', 'feats', 'head', 'rel', 'ner']
+
+def nlp_init(cache_path=None): 
+    """This function loads the natasha embeddings, taggers and parser into this process the first time 
+    it's called. Process pools run it as their initializer so each worker pays the load once. The lemma 
+    cache is opened at cache_path, or kept as it is when no path is given (lemma_cache_path if none is open)"""
+    
+    if not nlp_models: 
+        emb = natasha.NewsEmbedding()
+        nlp_models.update({
+            'segmenter': natasha.Segmenter(), 
+            'morph_vocab': natasha.MorphVocab(), 
+            'morph': natasha.NewsMorphTagger(emb), 
+            'syntax': natasha.NewsSyntaxParser(emb), 
+            'ner': natasha.NewsNERTagger(emb)})
+    if cache_path is None and 'lemmas' not in nlp_models: 
+        cache_path = lemma_cache_path
+    if cache_path is not None and ('lemmas' not in nlp_models or nlp_models['lemmas'].path != cache_path): 
+        nlp_models['lemmas'] = LemmaCache(cache_path)
+    return nlp_models
+
+def format_feats(feats): 
+    return '|'.join(f"{k}={feats[k]}" for k in sorted(feats)) if feats else ''
+
+def nlp_batch(batch): 
+    """This function runs morphology, syntax and NER over a batch of (w_id, stanza, text) stanzas and 
+    returns one token_cols tuple per token along with the lemma cache counters. All sentences of the 
+    batch go through each model together"""
+    
+    m = nlp_init()
+    lemmas = m['lemmas']
+    docs = []
+    for w_id, stanza, text in batch: 
+        doc = natasha.Doc(text)
+        doc.segment(m['segmenter'])
+        docs.append(doc)
+    sents = [sent for doc in docs for sent in doc.sents]
+    words = [[t.text for t in sent.tokens] for sent in sents]
+    for sent, markup in zip(sents, m['morph'].map(words)): 
+        for token, tagged in zip(sent.tokens, markup.tokens): 
+            token.pos, token.feats = tagged.pos, tagged.feats
+    for sent, markup in zip(sents, m['syntax'].map(words)): 
+        for token, parsed in zip(sent.tokens, markup.tokens): 
+            token.id, token.head_id, token.rel = parsed.id, parsed.head_id, parsed.rel
+    spans = m['ner'].map([doc.text for doc in docs])
+    
+    rows = []
+    for (w_id, stanza, _), doc, markup in zip(batch, docs, spans): 
+        for sent_no, sent in enumerate(doc.sents): 
+            for token in sent.tokens: 
+                # token and span offsets are both into the stanza text
+                start, stop = token.start, token.stop
+                ner = next((span.type for span in markup.spans if span.start <= start and stop <= span.stop), None)
+                feats = format_feats(token.feats)
+                lemma = lemmas.lemmatize(token.text, token.pos, feats, lambda: m['morph_vocab'].lemmatize(token.text, token.pos, token.feats))
+                rows.append((w_id, stanza, sent_no, int(token.id), start, stop, token.text, lemma, 
+                             token.pos, feats, int(token.head_id), token.rel, ner))
+    lemmas.flush()
+    return rows, lemmas.take_stats()
+
+def nlp_tokens(WsDf, procs=max_procs, batch_size=64, path=None, cache_path=None): 
+    """This function tokenizes, tags, parses and lemmatizes every stanza in WsDf.text and returns the 
+    token table, keyed by work id and stanza number, optionally writing it to path as Parquet. 
+    The lemma cache's hit counters end up in tokensDf.attrs['lemma_cache']"""
+    
+    # explode takes any list-like, the lists of a CSV frame and the arrays read_frame gives alike
+    texts = WsDf.text.explode().dropna()
+    stanzas = list(zip(texts.index, texts.groupby(level=0).cumcount(), texts))
+    batches = [stanzas[i:i+batch_size] for i in range(0, len(stanzas), batch_size)]
+    logging.info(f"Tagging {len(stanzas)} stanzas in {len(batches)} batches on {procs} processes")
+    # nlp_batch keeps whichever cache nlp_init opened, so the default is settled here
+    cache_path = cache_path or lemma_cache_path
+    if procs == 1: 
+        nlp_init(cache_path)
+        results = list(map(nlp_batch, batches))
+    else: 
+        with concurrent.futures.ProcessPoolExecutor(max_workers=procs, initializer=nlp_init, initargs=(cache_path,)) as executor: 
+            results = list(executor.map(nlp_batch, batches))
+    tokensDf = pd.DataFrame(list(itertools.chain.from_iterable(rows for rows, _ in results)), columns=token_cols)
+    for col in ('pos', 'rel', 'ner'): 
+        tokensDf[col] = tokensDf[col].astype('category')
+    stats = {k: sum(s[k] for _, s in results) for k in ('memory', 'disk', 'miss')}
+    stats['hit_rate'] = hit_rate(stats)
+    tokensDf.attrs['lemma_cache'] = stats
+    logging.info(f"Lemma cache: {stats}")
+    if path is not None: 
+        tokensDf.to_parquet(path, index=False, compression='zstd')
+    return tokensDf
+
+def update_tokens(tokensDf, WsDf, w_ids, **kwargs): 
+    """This function re-analyses only the works in w_ids, e.g. the ones an incremental crawl changed, 
+    and swaps their rows into tokensDf. Works in w_ids missing from WsDf are dropped"""
+    
+    w_ids = set(w_ids)
+    fresh = nlp_tokens(WsDf[WsDf.index.isin(w_ids)], **kwargs)
+    kept = tokensDf[~tokensDf.w_id.isin(w_ids)]
+    updated = pd.concat([kept, fresh], ignore_index=True).sort_values(['w_id', 'stanza', 'sent', 'tok'], ignore_index=True)
+    for col in ('pos', 'rel', 'ner'): 
+        updated[col] = updated[col].astype('category')
+    updated.attrs['lemma_cache'] = fresh.attrs['lemma_cache']
+    return updated
+
+# bits of a posting key: w_id << 32 | stanza << 20 | offset, so keys sort by work, stanza, then position
+stanza_shift = 20
+w_id_shift = 32
+# arrays of a TextIndex, one .npy file each
+index_files = ('lemmas', 'starts', 'postings', 'forms', 'form_lemmas', 'stanzas')
+
+def posting_keys(w_id, stanza, offset): 
+    """This function packs (w_id, stanza, offset) into posting keys, raising ValueError for a value too big for its bits"""
+    
+    for name, values, bits in (('w_id', w_id, 63 - w_id_shift), ('stanza', stanza, w_id_shift - stanza_shift), ('offset', offset, stanza_shift)): 
+        values = np.asarray(values, 'int64')
+        if values.size and (values.min() < 0 or values.max() >= 1 << bits): 
+            raise ValueError(f"A posting key holds a {name} in {bits} bits, {values.max()} doesn't fit")
+    return (np.asarray(w_id, 'int64') << w_id_shift) | (np.asarray(stanza, 'int64') << stanza_shift) | np.asarray(offset, 'int64')
+
+def index_postings(tokensDf): 
+    """This function turns the token table from nlp_tokens into (lemma, form, key) postings, skipping punctuation. 
+    Offsets count words within the stanza, so a phrase can run over a comma. Works of 4096 stanzas or more, or 
+    stanzas of 2**20 words or more, don't fit a posting key and raise ValueError"""
+    
+    words = tokensDf[tokensDf.pos != 'PUNCT'].sort_values(['w_id', 'stanza', 'sent', 'tok'])
+    offset = words.groupby(['w_id', 'stanza']).cumcount()
+    return pd.DataFrame({
+        'lemma': words.lemma.str.lower().to_numpy(), 
+        'form': words.token.str.lower().to_numpy(), 
+        'key': posting_keys(words.w_id, words.stanza, offset)})
+
+def sorted_in(a, b): 
+    """This function tells, for each key of the sorted array a, whether it's in the sorted array b, by binary search"""
+    
+    i = np.searchsorted(b, a)
+    found = i < len(b)
+    found[found] = b[i[found]] == a[found]
+    return found
+
+def form_lemmas(postings): 
+    """This function maps each word form in postings to the lemma it's most often tagged with"""
+    
+    forms = postings.groupby(['form', 'lemma']).size().sort_values(ascending=False, kind='stable').reset_index()
+    return forms.drop_duplicates('form')[['form', 'lemma']]
+
+class TextIndex: 
+    """On-disk inverted index of the works' stanzas. Postings are keyed by lemma and hold (w_id, stanza, offset) 
+    packed into one int64, sorted per lemma. The arrays are .npy files loaded memory-mapped, so opening an index 
+    costs milliseconds whatever its size and queries only touch the postings they need. Each write goes to a 
+    new version folder under path, and the CURRENT file names the one readers load"""
+    
+    def __init__(self, path='textindex'): 
+        self.path = path
+        self.load()
+    
+    def version_path(self): 
+        """This function returns the folder of the current version of the index, or None if there's none yet. 
+        Indexes written before versions hold their files in path itself"""
+        
+        try: 
+            with open(os.path.join(self.path, 'CURRENT')) as f: 
+                return os.path.join(self.path, f.read().strip())
+        except FileNotFoundError: 
+            return self.path if os.path.exists(os.path.join(self.path, 'postings.npy')) else None
+    
+    def load(self): 
+        """This function memory-maps the current version of the index at self.path, or starts an empty one if there's none yet"""
+        
+        folder = self.version_path()
+        if folder is not None: 
+            for name in index_files: 
+                setattr(self, name, np.load(os.path.join(folder, name + '.npy'), mmap_mode='r'))
+        else: 
+            self.lemmas, self.forms = np.array([], 'U1'), np.array([], 'U1')
+            self.starts = np.zeros(1, 'int64')
+            self.postings, self.form_lemmas, self.stanzas = (np.array([], 'int64') for _ in range(3))
+    
+    def write(self, postings, forms): 
+        """This function writes the index for a postings frame (lemma, key) and a forms frame (form, lemma) as a new 
+        version, then reloads it. Readers are switched over by replacing the CURRENT file in one rename, so they 
+        load either the old version or the new one, never half of either. The version before stays for readers 
+        still opening it, older ones are removed"""
+        
+        postings = postings.sort_values(['lemma', 'key'], kind='stable')
+        lemmas, counts = np.unique(postings.lemma.to_numpy().astype(str), return_counts=True)
+        forms = forms[forms.lemma.isin(lemmas)].sort_values('form')
+        arrays = {
+            'lemmas': lemmas, 
+            'starts': np.concatenate([[0], np.cumsum(counts)]).astype('int64'), 
+            'postings': postings.key.to_numpy('int64'), 
+            'forms': forms.form.to_numpy().astype(str), 
+            'form_lemmas': np.searchsorted(lemmas, forms.lemma.to_numpy().astype(str)).astype('int32'), 
+            'stanzas': np.unique(postings.key.to_numpy('int64') >> stanza_shift)}
+        os.makedirs(self.path, exist_ok=True)
+        versions = sorted(v for v in os.listdir(self.path) if re.fullmatch(r'v\d+', v))
+        version = f"v{int(versions[-1][1:]) + 1 if versions else 1:06d}"
+        tmp = os.path.join(self.path, version + '.tmp')
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        for name, arr in arrays.items(): 
+            np.save(os.path.join(tmp, name + '.npy'), arr)
+        os.replace(tmp, os.path.join(self.path, version))
+        previous = self.version_path()
+        with open(os.path.join(self.path, 'CURRENT.tmp'), 'w') as f: 
+            f.write(version)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(os.path.join(self.path, 'CURRENT.tmp'), os.path.join(self.path, 'CURRENT'))
+        keep = {version, os.path.basename(previous) if previous is not None else None}
+        for old in versions: 
+            if old not in keep: 
+                shutil.rmtree(os.path.join(self.path, old), ignore_errors=True)
+        if previous == self.path: 
+            # an index from before versions, its files are superseded now
+            for name in index_files: 
+                os.remove(os.path.join(self.path, name + '.npy'))
+        self.load()
+        logging.info(f"Indexed {len(arrays['postings'])} words, {len(lemmas)} lemmas in {len(arrays['stanzas'])} stanzas")
+    
+    def build(self, tokensDf): 
+        """This function indexes every word of the token table from scratch"""
+        
+        postings = index_postings(tokensDf)
+        self.write(postings, form_lemmas(postings))
+    
+    def update(self, tokensDf, w_ids): 
+        """This function re-indexes only the works in w_ids, taking their words from tokensDf (which may hold 
+        just those works, e.g. from update_tokens). Works in w_ids with no tokens are dropped from the index"""
+        
+        w_ids = np.fromiter(set(w_ids), 'int64')
+        lemmas = np.asarray(self.lemmas)
+        old = pd.DataFrame({'lemma': lemmas[np.repeat(np.arange(len(lemmas)), np.diff(self.starts))], 'key': np.asarray(self.postings)})
+        old = old[~np.isin(old.key.to_numpy() >> w_id_shift, w_ids)]
+        fresh = index_postings(tokensDf[tokensDf.w_id.isin(w_ids)])
+        forms = form_lemmas(fresh)
+        # forms seen before keep their lemma unless the new works tag them otherwise
+        known = pd.DataFrame({'form': np.asarray(self.forms), 'lemma': lemmas[np.asarray(self.form_lemmas)]})
+        forms = pd.concat([known[~known.form.isin(forms.form)], forms], ignore_index=True)
+        self.write(pd.concat([old, fresh[['lemma', 'key']]], ignore_index=True), forms)
+    
+    def lemma_id(self, term): 
+        """This function finds the lemma a query term stands for: the lemma of the word form if the corpus has it, 
+        otherwise the term itself read as a lemma. It returns -1 for unknown terms"""
+        
+        term = term.lower()
+        i = np.searchsorted(self.forms, term)
+        if i < len(self.forms) and self.forms[i] == term: 
+            return int(self.form_lemmas[i])
+        i = np.searchsorted(self.lemmas, term)
+        return int(i) if i < len(self.lemmas) and self.lemmas[i] == term else -1
+    
+    def postings_of(self, term): 
+        i = self.lemma_id(term)
+        return self.postings[self.starts[i]:self.starts[i+1]] if i >= 0 else self.postings[:0]
+    
+    def stanzas_of(self, term): 
+        """This function returns the sorted stanza keys, a posting key shifted right by stanza_shift, containing term"""
+        
+        keys = self.postings_of(term) >> stanza_shift
+        return keys[np.concatenate([[True], keys[1:] != keys[:-1]])] if len(keys) else keys
+    
+    def phrase(self, terms): 
+        """This function returns the stanza keys where terms occur one right after the other"""
+        
+        hits = np.asarray(self.postings_of(terms[0]))
+        for term in terms[1:]: 
+            hits = hits + 1
+            hits = hits[sorted_in(hits, self.postings_of(term))]
+        return np.unique(hits >> stanza_shift)
+    
+    def search(self, query): 
+        """This function answers a query and returns the matching (w_id, stanza) pairs. A query is words and 
+        "quoted phrases" combined with AND (or just a space), OR, NOT and parentheses, e.g. 
+        'мак AND (дом OR "тихо в доме") NOT ночь'. Words match any form of their lemma"""
+        
+        keys = self.evaluate(query)
+        return list(zip((keys >> (w_id_shift - stanza_shift)).tolist(), (keys & (1 << (w_id_shift - stanza_shift)) - 1).tolist()))
+    
+    def works(self, query): 
+        """This function returns the sorted ids of the works with a stanza matching query"""
+        
+        return np.unique(self.evaluate(query) >> (w_id_shift - stanza_shift)).tolist()
+    
+    def evaluate(self, query): 
+        tokens = re.findall(r'"[^"]*"|\(|\)|[^\s()"]+', query)
+        keys, rest = self.parse_or(tokens)
+        if rest: 
+            raise ValueError(f"Can't parse query {query!r} at {' '.join(rest)!r}")
+        return keys
+    
+    def parse_or(self, tokens): 
+        keys, tokens = self.parse_and(tokens)
+        while tokens and tokens[0] == 'OR': 
+            other, tokens = self.parse_and(tokens[1:])
+            keys = np.union1d(keys, other)
+        return keys, tokens
+    
+    def parse_and(self, tokens): 
+        keys, tokens = self.parse_not(tokens)
+        while tokens and tokens[0] not in ('OR', ')'): 
+            negate = tokens[0] == 'NOT'
+            other, tokens = self.parse_not(tokens[1:] if tokens[0] in ('AND', 'NOT') else tokens)
+            found = sorted_in(keys, other)
+            keys = keys[~found if negate else found]
+        return keys, tokens
+    
+    def parse_not(self, tokens): 
+        if not tokens: 
+            raise ValueError("Query ends where a word was expected")
+        head, tokens = tokens[0], tokens[1:]
+        if head == 'NOT': 
+            keys, tokens = self.parse_not(tokens)
+            stanzas = np.asarray(self.stanzas)
+            return stanzas[~sorted_in(stanzas, keys)], tokens
+        if head == '(': 
+            keys, tokens = self.parse_or(tokens)
+            if not tokens or tokens[0] != ')': 
+                raise ValueError("Unbalanced parenthesis in query")
+            return keys, tokens[1:]
+        if head.startswith('"'): 
+            words = re.findall(r'\w+', head)
+            return (self.phrase(words) if words else self.stanzas[:0]), tokens
+        return np.asarray(self.stanzas_of(head)), tokens
+    
+    def __len__(self): 
+        return len(self.lemmas)
+    
+    def __contains__(self, term): 
+        return self.lemma_id(term) >= 0
+
+# tables an EntityGraph interns, in the order their nodes are numbered
+graph_tables = ['agents', 'works', 'locations', 'place_based_concepts', 'multivalent_markers']
+# adjacency kept by an EntityGraph: name -> (from table, to table, edge rels read forwards, edge rels read backwards)
+graph_relations = {
+    'author_works': ('agents', 'works', ['authored'], ['author']), 
+    'work_authors': ('works', 'agents', ['author'], ['authored']), 
+    'work_locations': ('works', 'locations', ['composition_location', 'mentions'], ['appears_in']), 
+    'location_works': ('locations', 'works', ['appears_in'], ['composition_location', 'mentions']), 
+}
+
+def name_key(name): 
+    """This function normalizes a name for matching: collapsed whitespace, casefolded, one kind of apostrophe"""
+    
+    return re.sub(r"[’ʼʹ`]", "'", ' '.join(str(name).split())).casefold()
+
+class EntityGraph: 
+    """Agents, works and the other entities interned as dense integer nodes, with CSR adjacency 
+    (indptr/indices NumPy arrays) for each relation in graph_relations. Saved as a single file 
+    of aligned arrays that loads memory-mapped"""
+    
+    def __init__(self, path=None): 
+        self.path = path
+        self.arrays = {}
+        if path is not None and os.path.exists(path): 
+            self.load(path)
+    
+    def build(self, edgesDf=None, WsDf=None, AsDf=None): 
+        """This function interns every entity of edgesDf and of the frames, then builds the adjacency. 
+        Without edgesDf, works are tied to agents by matching WsDf.author to AsDf.name (see name_key)"""
+        
+        if edgesDf is None: 
+            edgesDf = author_edges(WsDf, AsDf)
+        src = edgesDf.src.astype(object).to_numpy()
+        dst = edgesDf.dst.astype(object).to_numpy()
+        ids = []
+        for table in graph_tables: 
+            found = [edgesDf.src_id.to_numpy()[src == table], edgesDf.dst_id.to_numpy()[dst == table]]
+            frame = {'works': WsDf, 'agents': AsDf}.get(table)
+            if frame is not None: 
+                found.append(frame.index.to_numpy())
+            ids.append(np.unique(np.concatenate(found).astype('int32')))
+        self.arrays = {
+            'ids': np.concatenate(ids), 
+            'starts': np.concatenate([[0], np.cumsum([len(i) for i in ids])]).astype('int64')}
+        self.index()
+        rel = edgesDf.rel.astype(object).to_numpy()
+        for name, (frm, to, forwards, backwards) in graph_relations.items(): 
+            ahead = (src == frm) & (dst == to) & np.isin(rel, forwards)
+            behind = (src == to) & (dst == frm) & np.isin(rel, backwards)
+            pairs = np.unique(np.stack([
+                np.concatenate([self.local(frm, edgesDf.src_id.to_numpy()[ahead]), self.local(frm, edgesDf.dst_id.to_numpy()[behind])]), 
+                np.concatenate([self.local(to, edgesDf.dst_id.to_numpy()[ahead]), self.local(to, edgesDf.src_id.to_numpy()[behind])])], 1), axis=0)
+            counts = np.bincount(pairs[:, 0], minlength=self.size(frm))
+            self.arrays[name + '.indptr'] = np.concatenate([[0], np.cumsum(counts)]).astype('int64')
+            self.arrays[name + '.indices'] = pairs[:, 1].astype('int32')
+        self.index()
+        logging.info(f"Graph of {len(self.arrays['ids'])} entities: " + ', '.join(f"{n} {len(self.arrays[n + '.indices'])}" for n in graph_relations))
+        return self
+    
+    def save(self, path=None): 
+        """This function writes every array into one file: a JSON header of names, dtypes, shapes and 
+        offsets, then the arrays, each aligned to 64 bytes so it can be memory-mapped in place"""
+        
+        path = path or self.path
+        header, offset = {}, 0
+        for name, arr in self.arrays.items(): 
+            header[name] = [arr.dtype.str, list(arr.shape), offset]
+            offset += -(-arr.nbytes // 64) * 64
+        head = json.dumps(header).encode('utf-8')
+        head += b' ' * (-(len(head) + 8) % 64)
+        with open(path + '.tmp', 'wb') as f: 
+            f.write(len(head).to_bytes(8, 'little') + head)
+            for arr in self.arrays.values(): 
+                f.write(np.ascontiguousarray(arr).tobytes())
+                f.write(b'\0' * (-arr.nbytes % 64))
+        os.replace(path + '.tmp', path)
+        self.path = path
+    
+    def load(self, path): 
+        """This function memory-maps the arrays of a saved graph"""
+        
+        with open(path, 'rb') as f: 
+            size = int.from_bytes(f.read(8), 'little')
+            header = json.loads(f.read(size))
+            # plain arrays over the mapping, np.memmap slices cost more per query
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.arrays = {name: np.frombuffer(self.buffer, dtype, int(np.prod(shape)), 8 + size + offset).reshape(shape) 
+                       for name, (dtype, shape, offset) in header.items()}
+        self.path = path
+        self.index()
+    
+    def index(self): 
+        """This function slices the ids of each table out once, so queries don't"""
+        
+        starts = self.arrays['starts'].tolist()
+        self.table_ids = {t: self.arrays['ids'][starts[i]:starts[i+1]] for i, t in enumerate(graph_tables)}
+    
+    def size(self, table): 
+        return len(self.table_ids[table])
+    
+    def ids(self, table): 
+        """This function returns the entity ids of table, in node order"""
+        
+        return self.table_ids[table]
+    
+    def local(self, table, id_nums): 
+        """This function turns entity ids of table (one or an array) into its node numbers, raising KeyError for unknown ids"""
+        
+        ids = self.table_ids[table]
+        found = ids.searchsorted(id_nums)
+        if np.ndim(found) == 0: 
+            if found >= len(ids) or ids[found] != id_nums: 
+                raise KeyError(f"{table} {id_nums} not in the graph")
+        elif np.any(found >= len(ids)) or np.any(ids[np.minimum(found, len(ids)-1)] != id_nums): 
+            raise KeyError(f"{table} {id_nums} not in the graph")
+        return found
+    
+    def neighbours(self, relation, id_num): 
+        """This function returns the ids the entity id_num links to in relation, e.g. the works of an agent for 'author_works'"""
+        
+        frm, to = graph_relations[relation][:2]
+        i = self.local(frm, id_num)
+        indptr = self.arrays[relation + '.indptr']
+        return self.table_ids[to][self.arrays[relation + '.indices'][indptr[i]:indptr[i+1]]]
+    
+    def degree(self, relation, id_num): 
+        """This function returns how many entities id_num links to in relation"""
+        
+        indptr = self.arrays[relation + '.indptr']
+        i = self.local(graph_relations[relation][0], id_num)
+        return int(indptr[i+1] - indptr[i])
+    
+    def degrees(self, relation): 
+        """This function returns the degree of every entity in relation's from table as a Series indexed by id"""
+        
+        frm = graph_relations[relation][0]
+        return pd.Series(np.diff(self.arrays[relation + '.indptr']), index=pd.Index(self.ids(frm), name=id_cols[frm]), name=relation)
+    
+    def sums(self, relation, values): 
+        """This function sums values (a Series indexed by the to table's ids) over each entity's neighbours in relation"""
+        
+        frm, to = graph_relations[relation][:2]
+        weights = values.reindex(self.ids(to), fill_value=0).to_numpy('float64')
+        indptr = self.arrays[relation + '.indptr']
+        rows = np.repeat(np.arange(len(indptr)-1), np.diff(indptr))
+        totals = np.bincount(rows, weights=weights[self.arrays[relation + '.indices']], minlength=len(indptr)-1)
+        return pd.Series(totals, index=pd.Index(self.ids(frm), name=id_cols[frm]))
+    
+    def __len__(self): 
+        return len(self.arrays.get('ids', ()))
+
+def author_edges(WsDf, AsDf): 
+    """This function makes 'author' edges from works to agents by matching WsDf.author to AsDf.name, for 
+    frames crawled without an edge table. Names are compared with name_key and a name shared by several 
+    agents goes to the lowest id. Authors with no agent are left out"""
+    
+    works = WsDf.rename(columns=lambda k: tidy_name('works', k))
+    agents = pd.Series(AsDf.index.to_numpy(), index=AsDf.name.map(name_key)).sort_values()
+    agents = agents[~agents.index.duplicated()]
+    a_ids = works.author.map(name_key).map(agents)
+    if a_ids.isna().any(): 
+        logging.info(f"Authors not in AsDf: {sorted(works.author[a_ids.isna()].unique())}")
+    found = a_ids.notna()
+    return pd.DataFrame({'src': 'works', 'src_id': works.index[found], 'dst': 'agents', 'dst_id': a_ids[found].astype('int64'), 'rel': 'author', 'n': 1})
+
+# characters per shingle and MinHash permutations used by near_duplicates and reprints
+shingle_size = 5
+num_perm = 128
+# shingles hashed per block when signing, a block's hashes take shingle_block * num_perm * 8 bytes
+shingle_block = 1 << 13
+
+def shingle_hashes(arr, k=shingle_size): 
+    """This function hashes the k character shingles of every string in arr, an arrow string array, after 
+    casefolding and reducing punctuation and whitespace to single spaces. It returns the 64 bit hashes and 
+    the position in arr each came from, in order. Strings shorter than k give no shingles"""
+    
+    arr = pc.utf8_trim_whitespace(pc.replace_substring_regex(pc.utf8_lower(arr), r'[^\p{L}\p{N}]+', ' '))
+    lengths = pc.utf8_length(arr).to_numpy(zero_copy_only=False).astype('int64')
+    chars = np.frombuffer(''.join(arr.to_pylist()).encode('utf-32-le'), '<u4').astype('uint64')
+    # polynomial hash of every k characters of the joined text, then only shingles inside one string are kept
+    hashes = np.zeros(max(len(chars) - k + 1, 0), 'uint64')
+    for j in range(k): 
+        hashes = hashes * np.uint64(0x100000001b3) + chars[j:len(chars) - k + 1 + j]
+    parents = np.repeat(np.arange(len(lengths)), lengths)[:len(hashes)]
+    starts = np.concatenate([[0], np.cumsum(lengths)])
+    keep = np.arange(len(hashes)) - starts[parents] <= lengths[parents] - k
+    # splitmix64 finalizer so every bit of the hash depends on every character
+    hashes = hashes[keep]
+    hashes ^= hashes >> np.uint64(30)
+    hashes *= np.uint64(0xbf58476d1ce4e5b9)
+    hashes ^= hashes >> np.uint64(27)
+    hashes *= np.uint64(0x94d049bb133111eb)
+    hashes ^= hashes >> np.uint64(31)
+    return hashes, parents[keep]
+
+def minhash(hashes, parents, size, perms=num_perm, seed=0): 
+    """This function builds the MinHash signature of each of size sets from their shingle hashes (sorted by 
+    parents, as from shingle_hashes): for each of perms random multiply-shift hash functions, the least value 
+    over the set. Two signatures agree in a share of places that estimates the Jaccard similarity of their sets. 
+    Sets with no shingles get all 0xffffffff. Hashes are signed a block at a time so memory stays flat"""
+    
+    rng = np.random.default_rng(seed)
+    mult = rng.integers(0, 1 << 63, perms, 'uint64') * np.uint64(2) + np.uint64(1)
+    add = rng.integers(0, 1 << 63, perms, 'uint64')
+    signatures = np.full((size, perms), 0xffffffff, 'uint32')
+    counts = np.bincount(parents, minlength=size)
+    ends = np.cumsum(counts)
+    first = 0
+    while first < size: 
+        # whole sets per block, at least one
+        last = max(int(np.searchsorted(ends, ends[first] - counts[first] + shingle_block, 'right')), first + 1)
+        lo, hi = ends[first] - counts[first], ends[last-1]
+        # permutations by shingles, so the reduce runs along contiguous rows
+        block = np.multiply(mult[:, None], hashes[None, lo:hi])
+        block += add[:, None]
+        block >>= np.uint64(32)
+        sets = np.flatnonzero(counts[first:last]) + first
+        if len(sets): 
+            signatures[sets] = np.minimum.reduceat(block, ends[sets] - counts[sets] - lo, axis=1).T
+        first = last
+    return signatures
+
+def lsh_bands(threshold, perms=num_perm, recall=.99): 
+    """This function picks the bands and rows per band for LSH over perms values: the most rows (the fewest 
+    false candidates) that still bring a pair at threshold into one bucket with probability recall, 
+    1 - (1 - threshold**rows)**bands. Values past bands * rows are left out of the banding"""
+    
+    rows = max([r for r in range(1, perms + 1) if 1 - (1 - threshold ** r) ** (perms // r) >= recall] or [1])
+    return perms // rows, rows
+
+def similarities(signatures, a, b): 
+    """This function estimates the Jaccard similarity of the sets in rows a and b of signatures"""
+    
+    out = np.empty(len(a), 'float64')
+    for i in range(0, len(a), shingle_block): 
+        out[i:i+shingle_block] = (signatures[a[i:i+shingle_block]] == signatures[b[i:i+shingle_block]]).mean(1)
+    return out
+
+def lsh_pairs(signatures, threshold, valid=None): 
+    """This function finds the pairs of rows of signatures with estimated similarity of at least threshold, as 
+    (a, b, similarity) arrays with a < b. Rows that agree on every value of a band land in one bucket, and each 
+    bucket contributes its members paired with its first one, so the cost grows with the number of rows rather 
+    than with the number of pairs. Pairs are then checked against the whole signature. Rows where valid is 
+    False (no shingles) are left out"""
+    
+    size, perms = signatures.shape
+    bands, rows = lsh_bands(threshold, perms)
+    rows_of = np.arange(size) if valid is None else np.flatnonzero(valid)
+    mult = np.random.default_rng(perms).integers(0, 1 << 63, rows, 'uint64') * np.uint64(2) + np.uint64(1)
+    # one 64 bit key per band, colliding keys that don't agree on the band are weeded out by the check
+    keys = (signatures[rows_of, :bands * rows].reshape(len(rows_of), bands, rows).astype('uint64') * mult).sum(2)
+    found = []
+    for band in range(bands): 
+        order = np.argsort(keys[:, band], kind='stable')
+        sorted_keys = keys[order, band]
+        same = np.concatenate([[False], sorted_keys[1:] == sorted_keys[:-1]])
+        heads = np.maximum.accumulate(np.where(same, 0, np.arange(len(order))))
+        found.append(np.stack([rows_of[order[heads[same]]], rows_of[order[same]]], 1))
+    pairs = np.concatenate(found) if found else np.zeros((0, 2), 'int64')
+    pairs = np.unique(np.sort(pairs, 1), axis=0)
+    scores = similarities(signatures, pairs[:, 0], pairs[:, 1])
+    keep = scores >= threshold
+    return pairs[keep, 0], pairs[keep, 1], scores[keep]
+
+def connected_labels(size, a, b): 
+    """This function labels each of size nodes with the smallest node connected to it by the edges (a, b), hooking 
+    every edge to the smaller label and then jumping pointers until nothing changes"""
+    
+    labels = np.arange(size)
+    while True: 
+        low = np.minimum(labels[a], labels[b])
+        fresh = labels.copy()
+        np.minimum.at(fresh, a, low)
+        np.minimum.at(fresh, b, low)
+        fresh = fresh[fresh]
+        if np.array_equal(fresh, labels): 
+            return labels
+        labels = fresh
+
+def clusters_of(signatures, a, b): 
+    """This function groups the rows linked by the pairs (a, b) into clusters. It returns each row's cluster 
+    (numbered from 0 in order of first row, -1 for rows in no pair), cluster size and estimated similarity to the 
+    cluster's first row, which stands for the cluster"""
+    
+    size = len(signatures)
+    labels = connected_labels(size, a, b)
+    paired = np.zeros(size, bool)
+    paired[a] = paired[b] = True
+    # a cluster's label is its first row, so numbering the labels numbers the clusters in order of first row
+    cluster = np.full(size, -1)
+    cluster[paired] = np.unique(labels[paired], return_inverse=True)[1].reshape(-1)
+    sizes = np.ones(size, 'int64')
+    sizes[paired] = np.bincount(cluster[paired])[cluster[paired]]
+    similarity = np.full(size, np.nan)
+    similarity[paired] = similarities(signatures, np.flatnonzero(paired), labels[paired])
+    return cluster, sizes, similarity
+
+def near_duplicates(WsDf, threshold=.8, k=shingle_size, perms=num_perm, seed=0): 
+    """This function finds near-identical stanzas across WsDf.text, reprints and variants of the same verse, with 
+    MinHash signatures of their k character shingles and LSH banding, in time that grows about linearly with the 
+    number of stanzas. It returns stanzasDf, one row per stanza in a cluster indexed by (w_id, stanza), with its 
+    cluster, size (stanzas), works (distinct works in the cluster), similarity (estimated Jaccard similarity to the 
+    cluster's first stanza) and str, and pairsDf, every linked pair of stanzas with its similarity"""
+    
+    arr, w_id, stanza = stanza_array(WsDf)
+    hashes, parents = shingle_hashes(arr, k)
+    signatures = minhash(hashes, parents, len(arr), perms, seed)
+    valid = np.bincount(parents, minlength=len(arr)) > 0
+    a, b, scores = lsh_pairs(signatures, threshold, valid)
+    cluster, sizes, similarity = clusters_of(signatures, a, b)
+    index = pd.MultiIndex.from_arrays([w_id, stanza], names=OHCO[:2])
+    stanzasDf = pd.DataFrame({
+        'cluster': cluster, 
+        'size': sizes, 
+        'similarity': similarity, 
+        'str': arr.to_numpy(zero_copy_only=False)}, index=index)
+    stanzasDf = stanzasDf[stanzasDf.cluster >= 0]
+    works = stanzasDf.reset_index().groupby('cluster').w_id.nunique()
+    stanzasDf.insert(2, 'works', works.reindex(stanzasDf.cluster).to_numpy())
+    pairsDf = pd.DataFrame({
+        'w_id': w_id[a], 'stanza': stanza[a], 'other_w_id': w_id[b], 'other_stanza': stanza[b], 'similarity': scores})
+    logging.info(f"{len(pairsDf)} near-duplicate stanza pairs in {stanzasDf.cluster.nunique()} clusters of {len(stanzasDf)} stanzas")
+    return stanzasDf.sort_values(['cluster', 'similarity'], ascending=[True, False]), pairsDf
+
+def reprints(WsDf, threshold=.5, stanza_threshold=.8, k=shingle_size, perms=num_perm, seed=0): 
+    """This function finds works that reprint or vary each other. A work's MinHash signature is the least of its 
+    stanzas' signatures, the signature of all its shingles, so near-identical works are found by LSH like stanzas 
+    in near_duplicates. It returns worksDf, one row per work in a cluster indexed by w_id with its cluster, size, 
+    similarity (to the cluster's first work) and shared, the share of its stanzas with a near-duplicate in another 
+    work, which also catches a poem reprinted inside a longer work, and pairsDf of the linked works"""
+    
+    arr, w_id, _ = stanza_array(WsDf)
+    hashes, parents = shingle_hashes(arr, k)
+    # stanzas are in work order, so the shingles of each work are contiguous too
+    work_of, ids = pd.factorize(w_id)
+    work_parents = work_of[parents]
+    signatures = minhash(hashes, work_parents, len(ids), perms, seed)
+    valid = np.bincount(work_parents, minlength=len(ids)) > 0
+    a, b, scores = lsh_pairs(signatures, threshold, valid)
+    cluster, sizes, similarity = clusters_of(signatures, a, b)
+    worksDf = pd.DataFrame({'cluster': cluster, 'size': sizes, 'similarity': similarity}, index=pd.Index(ids, name='w_id'))
+    stanzasDf, _ = near_duplicates(WsDf, stanza_threshold, k, perms, seed)
+    counts = pd.Series(w_id).value_counts()
+    shared = stanzasDf[stanzasDf.works > 1].groupby(level='w_id').size() / counts
+    worksDf['shared'] = shared.reindex(worksDf.index).fillna(0).to_numpy()
+    worksDf = worksDf[(worksDf.cluster >= 0) | (worksDf.shared > 0)]
+    pairsDf = pd.DataFrame({'w_id': ids[a], 'other_w_id': ids[b], 'similarity': scores})
+    logging.info(f"{len(pairsDf)} near-duplicate work pairs, {int((worksDf.shared > 0).sum())} works share stanzas with others")
+    return worksDf.sort_values(['cluster', 'similarity'], ascending=[True, False]), pairsDf
@@ -0,0 +1,1460 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Benchmarks for maprrBack, run against a local stand-in for the MAPRR site
+so no requests go to the real server"""
+
+import os
+import re
+import ast
+import argparse
+import importlib
+import json
+import time
+import pickle
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import glob
+import hashlib
+import tempfile
+import threading
+import tracemalloc
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+
+import maprrBack
+
+
+def load_pages(names=('Asoup', 'Wsoup')):
+    """This function loads the saved soups and returns their raw html keyed by table name"""
+
+    pages = {}
+    for name in names:
+        with open(name + '.pkl', 'rb') as f:
+            soups = pickle.load(f)
+        table = {'Asoup': 'agents', 'Wsoup': 'works'}[name]
+        pages[table] = [str(s).encode('utf-8') for _, s in sorted(soups.items())]
+    return pages
+
+class MockHandler(BaseHTTPRequestHandler):
+    """Serves /<table>/<id> from the saved pages, cycling through them for ids past the saved ones.
+    Bodies set in server.overrides win over the saved pages, and an override of None is a 404.
+    server.flaky maps (table, id) to a list of error statuses returned, one per request, before
+    the page is served, and with server.error_rate set each page draws, once and from server.seed,
+    whether its first request fails with one of server.errors. Responses carry an ETag and answer a
+    matching If-None-Match with 304. Ids past server.sizes[table] are 404s, paths in server.stalls
+    are held back that many seconds more, and /<table> is an index linking its first ids"""
+
+    # HTTP/1.1 so clients can keep connections alive
+    protocol_version = 'HTTP/1.1'
+
+    def do_HEAD(self):
+        self.do_GET(head=True)
+
+    def do_GET(self, head=False):
+        with self.server.lock:
+            hit = self.server.hits[self.path] = self.server.hits.get(self.path, 0) + 1
+        time.sleep(self.delay(hit) + self.server.stalls.get(self.path, 0))
+        parts = self.path.strip('/').split('/')
+        if len(parts) == 1 and parts[0] in self.server.pages:
+            return self.index(parts[0], head)
+        try:
+            table, id_num = parts
+            if int(id_num) > self.server.sizes.get(table, float('inf')):
+                raise KeyError(id_num)
+            self.inject((table, int(id_num)))
+            errors = self.server.flaky.get((table, int(id_num)))
+            if errors:
+                status = errors.pop(0)
+                self.send_response(status)
+                if status in (429, 503):
+                    self.send_header('Retry-After', '0')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            saved = self.server.pages[table]
+            body = saved[(int(id_num)-1) % len(saved)] if int(id_num) > 0 else None
+            body = self.server.overrides.get((table, int(id_num)), body)
+        except (ValueError, KeyError):
+            body = None
+        if body is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', self.server.last_modified)
+        self.end_headers()
+        if not head:
+            try:
+                self.wfile.write(body)
+            except (BrokenPipeError, ConnectionResetError):
+                # the client timed out waiting
+                pass
+
+    def delay(self, hit):
+        """This function returns how long to hold back the hit'th response to this path, latency give or
+        take up to jitter of it. The draw depends only on the seed, path and hit, not on request order"""
+
+        server = self.server
+        if not server.jitter:
+            return server.latency
+        rng = random.Random(f'{server.seed}/{self.path}/{hit}')
+        return max(0.0, server.latency*(1 + server.jitter*(2*rng.random() - 1)))
+
+    def inject(self, key):
+        """This function decides, the first time a page is asked for, whether it fails once first"""
+
+        server = self.server
+        with server.lock:
+            if not server.error_rate or key in server.injected:
+                return
+            server.injected.add(key)
+            rng = random.Random(f'{server.seed}/{key[0]}/{key[1]}')
+            if rng.random() < server.error_rate:
+                server.flaky.setdefault(key, []).append(rng.choice(server.errors))
+
+    def index(self, table, head):
+        """This function serves a first page of links to the table's records, like a paginated index"""
+
+        size = self.server.sizes.get(table, len(self.server.pages[table]))
+        links = ''.join(f'<li><a href="/{table}/{i}">{table} {i}</a></li>' for i in range(1, min(size, 20)+1))
+        body = f'<html><body><ul>{links}</ul></body></html>'.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class MockMAPRR:
+    """Local HTTP server standing in for the MAPRR site, used as a context manager"""
+
+    def __init__(self, pages=None, latency=0.0, jitter=0.0, error_rate=0.0, errors=(500, 503, 429), seed=0):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), MockHandler)
+        self.server.daemon_threads = True
+        self.server.pages = load_pages() if pages is None else pages
+        # {(table, id): body or None} served instead of the saved pages
+        self.server.overrides = {}
+        # {(table, id): [status, ...]} errors returned before a page is served
+        self.server.flaky = {}
+        # {table: highest id}, tables left out have no end
+        self.server.sizes = {}
+        # {path: seconds} extra wait before answering, long enough to stand in for a hung connection
+        self.server.stalls = {}
+        # requests received per path
+        self.server.hits = {}
+        self.server.lock = threading.Lock()
+        self.server.last_modified = formatdate(usegmt=True)
+        # seconds each response is held back, to stand in for the real round trip
+        self.server.latency = latency
+        # fraction of latency each response's delay may stray by either way
+        self.server.jitter = jitter
+        # share of pages whose first request fails with one of errors, drawn from seed
+        self.server.error_rate = error_rate
+        self.server.errors = errors
+        self.server.seed = seed
+        # pages the error draw has been made for
+        self.server.injected = set()
+        self.domain = f"http://127.0.0.1:{self.server.server_port}/"
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset(self):
+        """This function forgets the hits and injected errors so the next crawl meets the same faults"""
+
+        with self.server.lock:
+            self.server.hits.clear()
+            self.server.injected.clear()
+            self.server.flaky.clear()
+
+def crawl_serial(site, tables, **options):
+    """This function crawls tables from the mock site with the serial maprr crawler and returns the pages it got"""
+
+    # the serial crawler reads the module globals, so point them at the mock site
+    old = maprrBack.domain, maprrBack.tables
+    maprrBack.domain, maprrBack.tables = site.domain, tables
+    try:
+        m = maprrBack.maprr(store=maprrBack.PageStore(tempfile.mkdtemp()))
+        m.get_htmlA()
+        m.get_htmlW()
+    finally:
+        maprrBack.domain, maprrBack.tables = old
+    return len(m.store)
+
+def crawl_legacy(site, tables, **options):
+    """This function fetches tables from the mock site page by page with the original MAPRR class,
+    half-second pause included, and returns the pages it got"""
+
+    m = maprrBack.MAPRR()
+    for table, id_num in maprrBack.crawl_plan(tables):
+        m.get_html(site.domain + table + '/' + str(id_num))
+    return len(m.Asoup) + len(m.Wsoup)
+
+def crawl_parallel(site, tables, **options):
+    """This function fetches and parses tables from the mock site with ParallelMAPRR and returns the pages it got"""
+
+    pipeline = maprrBack.ParallelMAPRR(domain=site.domain, tables=tables)
+    pipeline.get_and_parse()
+    return len(pipeline.parsed)
+
+def crawl_async(site, tables, rate=50, per_host=8, **options):
+    """This function crawls tables from the mock site with AsyncMAPRR and returns the pages it got"""
+
+    crawler = maprrBack.AsyncMAPRR(domain=site.domain, tables=tables, rate=rate, per_host=per_host, backoff=.05)
+    crawler.get_html()
+    return len(crawler.pages)
+
+# name: function(site, tables, **options) returning the pages it got, new crawlers go here
+crawl_engines = {
+    'serial': crawl_serial,
+    'legacy': crawl_legacy,
+    'parallel (fetch+parse)': crawl_parallel,
+    'async': crawl_async,
+}
+
+def bench_crawl(n=50, latency=.05, jitter=0.0, error_rate=0.0, seed=0, engines=None, legacy_n=5, **options):
+    """This function crawls n agents and n works from the mock site with each crawl engine (legacy_n of
+    each for the legacy MAPRR, which sleeps half a second a page) and prints pages/sec. Every engine
+    meets the same latencies and injected errors, so pages got and requests made are comparable too"""
+
+    results = {}
+    with MockMAPRR(latency=latency, jitter=jitter, error_rate=error_rate, seed=seed) as site:
+        for name in engines or crawl_engines:
+            site.reset()
+            size = legacy_n if name == 'legacy' else n
+            random.seed(seed)
+            t1 = time.perf_counter()
+            got = crawl_engines[name](site, {'agents/': size, 'works/': size}, **options)
+            t2 = time.perf_counter()
+            results[name] = {'pages/s': got/(t2-t1), 'pages': got, 'requests': sum(site.server.hits.values())}
+            print(f"{name}: {round(got/(t2-t1), 2)} pages/sec, {got} of {2*size} pages in {results[name]['requests']} requests")
+    return results
+
+def check_store(n=4):
+    """This function checks PageStore keeps one object per distinct page and forgets removed pages,
+    that import_soup_pickles files the pickled soups under the right tables, and that the run of the
+    async, serial and parallel crawlers writes only the pages its own crawl got: not one that has since
+    gone 404, nor ones stored by an earlier crawl of more pages"""
+
+    pages = load_pages()
+    store = maprrBack.PageStore(tempfile.mkdtemp())
+    body = pages['works'][0]
+    store.put('works', 1, body)
+    store.put('works', 2, body)
+    assert store.get('works', 2) == body and store.sha1('works', 1) == store.sha1('works', 2)
+    assert len(os.listdir(os.path.dirname(store.object_path(store.sha1('works', 1))))) == 1
+    store.remove('works', 1)
+    assert store.get('works', 1) is None and store.get('works', 2) == body and store.ids('works') == [2]
+
+    cwd = os.getcwd()
+    os.chdir(tempfile.mkdtemp())
+    try:
+        soups = {'Asoup': {1: pages['agents'][0].decode()}, 'Wsoup': {'3': body.decode()},
+                 'soups': {'w4': body.decode(), 'a5': pages['agents'][0].decode(), 6: 'table unknown'}}
+        for name, soup in soups.items():
+            with open(name + '.pkl', 'wb') as f:
+                pickle.dump(soup, f)
+        imported = maprrBack.PageStore('pages')
+        assert maprrBack.import_soup_pickles(imported) == 4
+        assert imported.ids('agents') == [1, 5] and imported.ids('works') == [3, 4]
+        assert imported.get('works', 4) == body
+    finally:
+        os.chdir(cwd)
+
+    def serial_run(site, tables, store):
+        # the serial crawler reads the module globals, so point them at the mock site
+        old = maprrBack.domain, maprrBack.tables
+        maprrBack.domain, maprrBack.tables = site.domain, tables
+        try:
+            maprrBack.maprr(store=store).run()
+        finally:
+            maprrBack.domain, maprrBack.tables = old
+
+    runs = {
+        'async': lambda site, tables, store: maprrBack.AsyncMAPRR(domain=site.domain, tables=tables, store=store).run(),
+        'serial': serial_run,
+        'parallel': lambda site, tables, store: maprrBack.ParallelMAPRR(domain=site.domain, tables=tables, store=store, procs=1).run(),
+    }
+    for name, run in runs.items():
+        with MockMAPRR(pages) as site:
+            store = maprrBack.PageStore(tempfile.mkdtemp())
+            out = tempfile.mkdtemp()
+            os.chdir(out)
+            try:
+                run(site, {'agents/': n, 'works/': n+2}, store)
+                assert maprrBack.read_frame('WsDf').index.tolist() == list(range(1, n+3)), name
+                site.server.overrides[('works', 3)] = None
+                run(site, {'agents/': n, 'works/': n}, store)
+            finally:
+                os.chdir(cwd)
+            assert ('works', 3) not in store and ('works', 3) in store.skipped(), name
+            assert maprrBack.read_frame('WsDf', path=out).index.tolist() == [i for i in range(1, n+1) if i != 3], name
+            assert maprrBack.read_frame('AsDf', path=out).index.tolist() == list(range(1, n+1)), name
+    print("PageStore dedups and forgets pages, pickles import by table, run writes only what its crawl got")
+
+def check_incremental(n=6):
+    """This function crawls the mock site, changes one work, removes another and adds a new one,
+    then checks an incremental re-crawl reports and patches exactly those"""
+
+    small_tables = {'agents/': n, 'works/': n}
+    with MockMAPRR() as site:
+        store = maprrBack.PageStore(tempfile.mkdtemp())
+        first = maprrBack.AsyncMAPRR(domain=site.domain, tables=small_tables, store=store, incremental=True)
+        first.get_html()
+        WsDf, AsDf = first.update_frames(pd.DataFrame(), pd.DataFrame())
+        assert first.report == {'unchanged': 0, 'changed': 0, 'new': 2*n, 'gone': 0}, first.report
+
+        changed = store.get('works', 2).replace('Untitled'.encode(), 'Retitled'.encode(), 1)
+        site.server.overrides[('works', 2)] = changed
+        site.server.overrides[('works', 3)] = None
+        second = maprrBack.AsyncMAPRR(domain=site.domain, tables={'agents/': n, 'works/': n+1}, store=store, incremental=True)
+        second.get_html()
+        assert second.report == {'unchanged': 2*n-2, 'changed': 1, 'new': 1, 'gone': 1}, second.report
+
+        WsDf, AsDf = second.update_frames(WsDf, AsDf)
+        assert WsDf.loc[2, 'title_ru'] == 'Retitled'
+        assert 3 not in WsDf.index and n+1 in WsDf.index
+    print(f"Incremental re-crawl: {second.report}")
+    return second.report
+
+def finishes(fn, timeout=60):
+    """This function runs fn on a thread and fails if it hasn't returned or raised within timeout seconds.
+    It returns fn's result, or the exception it raised"""
+
+    outcome = {}
+
+    def target():
+        try:
+            outcome['result'] = fn()
+        except BaseException as e:
+            outcome['result'] = e
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), f"{fn} still running after {timeout} seconds"
+    return outcome['result']
+
+def check_pipeline(n=6, bad=(('works', 2, b''), ('agents', 3, b'  '), ('works', 4, b'<html><body></body></html>'))):
+    """This function checks ParallelMAPRR parses every page the same as parse_entity, that an empty or
+    unparsable page costs only that page in ParallelMAPRR, AsyncMAPRR and the serial maprr, and that a
+    parser which dies stops the fetch threads instead of leaving them blocked on the queue"""
+
+    pages = all_pages(n)
+    all_tables = {t + '/': n for t in pages}
+    plan = [(t, i) for t, i in maprrBack.crawl_plan(all_tables) if t in maprrBack.table_specs]
+    with MockMAPRR(pages) as site:
+        pipeline = maprrBack.ParallelMAPRR(procs=1, domain=site.domain, tables=all_tables)
+        finishes(pipeline.get_and_parse)
+        assert sorted(pipeline.parsed) == sorted(plan), pipeline.parsed.keys()
+        for (t, i), row in pipeline.parsed.items():
+            assert row == maprrBack.parse_entity(t, i, pages[t][(i-1) % len(pages[t])])[0], (t, i)
+
+        for t, i, body in bad:
+            site.server.overrides[(t, i)] = body
+        broken = {(t, i) for t, i, _ in bad}
+        broken_agents = {i for t, i in broken if t == 'agents'}
+        pipeline = maprrBack.ParallelMAPRR(procs=1, domain=site.domain, tables=all_tables)
+        finishes(pipeline.get_and_parse)
+        assert sorted(pipeline.parsed) == sorted(set(plan) - broken), pipeline.parsed.keys()
+        assert sum(pipeline.metrics.counters['parse_errors_total'].values()) == len(bad)
+
+        crawler = maprrBack.AsyncMAPRR(domain=site.domain, tables=all_tables, backoff=.05)
+        crawler.get_html()
+        parsed = {(t, i) for t, i, body in crawler.iter_pages(list(pages)) if crawler.parse(t, i, body) is not None}
+        assert parsed == set(plan) - broken, parsed
+
+        # a parser side that dies with the queue full
+        pipeline = maprrBack.ParallelMAPRR(threads=2, procs=1, queue_size=1, domain=site.domain, tables=all_tables)
+
+        def collect(done):
+            raise RuntimeError("parser died")
+
+        pipeline.collect = collect
+        died = finishes(pipeline.get_and_parse)
+        assert isinstance(died, RuntimeError) and pipeline.stopped.is_set(), died
+
+    # the serial crawler's parse, with a page whose bio has one date and a parser that fails on another
+    store = maprrBack.PageStore(tempfile.mkdtemp())
+    for i in range(1, n+1):
+        store.put('agents', i, pages['agents'][(i-1) % len(pages['agents'])])
+    store.put('agents', 1, one_date_pages()[0])
+    for t, i, body in bad:
+        if t == 'agents':
+            store.put(t, i, body)
+    serial = maprrBack.maprr(store=store)
+
+    def parse(html):
+        if 'Ivan Nikolaevich Antonov' in html.text:
+            raise ValueError('unexpected layout')
+        return serial.parseAs(html)
+
+    old = maprrBack.tables
+    maprrBack.tables = all_tables
+    try:
+        parsed = serial.parse_stored('agents', parse)
+    finally:
+        maprrBack.tables = old
+    failing = {i for i in range(1, n+1) if b'Ivan Nikolaevich Antonov' in pages['agents'][(i-1) % len(pages['agents'])]}
+    assert set(parsed) == set(range(1, n+1)) - broken_agents - failing and parsed[1]['death'] is None, parsed.keys()
+    print(f"Pipeline parsed {len(plan)} pages, skipped {len(bad)} bad ones, stopped when its parser died")
+
+def entity_page(table, id_num):
+    """This function makes a page for one of the tables without saved pages, laid out like the
+    current agent pages: a name in the wrapper, a typology table and an associations table"""
+
+    return f"""<html><body><div id="maprr-content-wrapper"><div class="wrapper">
+    <h3>{table} {id_num}</h3>
+    <table class="table" id="typology"><tr><th>Type</th><td>{table[:-1]}</td></tr></table>
+    <h4>Associated Works</h4>
+    <table class="table table-sm associations"><tr><th scope="row">Appears In</th>
+    <td><li><a href="/works/{id_num}">work</a></li></td></tr></table>
+    </div></div></body></html>""".encode('utf-8')
+
+def all_pages(n, others=('place_based_concepts', 'locations', 'multivalent_markers')):
+    """This function returns the saved agent and work pages plus n made up pages for each other table"""
+
+    pages = load_pages()
+    pages.update({t: [entity_page(t, i) for i in range(1, n+1)] for t in others})
+    return pages
+
+def check_graph(n=4):
+    """This function crawls all five tables from the mock site, checks every table gets a frame
+    and the links end up in edgesDf, then changes one work and checks an incremental re-crawl
+    swaps just its edges"""
+
+    others = ('place_based_concepts', 'locations', 'multivalent_markers')
+    pages = all_pages(n)
+    all_tables = {t + '/': n for t in pages}
+    cwd = os.getcwd()
+    os.chdir(tempfile.mkdtemp())
+    try:
+        with MockMAPRR(pages) as site:
+            store = maprrBack.PageStore('pages')
+            first = maprrBack.AsyncMAPRR(domain=site.domain, tables=all_tables, store=store, incremental=True)
+            first.run()
+            edgesDf = maprrBack.read_frame('edgesDf')
+            for t in others:
+                df = maprrBack.read_frame(maprrBack.frame_names[t])
+                assert list(df.index) == list(range(1, n+1)) and df.loc[1, 'name'] == f'{t} 1', df
+                appears = edgesDf[(edgesDf.src == t) & (edgesDf.rel == 'appears_in')]
+                assert list(appears.dst_id) == list(range(1, n+1)), appears
+            authors = edgesDf[(edgesDf.src == 'works') & (edgesDf.rel == 'author')]
+            assert len(authors) == n and set(authors.dst) == {'agents'}, authors
+
+            changed = store.get('works', 2).replace(b'href="/agents/1"', b'href="/agents/3"', 1)
+            site.server.overrides[('works', 2)] = changed
+            second = maprrBack.AsyncMAPRR(domain=site.domain, tables=all_tables, store=store, incremental=True)
+            second.run_incremental()
+            assert second.report['changed'] == 1, second.report
+            patched = maprrBack.read_frame('edgesDf')
+            author = patched[(patched.src == 'works') & (patched.src_id == 2) & (patched.rel == 'author')]
+            assert list(author.dst_id) == [3], author
+            rest = lambda df: df[~((df.src == 'works') & (df.src_id == 2))].reset_index(drop=True).astype(object)
+            assert rest(patched).equals(rest(edgesDf))
+            graph = maprrBack.EntityGraph().build(patched)
+            # the mock's agent pages repeat, so agents 1 and 4 still claim work 2 as well
+            assert 3 in graph.neighbours('work_authors', 2) and 2 in graph.neighbours('author_works', 3)
+            assert list(graph.neighbours('location_works', 1)) == [1] and 1 in graph.neighbours('work_locations', 1)
+    finally:
+        os.chdir(cwd)
+    print(f"{len(edgesDf)} edges from {sum(all_tables.values())} pages: {edgesDf.rel.value_counts().to_dict()}")
+    return edgesDf
+
+def check_stream(n=6, batch_size=4):
+    """This function checks AsyncMAPRR.stream writes the same frames and edges as run, and that a crawl
+    which died after one committed batch, half way through the next, resumes without fetching the
+    committed pages again. A crawl with a store killed before it committed anything loses none of the
+    pages it journaled done, and both write frames sorted by id"""
+
+    pages = all_pages(n)
+    all_tables = {t + '/': n for t in pages}
+    names = list(maprrBack.frame_names.values())
+    cwd = os.getcwd()
+    full, streamed = tempfile.mkdtemp(), tempfile.mkdtemp()
+    with MockMAPRR(pages) as site:
+        os.chdir(full)
+        try:
+            maprrBack.AsyncMAPRR(domain=site.domain, tables=all_tables).run()
+        finally:
+            os.chdir(cwd)
+
+        # a batch of works that made it to disk, and a part of the next batch that didn't get committed
+        writer = maprrBack.PartWriter(streamed, batch_size)
+        for i in range(1, batch_size+1):
+            row, links = maprrBack.parse_entity('works', i, pages['works'][(i-1) % len(pages['works'])])
+            writer.add('works', i, maprrBack.tidy_row('works', row), links)
+        stray = os.path.join(writer.dir, 'AsDf', '00001.parquet')
+        os.makedirs(os.path.dirname(stray))
+        with open(stray, 'wb') as f:
+            f.write(b'half written')
+
+        site.reset()
+        crawler = maprrBack.AsyncMAPRR(domain=site.domain, tables=all_tables)
+        merged = crawler.stream(streamed, batch_size)
+        assert sorted(merged) == sorted(names + ['edgesDf']), merged
+        assert not any(f'/works/{i}' in site.server.hits for i in range(1, batch_size+1)), site.server.hits
+        assert not crawler.pages and not os.path.exists(os.path.join(streamed, 'parts'))
+
+        # killed after pages were journaled done and before their batch was committed: nothing gets flushed
+        killed = tempfile.mkdtemp()
+        store = maprrBack.PageStore(tempfile.mkdtemp())
+        add, flush = maprrBack.PartWriter.add, maprrBack.PartWriter.flush
+        added = []
+        def dying_add(writer, *args):
+            added.append(args[:2])
+            if len(added) == batch_size:
+                raise RuntimeError('killed')
+            add(writer, *args)
+        def no_flush(writer):
+            pass
+        maprrBack.PartWriter.add, maprrBack.PartWriter.flush = dying_add, no_flush
+        try:
+            maprrBack.AsyncMAPRR(domain=site.domain, tables=all_tables, store=store).stream(killed, 10*batch_size)
+            raise AssertionError('the crawl should have been killed')
+        except RuntimeError:
+            pass
+        finally:
+            maprrBack.PartWriter.add, maprrBack.PartWriter.flush = add, flush
+        journal = maprrBack.CrawlJournal(store)
+        assert all(journal.state(t, i)['state'] == 'done' for t, i in added), added
+        crawler = maprrBack.AsyncMAPRR(domain=site.domain, tables=all_tables, store=store)
+        crawler.stream(killed, batch_size)
+        assert set(added) <= set(crawler.resumed), (added, crawler.resumed)
+
+    for path in (streamed, killed):
+        for name in names:
+            old = maprrBack.read_frame(name, path=full).sort_index().astype(object)
+            new = maprrBack.read_frame(name, path=path)
+            assert new.index.is_monotonic_increasing, (name, new.index)
+            assert old.equals(new.astype(object)), (name, old, new)
+        sort = lambda df: df.astype(object).sort_values(maprrBack.edge_cols, ignore_index=True)
+        assert sort(maprrBack.read_frame('edgesDf', path=full)).equals(sort(maprrBack.read_frame('edgesDf', path=path)))
+    print(f"Streamed {sum(all_tables.values())} pages in batches of {batch_size}, resumed after {batch_size}, "
+          f"and after a kill before any commit, same frames as run")
+
+def bench_stream(n=200, batch_size=64, latency=0.0):
+    """This function crawls n agents and n works from the mock site with AsyncMAPRR.run and with
+    AsyncMAPRR.stream, and prints the time and the peak memory Python allocated (tracemalloc) for each"""
+
+    small_tables = {'agents/': n, 'works/': n}
+    results = {}
+    with MockMAPRR(latency=latency) as site:
+        for name in ('run', 'stream'):
+            site.reset()
+            path = tempfile.mkdtemp()
+            crawler = maprrBack.AsyncMAPRR(domain=site.domain, tables=small_tables, rate=1000, max_rate=1000)
+            cwd = os.getcwd()
+            os.chdir(path)
+            tracemalloc.start()
+            t1 = time.perf_counter()
+            try:
+                crawler.run() if name == 'run' else crawler.stream(path, batch_size)
+            finally:
+                t2 = time.perf_counter()
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                os.chdir(cwd)
+            results[name] = {'s': t2 - t1, 'MB': peak/2**20}
+            print(f"{name}: {round(t2-t1, 2)} s, peak {round(peak/2**20, 1)} MB")
+    return results
+
+def check_resume(n=6, crash_at=('works', 3)):
+    """This function stops a serial crawl at crash_at, with one page hanging past the read timeout, and
+    checks the next run fetches only what the first didn't get, the timed out page included. Then that
+    get_single answers from the page store, and that AsyncMAPRR and ParallelMAPRR resume the same way.
+    A ParallelMAPRR whose store fails mid crawl raises from run without writing or journaling the page done"""
+
+    class Crash(Exception):
+        pass
+
+    class Crashing(maprrBack.maprr):
+        def get_page(self, table, id_num):
+            if (table, id_num) == crash_at:
+                self.journal.begin(table, id_num)
+                raise Crash()
+            return super().get_page(table, id_num)
+
+    small_tables = {'agents/': n, 'works/': n}
+    with MockMAPRR() as site:
+        old = maprrBack.domain, maprrBack.tables
+        maprrBack.domain, maprrBack.tables = site.domain, small_tables
+        try:
+            store = maprrBack.PageStore(tempfile.mkdtemp())
+            site.server.stalls['/agents/2'] = 1
+            t1 = time.perf_counter()
+            try:
+                Crashing(store=store, timeout=(1, .2)).run()
+            except Crash:
+                pass
+            assert time.perf_counter() - t1 < 1 + 2*n*.2, "the hung page held the crawl up"
+            journal = maprrBack.CrawlJournal(store)
+            assert journal.state('agents', 2)['status'] == 'ReadTimeout', journal.state('agents', 2)
+            assert journal.state(*crash_at)['state'] == 'in_flight'
+            del site.server.stalls['/agents/2']
+
+            site.server.hits.clear()
+            resumed = maprrBack.maprr(store=store)
+            resumed.get_htmlA()
+            resumed.get_htmlW()
+            resumed.journal.finish()
+            assert set(site.server.hits) == {'/agents/2'} | {f'/works/{i}' for i in range(crash_at[1], n+1)}, site.server.hits
+            assert len(store) == 2*n
+
+            site.server.hits.clear()
+            row = resumed.get_single('work', 2)
+            assert row.loc[2, 'title'] and not site.server.hits
+            row = resumed.get_single('work', n+1)
+            assert site.server.hits == {f'/works/{n+1}': 1} and ('works', n+1) in store
+            assert resumed.journal.state('works', n+1) == {'state': 'done', 'status': '200'}
+
+            # a crawler that hasn't run journals each lookup in a run of its own, and leaves an unfinished crawl be
+            journal.start(maprrBack.crawl_plan(small_tables))
+            unfinished = journal.unfinished()
+            fresh = maprrBack.maprr(store=store)
+            for _ in range(2):
+                fresh.get_single('work', 3, refresh=True)
+            rows = store.db.execute('SELECT run, state FROM journal WHERE tbl = ? AND id = ? AND run > ?', ('works', 3, unfinished)).fetchall()
+            assert len(rows) == 2 and all(state == 'done' for _, state in rows), rows
+            assert not store.db.execute('SELECT COUNT(*) FROM journal WHERE run IS NULL').fetchone()[0]
+            assert journal.unfinished() == unfinished and journal.counts(unfinished).get('done', 0) == 0
+        finally:
+            maprrBack.domain, maprrBack.tables = old
+
+        for name in ('async', 'parallel'):
+            store = maprrBack.PageStore(tempfile.mkdtemp())
+            plan = maprrBack.crawl_plan(small_tables)
+            # what a run that died part way through leaves: half the pages done, one in flight
+            journal = maprrBack.CrawlJournal(store)
+            journal.start(plan)
+            for t, i in plan[:n]:
+                store.put(t, i, site.server.pages[t][(i-1) % len(site.server.pages[t])])
+                journal.done(t, i)
+            journal.begin(*plan[n])
+            site.server.hits.clear()
+            if name == 'async':
+                crawler = maprrBack.AsyncMAPRR(domain=site.domain, tables=small_tables, store=store)
+                crawler.get_html()
+            else:
+                crawler = maprrBack.ParallelMAPRR(procs=1, domain=site.domain, tables=small_tables, store=store)
+                crawler.get_and_parse()
+                assert len(crawler.parsed) == 2*n, crawler.parsed
+            assert set(site.server.hits) == {f'/{t}/{i}' for t, i in plan[n:]}, site.server.hits
+            assert journal.unfinished() is None and len(store) == 2*n
+
+        # a store that fails mid crawl: the page isn't journaled done without its html, and run writes nothing
+        store = maprrBack.PageStore(tempfile.mkdtemp())
+        put = store.put
+
+        def failing_put(table, id_num, body):
+            if (table, id_num) == crash_at:
+                raise OSError('disk full')
+            return put(table, id_num, body)
+
+        store.put = failing_put
+        out = tempfile.mkdtemp()
+        cwd = os.getcwd()
+        os.chdir(out)
+        try:
+            failed = finishes(maprrBack.ParallelMAPRR(procs=1, domain=site.domain, tables=small_tables, store=store).run)
+        finally:
+            os.chdir(cwd)
+        assert isinstance(failed, OSError) and not os.listdir(out), (failed, os.listdir(out))
+        journal = maprrBack.CrawlJournal(store)
+        assert journal.unfinished() is not None and journal.state(*crash_at)['state'] != 'done', journal.state(*crash_at)
+        store.put = put
+        crawler = maprrBack.ParallelMAPRR(procs=1, domain=site.domain, tables=small_tables, store=store)
+        crawler.get_and_parse()
+        assert crash_at in crawler.parsed and len(crawler.parsed) == 2*n and crash_at in store, crawler.parsed.keys()
+    print(f"Crawls resume after a crash and a timeout, get_single reads from the page store, "
+          f"a failed download stops ParallelMAPRR.run")
+
+def check_metrics(n=4):
+    """This function runs the serial, parallel and async crawlers end to end on the mock site, one
+    page answering 503 once, and checks each writes stage timings, per page records and counters
+    to maprr_metrics.json and a Prometheus file that agrees with it, and the frames as typed Parquet"""
+
+    small_tables = {'agents/': n, 'works/': n}
+    pages = load_pages()
+    cwd = os.getcwd()
+    os.chdir(tempfile.mkdtemp())
+    try:
+        with MockMAPRR(pages) as site:
+            old = maprrBack.domain, maprrBack.tables
+            maprrBack.domain, maprrBack.tables = site.domain, small_tables
+            try:
+                crawlers = {
+                    'serial': maprrBack.maprr(store=maprrBack.PageStore('serial')),
+                    'parallel': maprrBack.ParallelMAPRR(procs=1, domain=site.domain, tables=small_tables),
+                    'async': maprrBack.AsyncMAPRR(domain=site.domain, tables=small_tables, backoff=0),
+                }
+                for name, crawler in crawlers.items():
+                    site.server.flaky[('works', 2)] = [503] if name == 'async' else []
+                    for f in glob.glob('*.parquet'):
+                        os.remove(f)
+                    crawler.run()
+                    for frame in ('WsDf', 'AsDf'):
+                        df = maprrBack.read_frame(frame)
+                        assert df.index.tolist() == list(range(1, n+1)), (name, frame, df.index)
+                    assert str(maprrBack.read_frame('WsDf').comp_date.dtype).startswith('datetime64') and not glob.glob('*Df.json')
+                    with open('maprr_metrics.json') as f:
+                        report = json.load(f)
+                    with open('maprr_metrics.prom') as f:
+                        prom = f.read()
+                    stages = {h['labels']['stage'] for h in report['histograms']['stage_seconds']}
+                    assert {'build', 'write'} <= stages and stages & {'fetch', 'fetch+parse'}, stages
+                    pages = {(p['table'], p['id']): p for p in report['pages']}
+                    assert len(pages) == 2*n and all(p['parse_seconds'] is not None for p in pages.values()), pages
+                    fetched = sum(c['value'] for c in report['counters']['responses_total'])
+                    assert fetched == 2*n + (name == 'async'), fetched
+                    assert pages[('works', 2)]['attempts'] == 1 + (name == 'async')
+                    total = sum(c['value'] for c in report['counters']['bytes_total'])
+                    assert f'maprr_bytes_total{{table="works"}}' in prom and total == sum(p['bytes'] for p in pages.values())
+                    assert 'maprr_fetch_seconds_bucket{table="agents",le="+Inf"} ' + str(n) in prom
+                    print(f"{name}: stages {sorted(stages)}, {fetched} responses, {total} bytes")
+            finally:
+                maprrBack.domain, maprrBack.tables = old
+    finally:
+        os.chdir(cwd)
+    return report
+
+def check_retries(n=6):
+    """This function checks transient errors are retried until the page comes through and
+    that a 404 goes on the skip list and isn't requested by the next crawl"""
+
+    small_tables = {'agents/': n, 'works/': n}
+    with MockMAPRR() as site:
+        store = maprrBack.PageStore(tempfile.mkdtemp())
+        site.server.flaky[('works', 1)] = [503, 429]
+        site.server.flaky[('works', 2)] = [500]
+        site.server.overrides[('agents', 2)] = None
+        crawler = maprrBack.AsyncMAPRR(domain=site.domain, tables=small_tables, store=store, backoff=.05)
+        crawler.get_html()
+        assert ('works', 1) in store and ('works', 2) in store
+        assert crawler.aberrant == [('agents', 2, 404)], crawler.aberrant
+        assert store.skipped() == {('agents', 2)}
+
+        maprrBack.AsyncMAPRR(domain=site.domain, tables=small_tables, store=store).get_html()
+        assert site.server.hits['/agents/2'] == 1
+        assert site.server.hits['/works/1'] == 4
+    print(f"Retries and skip list behave, final rate {round(crawler.limiter.rate, 2)} requests/sec")
+
+def check_discovery(sizes={'agents': 37, 'works': 655}, holes=(('works', 300), ('works', 301))):
+    """This function checks discovery finds each table's real highest id on the mock site, holes
+    included, starting from the stale counts in tables, and prints how many requests it took. A probe
+    that drops is retried, and a site that can't be reached keeps the counts it had"""
+
+    with MockMAPRR() as site:
+        site.server.sizes.update(sizes)
+        for hole in holes:
+            site.server.overrides[hole] = None
+        found = maprrBack.discover_tables(site.domain, {'agents/': 323, 'works/': 648})
+        requests_made = sum(site.server.hits.values())
+        assert found == {t+'/': n for t, n in sizes.items()}, found
+
+        # a probe whose connection drops once is retried
+        class Dropping:
+            def __init__(self):
+                self.session = maprrBack.requests.Session()
+                self.drops = 1
+
+            def head(self, url, **kwargs):
+                if self.drops:
+                    self.drops -= 1
+                    raise maprrBack.requests.ConnectionError('connection reset')
+                return self.session.head(url, **kwargs)
+
+        assert maprrBack.discover_max_id(Dropping(), site.domain, 'agents', 1) == sizes['agents']
+
+    # a site that can't be reached keeps its old counts instead of stopping discovery
+    unreachable = maprrBack.discover_tables(site.domain, {'agents/': 323, 'works/': 648}, timeout=1)
+    assert unreachable == {'agents/': 323, 'works/': 648}, unreachable
+    print(f"Discovered {found} with {requests_made} requests, kept the old counts when the site was down")
+    return requests_made
+
+def one_date_pages():
+    """This function returns agent pages whose bio has a single date: each saved page with the death cut
+    from its bio, and a page in the older card layout"""
+
+    pages = [re.sub(rb'(<span class="bio">[^<]*?) - [^<]*', rb'\1', body, count=1) for body in load_pages()['agents']]
+    pages.append(b'<html><body><div class="card scrollable"><h2>Anna Akhmatova</h2><span>June 23, 1889</span></div>'
+                 b'<div class="col-md-4"><h4>Sex</h4><p>female</p></div></body></html>')
+    return pages
+
+def check_parsers(backends=None):
+    """This function parses every saved agent and work page, and agent pages with a single date in
+    their bio, with each parser backend and checks they all return exactly the dicts the bs4 backend does"""
+
+    backends = [b for b in maprrBack.parsers if b != 'bs4'] if backends is None else backends
+    pages = load_pages()
+    pages['agents'] = pages['agents'] + one_date_pages()
+    checked = 0
+    for table, bodies in pages.items():
+        for i, body in enumerate(bodies, 1):
+            golden = maprrBack.parse_page(table, body, backend='bs4')
+            for backend in backends:
+                got = maprrBack.parse_page(table, body, backend=backend)
+                assert got == golden, f"{backend} differs from bs4 on {table}/{i}: {got} != {golden}"
+            checked += 1
+    for body in one_date_pages():
+        row = maprrBack.parse_page('agents', body, backend='bs4')
+        assert row['birth'] and row['death'] is None, row
+    print(f"All backends agree on {checked} pages")
+    return checked
+
+def bench_parse(repeat=20, backends=None):
+    """This function parses the saved pages repeat times with each parser backend and prints pages/sec"""
+
+    backends = list(maprrBack.parsers) if backends is None else backends
+    pages = [(table, body) for table, bodies in load_pages().items() for body in bodies]
+    results = {}
+    for backend in backends:
+        t1 = time.perf_counter()
+        for _ in range(repeat):
+            for table, body in pages:
+                maprrBack.parse_page(table, body, backend=backend)
+        t2 = time.perf_counter()
+        results[backend] = repeat*len(pages)/(t2-t1)
+        print(f"{backend}: {round(results[backend], 2)} pages/sec")
+    return results
+
+def legacy_frames():
+    """This function loads the WsDf.csv/AsDf.csv dumps, turning the stringified stanza lists back into lists"""
+
+    WsDf = pd.read_csv('WsDf.csv', index_col=0)
+    WsDf['text'] = WsDf.text.apply(ast.literal_eval)
+    AsDf = pd.read_csv('AsDf.csv', index_col=0)
+    return WsDf, AsDf
+
+def bench_load(repeat=5):
+    """This function times loading the works and agents the way the notebook does (JSON or CSV,
+    then renaming and pd.to_datetime) against read_frame on Parquet, and compares file sizes"""
+
+    WsDf, AsDf = legacy_frames()
+    tmp = tempfile.mkdtemp()
+    WsDf.to_json(os.path.join(tmp, 'WsDf.json'))
+    AsDf.to_json(os.path.join(tmp, 'AsDf.json'))
+    maprrBack.write_frames(WsDf, AsDf, tmp)
+
+    def notebook(reader, ext):
+        libDf = reader(os.path.join(tmp if ext == 'json' else '.', 'WsDf.' + ext))
+        libDf.columns = maprrBack.lib_cols[:1] + maprrBack.lib_cols[2:]
+        libDf['comp_date'] = pd.to_datetime(libDf['comp_date'], errors='coerce', format='mixed')
+        libDf['pub_year'] = pd.to_datetime(libDf['pub_year'], errors='coerce', format='mixed').dt.year
+        AsDf = reader(os.path.join(tmp if ext == 'json' else '.', 'AsDf.' + ext))
+        AsDf['birth'] = pd.to_datetime(AsDf['birth'], errors='coerce', format='mixed')
+        AsDf['death'] = pd.to_datetime(AsDf['death'], errors='coerce', format='mixed')
+
+    loaders = {
+        'json': lambda: notebook(pd.read_json, 'json'),
+        'csv': lambda: notebook(lambda f: pd.read_csv(f, index_col=0), 'csv'),
+        'parquet': lambda: (maprrBack.read_frame('WsDf', path=tmp), maprrBack.read_frame('AsDf', path=tmp)),
+        'parquet (author, comp_date)': lambda: maprrBack.read_frame('WsDf', ['author', 'comp_date'], path=tmp),
+    }
+    results = {}
+    for name, load in loaders.items():
+        t1 = time.perf_counter()
+        for _ in range(repeat):
+            load()
+        results[name] = (time.perf_counter()-t1)/repeat*1000
+        print(f"{name}: {round(results[name], 2)} ms")
+    for ext, folder in (('csv', '.'), ('json', tmp), ('parquet', tmp)):
+        size = sum(os.path.getsize(os.path.join(folder, f'{n}.{ext}')) for n in ('WsDf', 'AsDf'))
+        print(f"{ext} files: {round(size/1024)} KB")
+    return results
+
+def bench_import(repeat=5, heavy=('pandas', 'pyarrow', 'aiohttp', 'requests', 'bs4', 'lxml', 'natasha')):
+    """This function times fresh interpreters importing maprrBack, then importing it and reading the works
+    back with read_frame, and checks a bare import loads none of the heavy dependencies"""
+
+    WsDf, AsDf = legacy_frames()
+    tmp = tempfile.mkdtemp()
+    maprrBack.write_frames(WsDf, AsDf, tmp)
+    scripts = {
+        'python': 'pass',
+        'import': 'import maprrBack',
+        'import + read_frame': f'import maprrBack; maprrBack.read_frame("WsDf", path={tmp!r})',
+    }
+    results = {}
+    for name, script in scripts.items():
+        runs = []
+        for _ in range(repeat):
+            t1 = time.perf_counter()
+            subprocess.run([sys.executable, '-c', script], check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+            runs.append(time.perf_counter()-t1)
+        results[name] = min(runs)*1000
+        print(f"{name}: {round(results[name])} ms")
+    loaded = subprocess.run([sys.executable, '-c', f'import sys, maprrBack; print(*[m for m in {heavy!r} if m in sys.modules])'],
+                            check=True, capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.split()
+    assert not loaded, f"importing maprrBack loaded {loaded}"
+    return results
+
+def bench_text(scales=(1, 50)):
+    """This function times the notebook's per-row word count and apply(pd.Series).stack() explode
+    against work_counts and explode_text, on the legacy works repeated up to each scale"""
+
+    WsDf, _ = legacy_frames()
+    results = {}
+    for scale in scales:
+        works = pd.concat([WsDf]*scale, ignore_index=True)
+        works.index += 1
+        cases = {
+            'notebook num_words': lambda: works.text.apply(lambda k: len([a for b in [x.split() for y in k for x in y.split('               ')] for a in b if a.isalpha() == True])),
+            'notebook stanzas': lambda: works.text.apply(pd.Series).stack(),
+            'work_counts': lambda: maprrBack.work_counts(works),
+            'explode_text stanza': lambda: maprrBack.explode_text(works, 'stanza'),
+            'explode_text token': lambda: maprrBack.explode_text(works),
+        }
+        for name, case in cases.items():
+            t1 = time.perf_counter()
+            case()
+            results[(scale, name)] = time.perf_counter()-t1
+            print(f"x{scale} {name}: {round(results[(scale, name)]*1000, 1)} ms")
+    return results
+
+def date_columns():
+    """This function returns the free text date columns of the legacy frames, AsDf birth/death and WsDf composition and publication"""
+
+    WsDf, AsDf = legacy_frames()
+    return {'birth': AsDf.birth, 'death': AsDf.death, 'comp_date': WsDf['Composition Date'], 'pub_year': WsDf['First Publication Year']}
+
+def check_dates():
+    """This function checks parse_dates on the shapes of date the site uses, and that on the saved corpus it
+    finds every date pd.to_datetime does, on the same day unless it is BC, and more"""
+
+    cases = {
+        'June 23, 1889': ('1889-06-23', '1889-06-23', 'day', 'exact'),
+        '1878': ('1878-01-01', '1878-12-31', 'year', 'exact'),
+        '1936?': ('1936-01-01', '1936-12-31', 'year', 'uncertain'),
+        'July 1917': ('1917-07-01', '1917-07-31', 'month', 'exact'),
+        'autumn 1919?': ('1919-09-01', '1919-11-30', 'season', 'uncertain'),
+        'February -0341': ('-341-02-01', '-341-02-28', 'month', 'exact'),
+        '1914 to 1916': ('1914-01-01', '1916-12-31', 'year', 'range'),
+        'October 1917 to January 1918': ('1917-10-01', '1918-01-31', 'month', 'range'),
+        'August 22, 1891, August 22, 1896': ('1891-08-22', '1896-08-22', 'day', 'alternatives'),
+        'c. 1920s': ('1920-01-01', '1929-12-31', 'decade', 'approximate'),
+        '1500s': ('1500-01-01', '1599-12-31', 'century', 'exact'),
+        '1900s': ('1900-01-01', '1909-12-31', 'decade', 'exact'),
+        '1910s': ('1910-01-01', '1919-12-31', 'decade', 'exact'),
+        '19th century': ('1800-01-01', '1899-12-31', 'century', 'exact'),
+        '23 June 1889': ('1889-06-23', '1889-06-23', 'day', 'exact'),
+        '1 May 1917': ('1917-05-01', '1917-05-01', 'day', 'exact'),
+        '1 May 1917 to 3 June 1918': ('1917-05-01', '1918-06-03', 'day', 'range'),
+        '1914-16': ('1914-01-01', '1916-12-31', 'year', 'range'),
+        '1899-01': ('1899-01-01', '1901-12-31', 'year', 'range'),
+        '1916 to 1914': (None, None, None, None),
+        '1/5/1917': ('1917-01-05', '1917-05-01', 'day', 'alternatives'),
+        '13/5/1917': ('1917-05-13', '1917-05-13', 'day', 'exact'),
+        '31/31/1917': (None, None, None, None),
+        '5/1917': ('1917-05-01', '1917-05-31', 'month', 'exact'),
+        '1891/1896': ('1891-01-01', '1896-12-31', 'year', 'alternatives'),
+        '1, 2': (None, None, None, None),
+        'date unknown': (None, None, None, 'unknown'),
+        'February 30, 1900': (None, None, None, None),
+        'Shanghai': (None, None, None, None),
+    }
+    got = maprrBack.parse_dates(pd.Series(list(cases)))
+    for (text, expected), row in zip(cases.items(), got.itertuples(index=False)):
+        row = tuple(None if pd.isna(v) else str(np.datetime64(v, 'D')) if i < 2 else v for i, v in enumerate(row))
+        assert row == expected, (text, row, expected)
+    for name, col in date_columns().items():
+        old = pd.to_datetime(col, errors='coerce', format='mixed')
+        new = maprrBack.parse_dates(col)
+        found = old.notna()
+        # to_datetime drops the minus of BC years, 'February -0341' comes out as AD 341
+        differ = found & (new.start != old)
+        assert col[differ].astype(str).str.contains(r'(?:^| )-\d').all(), col[differ]
+        print(f"{name}: to_datetime {found.sum()}, parse_dates {new.start.notna().sum()} of {col.notna().sum()} "
+              f"({new.certainty.value_counts().to_dict()})")
+    return got
+
+def bench_dates(scales=(1, 50), repeat=5):
+    """This function times pd.to_datetime(format='mixed') on the date columns, as the notebook runs on every
+    load, against parse_dates, on the columns repeated up to each scale, and prints the parse_date cache hits"""
+
+    results = {}
+    for scale in scales:
+        cols = [pd.concat([col]*scale, ignore_index=True) for col in date_columns().values()]
+        cases = {
+            'to_datetime': lambda: [pd.to_datetime(col, errors='coerce', format='mixed') for col in cols],
+            'parse_dates (cold cache)': lambda: (maprrBack.parse_date.cache_clear(), [maprrBack.parse_dates(col) for col in cols]),
+            'parse_dates': lambda: [maprrBack.parse_dates(col) for col in cols],
+        }
+        for name, case in cases.items():
+            t1 = time.perf_counter()
+            for _ in range(repeat):
+                case()
+            results[(scale, name)] = (time.perf_counter()-t1)/repeat*1000
+            print(f"x{scale} {name}: {round(results[(scale, name)], 2)} ms")
+    print(f"parse_date cache: {maprrBack.parse_date.cache_info()}")
+    return results
+
+def variant(text, rng, rate=.02):
+    """This function makes a variant reading of text by replacing about rate of its letters"""
+
+    chars = list(text)
+    letters = [i for i, c in enumerate(chars) if c.isalpha()]
+    for i in rng.choice(letters, int(len(letters)*rate), replace=False) if letters else []:
+        chars[i] = rng.choice(list('абвгдеклмнопрст'))
+    return ''.join(chars)
+
+def varied_works(WsDf, scale, seed=0, rate=.02):
+    """This function repeats the legacy works up to scale times with fresh ids, each copy a variant reading"""
+
+    rng = np.random.default_rng(seed)
+    copies = [WsDf] + [WsDf.assign(text=WsDf.text.map(lambda texts: [variant(t, rng, rate) for t in texts])) for _ in range(scale-1)]
+    works = pd.concat(copies, ignore_index=True)
+    works.index += 1
+    return works
+
+def brute_pairs(signatures, threshold, rows=64):
+    """This function compares every pair of signatures, the quadratic search lsh_pairs avoids"""
+
+    found = []
+    for lo in range(0, len(signatures), rows):
+        scores = (signatures[lo:lo+rows, None] == signatures[None]).mean(2)
+        a, b = np.nonzero(scores >= threshold)
+        a += lo
+        found += [(i, j) for i, j in zip(a.tolist(), b.tolist()) if i < j]
+    return found
+
+def check_duplicates(threshold=.8, seed=0):
+    """This function checks near_duplicates and reprints: stanzas identical once normalized share a cluster,
+    a planted variant and a planted reprint are found, and LSH finds nearly every pair brute force does"""
+
+    WsDf, _ = legacy_frames()
+    rng = np.random.default_rng(seed)
+    w_id = WsDf.index[WsDf.text.map(len) >= 4][0]
+    texts = WsDf.text[w_id]
+    # a variant reading of a whole work, and one of its stanzas reprinted amid other verse
+    WsDf.loc[WsDf.index.max()+1] = WsDf.loc[w_id].copy()
+    WsDf.at[WsDf.index.max(), 'text'] = [variant(t, rng, .01) for t in texts]
+    WsDf.loc[WsDf.index.max()+1] = WsDf.loc[w_id].copy()
+    WsDf.at[WsDf.index.max(), 'text'] = WsDf.text.iloc[0] + [texts[1]]
+    variant_id, reprint_id = WsDf.index[-2:]
+    stanzasDf, pairsDf = maprrBack.near_duplicates(WsDf, threshold)
+    clusters = stanzasDf.cluster
+    assert clusters[(w_id, 1)] == clusters[(variant_id, 1)] == clusters[(reprint_id, len(WsDf.text.iloc[0]))]
+    assert (pairsDf.similarity >= threshold).all() and stanzasDf.similarity.between(threshold-.2, 1).all()
+    norm = WsDf.text.explode().dropna().map(lambda t: ' '.join(re.findall(r'[^\W_]+', t.lower())))
+    norm = norm[norm.str.len() >= maprrBack.shingle_size]
+    keys = pd.Series(norm.to_numpy(), index=pd.MultiIndex.from_arrays([norm.index, norm.groupby(level=0).cumcount()]))
+    same = keys[keys.duplicated(keep=False)]
+    assert same.groupby(same).apply(lambda g: clusters.reindex(g.index).nunique(dropna=False) == 1).all()
+    worksDf, workPairs = maprrBack.reprints(WsDf)
+    assert {w_id, variant_id} <= set(worksDf.index[worksDf.cluster == worksDf.cluster[w_id]])
+    assert worksDf.shared[reprint_id] > 0
+    arr, _, _ = maprrBack.stanza_array(WsDf)
+    hashes, parents = maprrBack.shingle_hashes(arr)
+    signatures = maprrBack.minhash(hashes, parents, len(arr))
+    valid = np.bincount(parents, minlength=len(arr)) > 0
+    a, b, _ = maprrBack.lsh_pairs(signatures, threshold, valid)
+    brute = {(i, j) for i, j in brute_pairs(signatures, threshold) if valid[i] and valid[j]}
+    # buckets pair their members with the first one only, so some brute force pairs are linked through a third
+    labels = maprrBack.connected_labels(len(arr), a, b)
+    missed = [(i, j) for i, j in brute if labels[i] != labels[j]]
+    assert set(zip(a.tolist(), b.tolist())) <= brute and len(missed) <= .05*len(brute), (missed, len(brute))
+    print(f"{len(pairsDf)} stanza pairs in {clusters.nunique()} clusters, {len(workPairs)} work pairs, "
+          f"LSH clusters hold {len(brute)-len(missed)} of {len(brute)} brute force pairs")
+
+def bench_dedup(scales=(1, 10), threshold=.8, brute_max=5000):
+    """This function times near_duplicates and reprints on the legacy works repeated up to each scale as
+    variant readings, against comparing every pair of stanza signatures (up to brute_max stanzas)"""
+
+    WsDf, _ = legacy_frames()
+    results = {}
+    for scale in scales:
+        works = varied_works(WsDf, scale)
+        arr, _, _ = maprrBack.stanza_array(works)
+        cases = {
+            'near_duplicates': lambda: maprrBack.near_duplicates(works, threshold),
+            'reprints': lambda: maprrBack.reprints(works),
+        }
+        if len(arr) <= brute_max:
+            hashes, parents = maprrBack.shingle_hashes(arr)
+            signatures = maprrBack.minhash(hashes, parents, len(arr))[np.bincount(parents, minlength=len(arr)) > 0]
+            cases['brute force pairs'] = lambda: brute_pairs(signatures, threshold)
+        for name, case in cases.items():
+            t1 = time.perf_counter()
+            found = case()
+            results[(scale, name)] = (time.perf_counter()-t1)*1000
+            print(f"x{scale} ({len(arr)} stanzas) {name}: {round(results[(scale, name)], 1)} ms, {len(found[1] if name != 'brute force pairs' else found)} pairs")
+    return results
+
+def bench_graph(repeat=10000):
+    """This function times the notebook's authorsDf (groupby on author name, then merge with AsDf on
+    name) against author_summary over an EntityGraph, checks they agree, and times neighbour and
+    degree queries and saving/loading the graph file"""
+
+    WsDf, AsDf = legacy_frames()
+    libDf = WsDf.rename(columns=lambda k: maprrBack.tidy_name('works', k))
+    libDf['num_words'] = maprrBack.work_counts(libDf).num_words
+    counts = libDf[['num_words']]
+
+    def notebook():
+        authorsDf = libDf.reset_index().groupby('author').size().to_frame().rename(columns={0: 'num_works'})
+        authorsDf['num_words'] = libDf.reset_index().groupby('author').num_words.sum()
+        authorsDf['avg_wpw'] = round(authorsDf.num_words/authorsDf.num_works, 2)
+        authorsDf = authorsDf.reset_index().sort_values(by=['avg_wpw'], ascending=False).rename(columns={'author': 'name'})
+        return pd.merge(AsDf.reset_index(), authorsDf.reset_index(), how='right', on='name').set_index('index_x')
+
+    path = os.path.join(tempfile.mkdtemp(), 'graph.bin')
+    cases = {
+        'notebook groupby + merge': notebook,
+        'build graph + author_summary': lambda: maprrBack.author_summary(libDf, AsDf, counts),
+        'author_summary on a loaded graph': lambda: maprrBack.author_summary(libDf, AsDf, counts, maprrBack.EntityGraph(path)),
+    }
+    maprrBack.EntityGraph().build(WsDf=libDf, AsDf=AsDf).save(path)
+    results = {}
+    for name, case in cases.items():
+        t1 = time.perf_counter()
+        for _ in range(20):
+            out = case()
+        results[name] = (time.perf_counter()-t1)/20*1000
+        print(f"{name}: {round(results[name], 2)} ms")
+    # the notebook gives a name shared by two agents to both, the graph to the first
+    old = notebook()
+    tied = old[old.index.notna()]
+    tied = tied[tied.index.astype('int64').isin(out.index)]
+    assert (out.loc[tied.index.astype('int64'), ['num_works', 'num_words']].to_numpy() == tied[['num_works', 'num_words']].to_numpy()).all()
+    # authors with no agent are kept by name, as the notebook's right merge keeps them
+    untied = old[old.index.isna()].set_index('name')[['num_works', 'num_words']].sort_index()
+    kept = out[out.index.isna()].set_index('name')[['num_works', 'num_words']].sort_index()
+    assert len(untied) and kept.equals(untied.astype('int64')), (kept, untied)
+
+    graph = maprrBack.EntityGraph(path)
+    t1 = time.perf_counter()
+    maprrBack.EntityGraph(path)
+    results['load'] = (time.perf_counter()-t1)*1000
+    print(f"load: {round(results['load'], 3)} ms")
+    for query in ('neighbours', 'degree'):
+        t1 = time.perf_counter()
+        for i in range(repeat):
+            getattr(graph, query)('author_works', 1)
+        results[query] = (time.perf_counter()-t1)/repeat*1e6
+        print(f"{query}: {round(results[query], 2)} us")
+    return results
+
+def check_nlp(works=3):
+    """This function checks nlp_tokens gives the same tokens for works read back from Parquet, whose
+    text comes back as arrays, as for the same works loaded from the CSV dump, and that the lemmas
+    go to the cache at the path given, where later runs and fresh worker processes find them"""
+
+    WsDf, AsDf = legacy_frames()
+    WsDf = WsDf.head(works)
+    tmp = tempfile.mkdtemp()
+    maprrBack.write_frames(WsDf, AsDf, tmp)
+    stored = maprrBack.read_frame('WsDf', path=tmp)
+    cache_path = os.path.join(tmp, 'lemmas.sqlite')
+    expected = maprrBack.nlp_tokens(WsDf, procs=1, cache_path=cache_path)
+    got = maprrBack.nlp_tokens(stored, procs=1, cache_path=cache_path)
+    assert len(expected) and got.equals(expected), (len(got), len(expected))
+    assert maprrBack.nlp_models['lemmas'].path == cache_path
+    with sqlite3.connect(cache_path) as db:
+        assert db.execute('SELECT COUNT(*) FROM lemmas').fetchone()[0] == expected.attrs['lemma_cache']['miss'] > 0
+    first, second = expected.attrs['lemma_cache'], got.attrs['lemma_cache']
+    assert second['miss'] == 0 and second['hit_rate'] > first['hit_rate'], (first, second)
+    # workers that open the cache themselves find every lemma on disk
+    maprrBack.nlp_models.pop('lemmas')
+    pooled = maprrBack.nlp_tokens(stored, procs=2, cache_path=cache_path).attrs['lemma_cache']
+    assert pooled['miss'] == 0 and pooled['disk'] > 0, pooled
+    print(f"nlp_tokens: {len(got)} tokens from Parquet and CSV alike, lemma cache {first} then {second}, pooled {pooled}")
+
+def bench_nlp(works=None, procs=None, batch_size=64):
+    """This function runs the NLP stage over the first works works of the saved corpus (all of them
+    by default) on 1, 2, 4... processes and prints tokens/sec overall and per core. Worker start-up,
+    model loading included, is part of the time. Runs after the first find their lemmas in the
+    lemma cache"""
+
+    WsDf, _ = legacy_frames()
+    WsDf = WsDf if works is None else WsDf.head(works)
+    procs = procs or sorted({2**i for i in range((os.cpu_count() or 1).bit_length())} | {os.cpu_count() or 1})
+    results = {}
+    for n in procs:
+        t1 = time.perf_counter()
+        tokensDf = maprrBack.nlp_tokens(WsDf, procs=n, batch_size=batch_size)
+        t2 = time.perf_counter()
+        tokens = len(tokensDf)
+        results[n] = tokens/(t2-t1)
+        print(f"{n} processes: {round(results[n])} tokens/sec, {round(results[n]/n)} tokens/sec/core ({tokens} tokens, "
+              f"lemma cache hit rate {round(tokensDf.attrs['lemma_cache']['hit_rate'], 3)})")
+    return results
+
+def corpus_tokens(path='tokens.parquet'):
+    """This function returns the token table of the saved corpus, running the NLP stage the first time"""
+
+    if os.path.exists(path):
+        return pd.read_parquet(path)
+    WsDf, _ = legacy_frames()
+    return maprrBack.nlp_tokens(WsDf, path=path)
+
+def check_index(phrases=('тихо в доме', 'последний мак', 'красное знамя')):
+    """This function checks TextIndex phrase search against a regex scan of the stanzas, and that
+    update() swaps one work's words without touching the rest"""
+
+    WsDf, _ = legacy_frames()
+    tokensDf = corpus_tokens()
+    index = maprrBack.TextIndex(tempfile.mkdtemp())
+    index.build(tokensDf)
+    for phrase in phrases:
+        pattern = re.compile(r'(?<!\S)' + r'\W+'.join(phrase.split()) + r'(?!\w)', re.I)
+        scan = [(w_id, i) for w_id, texts in WsDf.text.items() for i, text in enumerate(texts) if pattern.search(text)]
+        found = index.search(f'"{phrase}"')
+        assert set(scan) <= set(found), (phrase, scan, found)
+        print(f'"{phrase}": {len(found)} stanzas, scan {len(scan)}')
+    w_id = index.works('мак')[0]
+    others = [k for k in index.search('мак') if k[0] != w_id]
+    fresh = tokensDf[tokensDf.w_id == w_id].replace({'token': {'мак': 'ромашка'}, 'lemma': {'мак': 'ромашка'}})
+    index.update(fresh, [w_id])
+    assert index.search('мак') == others and index.works('ромашка') == [w_id]
+    assert maprrBack.TextIndex(index.path).search('NOT мак AND ромашка') == index.search('ромашка')
+    # each write is a new version, the one before is kept for readers still opening it
+    versions = sorted(v for v in os.listdir(index.path) if v.startswith('v'))
+    with open(os.path.join(index.path, 'CURRENT')) as f:
+        assert len(versions) == 2 and f.read() == versions[-1], versions
+    for w_id, stanza, offset in ((1, 1 << 12, 0), (1, 0, 1 << 20)):
+        try:
+            maprrBack.posting_keys(w_id, stanza, offset)
+        except ValueError:
+            continue
+        raise AssertionError(f"posting_keys took stanza {stanza}, offset {offset}")
+    print("TextIndex matches the scan and updates in place")
+
+def bench_index(scales=(1, 10, 50), repeat=200,
+                queries=('мак', 'дом AND мак', 'дом OR ночь', 'дом NOT мак', '"тихо в доме"', '(дом OR "последний мак") AND тихо')):
+    """This function times building and opening a TextIndex and answering queries at several corpus sizes
+    (the saved corpus repeated under new work ids), against a linear str.contains scan over WsDf.text"""
+
+    WsDf, _ = legacy_frames()
+    tokensDf = corpus_tokens()
+    span = int(WsDf.index.max()) + 1
+    results = {}
+    for scale in scales:
+        tokens = pd.concat([tokensDf.assign(w_id=tokensDf.w_id + k*span) for k in range(scale)], ignore_index=True)
+        stanzas = pd.concat([WsDf.text.explode().dropna()]*scale, ignore_index=True)
+        path = tempfile.mkdtemp()
+        t1 = time.perf_counter()
+        maprrBack.TextIndex(path).build(tokens)
+        t2 = time.perf_counter()
+        index = maprrBack.TextIndex(path)
+        t3 = time.perf_counter()
+        print(f"x{scale} ({len(tokens)} tokens): build {round(t2-t1, 2)} s, open {round((t3-t2)*1000, 2)} ms")
+        for query in queries:
+            index.search(query)
+            t1 = time.perf_counter()
+            for _ in range(repeat):
+                index.search(query)
+            results[(scale, query)] = (time.perf_counter()-t1)/repeat*1000
+            print(f"x{scale} {query}: {round(results[(scale, query)], 3)} ms")
+        t1 = time.perf_counter()
+        stanzas.str.contains('мак', case=False)
+        results[(scale, 'scan')] = (time.perf_counter()-t1)*1000
+        print(f"x{scale} scan for 'мак': {round(results[(scale, 'scan')], 2)} ms")
+    return results
+
+def metric_name(key):
+    """This function turns a bench result key, such as (scale, case), into a report metric name"""
+
+    if isinstance(key, tuple):
+        return f'x{key[0]} ' + ' '.join(map(str, key[1:]))
+    return str(key)
+
+def flatten(results, unit):
+    """This function turns a bench's results into {metric: {'value', 'unit'}}. Nested dicts give one
+    metric per inner key, which is then the unit, like {'async': {'pages/s': 80.1, 'requests': 104}}"""
+
+    report = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            for inner, v in value.items():
+                report[f'{metric_name(key)} {inner}'] = {'value': v, 'unit': inner}
+        else:
+            report[metric_name(key)] = {'value': value, 'unit': unit(key) if callable(unit) else unit}
+    return report
+
+def suite(quick=False, seed=0, latency=.02, error_rate=.1):
+    """This function returns the benches run_suite knows, as {name: (function, unit)}, sized down when quick"""
+
+    n = 10 if quick else 50
+    return {
+        'crawl': (lambda: bench_crawl(n=n, latency=latency, jitter=.5, seed=seed, legacy_n=2 if quick else 5), None),
+        'crawl_faults': (lambda: bench_crawl(n=n, latency=latency, jitter=.5, error_rate=error_rate, seed=seed,
+                                             engines=['serial', 'parallel (fetch+parse)', 'async']), None),
+        'stream': (lambda: bench_stream(n=50 if quick else 200), None),
+        'parse': (lambda: bench_parse(repeat=3 if quick else 20), 'pages/s'),
+        'load': (lambda: bench_load(repeat=1 if quick else 5), 'ms'),
+        'import': (lambda: bench_import(repeat=2 if quick else 5), 'ms'),
+        'dates': (lambda: bench_dates(scales=(1,) if quick else (1, 50)), 'ms'),
+        'text': (lambda: bench_text(scales=(1,) if quick else (1, 50)), 's'),
+        'dedup': (lambda: bench_dedup(scales=(1,) if quick else (1, 10)), 'ms'),
+        'graph': (lambda: bench_graph(repeat=1000 if quick else 10000), lambda k: 'us' if k in ('neighbours', 'degree') else 'ms'),
+        'index': (lambda: bench_index(scales=(1,) if quick else (1, 10, 50), repeat=20 if quick else 200), 'ms'),
+        'nlp': (lambda: {f'{k} procs': v for k, v in bench_nlp(works=10 if quick else None, procs=[1] if quick else None).items()}, 'tokens/s'),
+    }
+
+def checks():
+    """This function returns the behaviour checks run_suite runs with checks=True, as {name: function}"""
+
+    return {name[len('check_'):]: fn for name, fn in globals().items() if name.startswith('check_') and callable(fn)}
+
+def run_checks(only=None):
+    """This function runs the checks in checks() (or just those named in only), each from the current
+    directory, and returns {name: {'ok', 'seconds'}} with the error of any that fails"""
+
+    found = checks()
+    results = {}
+    cwd = os.getcwd()
+    for name in only or found:
+        print(f"== check {name}")
+        t1 = time.perf_counter()
+        try:
+            found[name]()
+            entry = {'ok': True}
+        except Exception as e:
+            entry = {'ok': False, 'error': repr(e)}
+            print(f"check {name} failed: {e!r}")
+        finally:
+            os.chdir(cwd)
+        entry['seconds'] = time.perf_counter() - t1
+        results[name] = entry
+    failed = [name for name, entry in results.items() if not entry['ok']]
+    print(f"{len(results) - len(failed)}/{len(results)} checks passed" + (f", failed: {', '.join(failed)}" if failed else ''))
+    return results
+
+def environment():
+    """This function describes where a report was made: commit, interpreter, machine and library versions"""
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    versions = {}
+    for name in ('pandas', 'numpy', 'pyarrow', 'lxml', 'bs4', 'aiohttp', 'requests', 'natasha'):
+        try:
+            versions[name] = getattr(importlib.import_module(name), '__version__', None)
+        except ImportError:
+            versions[name] = None
+    return {'commit': commit, 'python': platform.python_version(), 'platform': platform.platform(),
+            'cpus': os.cpu_count(), 'versions': versions}
+
+def run_suite(path='bench_report.json', only=None, quick=False, seed=0, latency=.02, error_rate=.1, checks=False):
+    """This function runs the benches in suite() (or just those named in only) with fixed seeds and writes
+    a JSON report of every metric with its unit, the settings and the environment. A bench that fails
+    is recorded with its error rather than stopping the rest. With checks, the behaviour checks run first
+    and the report's 'ok' says whether all of them passed; checks can also be a list of check names"""
+
+    benches = suite(quick, seed, latency, error_rate)
+    report = {'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'environment': environment(),
+              'settings': dict(quick=quick, seed=seed, latency=latency, error_rate=error_rate), 'benches': {}}
+    if checks:
+        report['checks'] = run_checks(None if checks is True else checks)
+        report['ok'] = all(entry['ok'] for entry in report['checks'].values())
+    for name in benches if only is None else only:
+        bench, unit = benches[name]
+        print(f"== {name}")
+        random.seed(seed)
+        np.random.seed(seed)
+        t1 = time.perf_counter()
+        try:
+            entry = {'metrics': flatten(bench(), unit)}
+        except Exception as e:
+            entry = {'error': repr(e)}
+            print(f"{name} failed: {e!r}")
+        entry['seconds'] = time.perf_counter() - t1
+        report['benches'][name] = entry
+    with open(path + '.tmp', 'w') as f:
+        json.dump(report, f, indent=1, default=float)
+    os.replace(path + '.tmp', path)
+    print(f"Report written to {path}")
+    return report
+
+def better(unit):
+    """This function says whether more ('higher') or less ('lower') of a unit is better, None for plain counts"""
+
+    if unit.endswith('/s'):
+        return 'higher'
+    if unit in ('s', 'ms', 'us', 'MB'):
+        return 'lower'
+    return None
+
+def compare_reports(old, new, threshold=.05):
+    """This function compares two reports (paths or dicts) metric by metric and prints new/old for each,
+    marking changes past threshold as faster or slower. Returns {(bench, metric): ratio}"""
+
+    reports = []
+    for report in (old, new):
+        if isinstance(report, str):
+            with open(report) as f:
+                report = json.load(f)
+        reports.append(report)
+    old, new = reports
+    if old.get('settings') != new.get('settings'):
+        print(f"Settings differ: {old.get('settings')} vs {new.get('settings')}")
+    ratios = {}
+    for name, entry in new['benches'].items():
+        before = old['benches'].get(name, {}).get('metrics', {})
+        for metric, m in entry.get('metrics', {}).items():
+            if metric not in before or not before[metric]['value']:
+                continue
+            ratio = ratios[(name, metric)] = m['value']/before[metric]['value']
+            direction = better(m['unit'])
+            if direction is None:
+                mark = '' if ratio == 1 else ' changed'
+            elif abs(ratio - 1) <= threshold:
+                mark = ''
+            else:
+                mark = ' faster' if (ratio > 1) == (direction == 'higher') else ' slower'
+            print(f"{name} {metric}: {round(before[metric]['value'], 3)} -> {round(m['value'], 3)} {m['unit']} (x{round(ratio, 3)}){mark}")
+    return ratios
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the maprrBack benchmarks against a local mock of the MAPRR site')
+    parser.add_argument('benches', nargs='*', help=f"benches to run out of {', '.join(suite())}, all of them by default")
+    parser.add_argument('--check', action='store_true',
+                        help='run the behaviour checks first and exit with an error if any of them fails')
+    parser.add_argument('--only-checks', nargs='*', metavar='CHECK',
+                        help=f"run just these checks out of {', '.join(checks())} (all of them if none named) and no benches")
+    parser.add_argument('--out', default='bench_report.json', help='where to write the JSON report')
+    parser.add_argument('--compare', help='an earlier report to compare this one with')
+    parser.add_argument('--quick', action='store_true', help='smaller sizes and fewer repeats')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=.02, help='seconds the mock site holds back each response')
+    parser.add_argument('--error-rate', type=float, default=.1, help='share of pages failing once in the crawl_faults bench')
+    args = parser.parse_args()
+    if args.only_checks is not None:
+        report = run_suite(args.out, [], args.quick, args.seed, latency=args.latency, error_rate=args.error_rate,
+                           checks=args.only_checks or True)
+    else:
+        report = run_suite(args.out, args.benches or None, args.quick, args.seed, latency=args.latency,
+                           error_rate=args.error_rate, checks=args.check)
+    if args.compare:
+        compare_reports(args.compare, report)
+    if not report.get('ok', True):
+        sys.exit(1)